@@ -0,0 +1,106 @@
+"""
+进行中订单索引 - 车辆/用户到当前订单的内存映射
+
+启动时从数据库加载所有进行中的订单，开锁/还车提交后同步维护（经事件总线同步到所有 worker）。
+- GPS 轨迹点按车辆查找当前订单号，无需每个点查询一次数据库
+- 刷卡还车按车辆查找当前订单，按主键读取订单，不再按 用户+车辆+状态 条件查询
+- 开锁前先占用用户（claim_user）：同一进程内同一用户几乎同时在两辆车上刷卡时只有一个能继续开锁，
+  其余直接拒绝、不访问数据库。占用只在本进程内有效，一人一单由 order_service 在数据库事务中保证
+
+索引未加载成功（ready 为 False）时，调用方应改为查询数据库。
+"""
+import threading
+import logging
+from typing import Any, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from models import Order, OrderStatus
+
+logger = logging.getLogger(__name__)
+
+# 用户已占用、订单尚未提交时 _by_user 中的占位值
+PENDING = 0
+
+
+class ActiveOrderIndex:
+    """进行中订单索引（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        self._by_bike: Dict[int, int] = {}  # bike_id -> order_id
+        self._by_user: Dict[int, int] = {}  # user_id -> order_id（开锁中为 PENDING）
+
+    def load(self, db: Session) -> int:
+        """从数据库加载全部进行中的订单"""
+        rows = (
+            db.query(Order.id, Order.bike_id, Order.user_id)
+            .filter(Order.status == OrderStatus.ACTIVE.value)
+            .order_by(Order.id)
+            .all()
+        )
+        with self._lock:
+            self._by_bike = {bike_id: order_id for order_id, bike_id, _ in rows if bike_id is not None}
+            self._by_user = {user_id: order_id for order_id, _, user_id in rows if user_id is not None}
+            self.ready = True
+        if len(self._by_user) < len(rows):
+            logger.warning(f"进行中订单: {len(rows)} 个订单属于 {len(self._by_user)} 个用户，存在同一用户多个进行中的订单")
+        logger.info(f"进行中订单已加载: {len(self._by_bike)} 个")
+        return len(self._by_bike)
+
+    def claim_user(self, user_id: int) -> Optional[int]:
+        """
+        开锁前占用用户：用户没有进行中的订单时占用并返回 None，
+        否则返回其当前订单号（开锁中为 PENDING）。占用后须调用 start 或 release_user
+        """
+        with self._lock:
+            current = self._by_user.get(user_id)
+            if current is None:
+                self._by_user[user_id] = PENDING
+            return current
+
+    def release_user(self, user_id: int):
+        """开锁失败时释放占用"""
+        with self._lock:
+            if self._by_user.get(user_id) == PENDING:
+                del self._by_user[user_id]
+
+    def start(self, bike_id: int, order_id: int, user_id: int = None):
+        """开锁成功（订单已提交）后调用"""
+        with self._lock:
+            self._by_bike[bike_id] = order_id
+            if user_id is not None:
+                self._by_user[user_id] = order_id
+
+    def finish(self, bike_id: int, order_id: int = None, user_id: int = None):
+        """还车成功后调用；传入 order_id 时只移除该订单"""
+        with self._lock:
+            if order_id is None or self._by_bike.get(bike_id) == order_id:
+                self._by_bike.pop(bike_id, None)
+            if user_id is not None and (order_id is None or self._by_user.get(user_id) == order_id):
+                self._by_user.pop(user_id, None)
+
+    def order_for_bike(self, bike_id: int) -> Optional[int]:
+        return self._by_bike.get(bike_id)
+
+    def order_for_user(self, user_id: int) -> Optional[int]:
+        """用户当前的订单号（开锁中的占用不算）"""
+        return self._by_user.get(user_id) or None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = sum(1 for order_id in self._by_user.values() if order_id == PENDING)
+            return {
+                "ready": self.ready,
+                "by_bike": len(self._by_bike),
+                "by_user": len(self._by_user) - pending,
+                "pending_unlocks": pending,
+            }
+
+    def __len__(self) -> int:
+        return len(self._by_bike)
+
+
+# 全局进行中订单索引
+active_orders = ActiveOrderIndex()
@@ -0,0 +1,148 @@
+"""
+车辆状态写回缓冲 - 合并心跳/GPS 更新后批量写入数据库
+
+每辆车只保留最新的位置、电量和心跳时间，
+按固定间隔用一条 CASE 批量 UPDATE 写回，替代每条消息一次事务。
+
+车辆状态不经缓冲：开锁/还车提交的状态可能晚于缓冲中的心跳，
+延迟写入的旧状态会覆盖它（见 mqtt_message_handler.write_bike_status）。
+"""
+import threading
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import case, update
+
+from config import settings
+from database import engine
+from models import Bike
+
+logger = logging.getLogger(__name__)
+
+bikes_table = Bike.__table__
+
+# 参与写回的列（不含 status）
+BUFFERED_COLUMNS = ("current_lat", "current_lng", "battery", "last_heartbeat")
+
+
+class BikeWriteBuffer:
+    """车辆状态写回缓冲（线程安全）"""
+
+    def __init__(self, flush_interval: float = None, batch_size: int = None):
+        self.flush_interval = flush_interval or settings.DB_FLUSH_INTERVAL
+        self.batch_size = batch_size or settings.DB_FLUSH_BATCH_SIZE
+
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # 统计指标
+        self.received = 0  # 收到的更新数
+        self.coalesced = 0  # 被合并（未单独写库）的更新数
+        self.rows_written = 0  # 实际写入的行数
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+
+    def record(self, bike_id: int, **fields):
+        """记录一辆车的最新状态，值为 None 的字段不覆盖已有值"""
+        values = {k: v for k, v in fields.items() if v is not None}
+        with self._lock:
+            self.received += 1
+            entry = self._pending.get(bike_id)
+            if entry is None:
+                self._pending[bike_id] = values
+            else:
+                entry.update(values)
+                self.coalesced += 1
+
+    def flush(self) -> int:
+        """将缓冲中的更新批量写入数据库，返回写入的车辆数"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+
+            start = time.perf_counter()
+            items = list(pending.items())
+            try:
+                with engine.begin() as conn:
+                    for i in range(0, len(items), self.batch_size):
+                        conn.execute(self._build_update(items[i:i + self.batch_size]))
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error(f"写回车辆状态失败: {e}")
+                self._restore(pending)
+                return 0
+
+            self.flush_count += 1
+            self.rows_written += len(items)
+            self.last_flush_ms = (time.perf_counter() - start) * 1000
+            logger.debug("写回车辆状态: %d 辆, 耗时 %.1f ms", len(items), self.last_flush_ms)
+            return len(items)
+
+    def _build_update(self, items: List[tuple]):
+        """构造 UPDATE bikes SET col = CASE id WHEN ... END WHERE id IN (...)"""
+        values = {}
+        for column in BUFFERED_COLUMNS:
+            mapping = {bike_id: entry[column] for bike_id, entry in items if column in entry}
+            if mapping:
+                values[column] = case(mapping, value=bikes_table.c.id, else_=bikes_table.c[column])
+
+        bike_ids = [bike_id for bike_id, _ in items]
+        return update(bikes_table).where(bikes_table.c.id.in_(bike_ids)).values(**values)
+
+    def _restore(self, pending: Dict[int, Dict[str, Any]]):
+        """写库失败时放回缓冲，不覆盖期间到达的更新"""
+        with self._lock:
+            for bike_id, entry in pending.items():
+                newer = self._pending.get(bike_id)
+                if newer is not None:
+                    entry.update(newer)
+                self._pending[bike_id] = entry
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        """启动后台写回线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="bike-write-buffer", daemon=True)
+        self._thread.start()
+        logger.info(f"车辆状态写回缓冲已启动，间隔 {self.flush_interval}s")
+
+    def stop(self):
+        """停止后台线程并写回剩余数据"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        flushed = self.flush()
+        logger.info(f"车辆状态写回缓冲已停止，关闭前写回 {flushed} 辆")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取合并统计"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "rows_written": self.rows_written,
+            "coalesce_ratio": round(self.received / self.rows_written, 2) if self.rows_written else None,
+            "pending": pending,
+            "flush_count": self.flush_count,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "flush_interval": self.flush_interval,
+        }
+
+
+# 全局写回缓冲实例
+bike_write_buffer = BikeWriteBuffer()
@@ -1,14 +1,46 @@
+"""
+数据库连接与会话
+
+SQLAlchemy 会话是同步的，不能在事件循环中直接使用（每次查询都会阻塞所有 WebSocket 推送）。约定：
+- 访问数据库的路由写成同步函数 func(..., db: Session)，用 @db_route 包装成异步路由：
+  整个函数（含提交和关闭会话）在数据库线程池中执行，返回事件循环前连接已归还连接池，
+  响应在事件循环中序列化
+- 先查内存、未命中才访问数据库的路由保持 async def，数据库部分通过 run_db 执行
+- 数据库线程池并发上限为 DB_THREADPOOL_SIZE（默认等于连接池常驻连接数），
+  超出的请求在事件循环中排队，不占用线程也不阻塞其他请求；
+  连接池的额外连接留给后台写库线程（写回缓冲、轨迹写入、MQTT 消息处理）
+"""
+import inspect
+import functools
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import anyio
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config import settings
 
+T = TypeVar("T")
+
+# 内存 SQLite 使用单连接池，不支持连接池参数
+_url = make_url(settings.DATABASE_URL)
+if _url.get_backend_name() == "sqlite" and _url.database in (None, "", ":memory:"):
+    _pool_options = {}
+else:
+    _pool_options = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
+
 # 创建数据库引擎
 engine = create_engine(
     settings.DATABASE_URL,
     pool_pre_ping=True,  # 自动检测连接是否有效
     pool_recycle=3600,  # 1小时后回收连接
     echo=False,  # 生产环境设为 False，开发调试可设为 True
+    **_pool_options,
 )
 
 # 创建 SessionLocal 类
@@ -20,7 +52,7 @@ Base = declarative_base()
 
 def get_db():
     """
-    依赖注入函数，用于获取数据库会话
+    依赖注入函数，用于获取数据库会话（后台线程中使用，路由使用 @db_route）
     """
     db = SessionLocal()
     try:
@@ -29,6 +61,58 @@ def get_db():
         db.close()
 
 
+# 数据库线程池的并发上限（应用启动时创建，未创建时使用 anyio 默认线程池）
+_limiter: Optional[anyio.CapacityLimiter] = None
+
+
+def configure_threadpool():
+    """创建数据库线程池的并发上限（须在事件循环中调用，应用启动时执行一次）"""
+    global _limiter
+    _limiter = anyio.CapacityLimiter(settings.db_threadpool_size)
+
+
+async def run_db(func: Callable[..., T], *args) -> T:
+    """在数据库线程池中用新会话执行同步函数 func(db, *args)，返回前关闭会话"""
+    def call():
+        db = SessionLocal()
+        try:
+            return func(db, *args)
+        finally:
+            db.close()
+
+    return await anyio.to_thread.run_sync(call, limiter=_limiter)
+
+
+def db_route(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """把同步路由函数 func(..., db: Session) 包装成在数据库线程池中执行的异步路由"""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def endpoint(*args, **kwargs):
+        return await run_db(lambda db: func(*args, db=db, **kwargs))
+
+    # FastAPI 按签名解析参数，去掉由 run_db 提供的 db
+    endpoint.__signature__ = signature.replace(
+        parameters=[p for p in signature.parameters.values() if p.name != "db"]
+    )
+    return endpoint
+
+
+def get_db_metrics() -> Dict[str, Any]:
+    """连接池与数据库线程池状态"""
+    pool = engine.pool
+    metrics: Dict[str, Any] = {"pool": pool.status()}
+    if hasattr(pool, "checkedout"):
+        metrics["connections_in_use"] = pool.checkedout()
+    if _limiter is not None:
+        metrics.update(
+            threadpool_size=_limiter.total_tokens,
+            threads_busy=_limiter.borrowed_tokens,
+            requests_waiting=_limiter.statistics().tasks_waiting,
+        )
+    return metrics
+
+
 def init_db():
     """
     初始化数据库（创建所有表）
@@ -0,0 +1,226 @@
+"""
+领域事件 - 订单、车辆状态、余额变更主动推送给前端
+
+开锁、还车、充值、注册、修改车辆状态等接口在事务提交后发布领域事件，
+事件经事件总线同步到所有 worker，每个 worker：
+1. 增量更新仪表盘计数（用户总数、今日订单数、今日收入），不再每次查询数据库
+2. 通过 WebSocketManager 推送给订阅者:
+   {"type": "event", "seq", "topic": "event/<事件名>", "data": {...}, "dashboard": {...}}
+前端据此更新页面，无需定时轮询车辆列表和仪表盘接口。
+
+事件数据中涉及车辆变化的带 "bike": {"id", ...变化的字段}。
+
+车辆离线/重新上线由每个 worker 的心跳超时检测各自判定（各 worker 收到的遥测相同），
+只在本进程应用和推送，不经事件总线。
+"""
+import logging
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models import BikeStatus, Order, OrderStatus, User
+from fleet_state import fleet_state
+from event_bus import event_bus
+from websocket_server import EVENT_TOPIC_PREFIX, websocket_manager
+
+logger = logging.getLogger(__name__)
+
+# 事件名（推送主题为 event/<事件名>）
+ORDER_STARTED = "order_started"
+ORDER_COMPLETED = "order_completed"
+BIKE_STATUS_CHANGED = "bike_status_changed"
+BALANCE_CHANGED = "balance_changed"
+USER_REGISTERED = "user_registered"
+BIKE_OFFLINE = "bike_offline"
+BIKE_ONLINE = "bike_online"
+
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+
+def _float(value) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+class DashboardCounters:
+    """
+    仪表盘计数（线程安全）
+
+    车辆数直接取车队状态；用户总数、今日订单数和今日收入启动时从数据库加载，
+    之后按领域事件增量更新，跨天时今日计数清零。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        self.day: Optional[date] = None
+        self.total_users = 0
+        self.today_orders = 0
+        self.today_revenue = Decimal("0.00")
+
+    def load(self, db: Session):
+        """从数据库加载计数"""
+        today = datetime.now().date()
+        total_users = db.query(User).count()
+        today_orders = db.query(Order).filter(func.date(Order.created_at) == today).count()
+        today_revenue = db.query(func.sum(Order.cost)).filter(
+            func.date(Order.created_at) == today,
+            Order.status == OrderStatus.COMPLETED.value,
+        ).scalar() or Decimal("0.00")
+        with self._lock:
+            self.day = today
+            self.total_users = total_users
+            self.today_orders = today_orders
+            self.today_revenue = Decimal(str(today_revenue))
+            self.ready = True
+        logger.info(f"仪表盘计数已加载: 用户 {total_users}，今日订单 {today_orders}，今日收入 {today_revenue}")
+
+    def _roll_over(self):
+        """跨天时清零今日计数（须持有锁）"""
+        today = datetime.now().date()
+        if today != self.day:
+            self.day = today
+            self.today_orders = 0
+            self.today_revenue = Decimal("0.00")
+
+    def apply(self, event: str, data: Dict[str, Any]):
+        """按领域事件更新计数"""
+        with self._lock:
+            self._roll_over()
+            if event == ORDER_STARTED:
+                self.today_orders += 1
+            elif event == ORDER_COMPLETED:
+                # 与仪表盘接口一致：今日收入只统计今天创建的订单
+                created = data.get("created_at") or data.get("start_time")
+                if created and created[:10] == self.day.isoformat():
+                    self.today_revenue += Decimal(str(data.get("cost") or 0))
+            elif event == USER_REGISTERED:
+                self.total_users += 1
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        """当前仪表盘数据（与 DashboardStats 字段一致），计数或车队状态未就绪时返回 None"""
+        if not self.ready or not fleet_state.ready:
+            return None
+        counts = fleet_state.status_counts()
+        with self._lock:
+            self._roll_over()
+            return {
+                "total_bikes": fleet_state.total(),
+                "idle_bikes": counts.get(BikeStatus.IDLE.value, 0),
+                "riding_bikes": counts.get(BikeStatus.RIDING.value, 0),
+                "fault_bikes": counts.get(BikeStatus.FAULT.value, 0),
+                "total_users": self.total_users,
+                "today_orders": self.today_orders,
+                "today_revenue": float(self.today_revenue),
+                "online_bikes": fleet_state.online_count(),
+            }
+
+
+# 全局仪表盘计数
+dashboard_counters = DashboardCounters()
+
+
+class DomainEvents:
+    """领域事件发布（线程安全）：接口在事务提交后调用对应方法"""
+
+    def __init__(self, counters: DashboardCounters):
+        self.counters = counters
+        self.published = 0
+        self.pushed = 0
+        event_bus.register("domain", self._apply)
+        websocket_manager.set_dashboard_provider(counters.snapshot)
+
+    def publish(self, event: str, **data):
+        """发布领域事件：本进程及其他 worker 更新计数并推送给 WebSocket 客户端"""
+        self.published += 1
+        event_bus.emit("domain", event=event, data=data)
+
+    def _apply(self, message: Dict[str, Any]):
+        event, data = message["event"], message["data"]
+        self.counters.apply(event, data)
+        if websocket_manager.publish_event_sync(EVENT_TOPIC_PREFIX + event, data, self.counters.snapshot()):
+            self.pushed += 1
+
+    # 供 API 调用的便捷方法
+
+    @staticmethod
+    def _bike(bike) -> Dict[str, Any]:
+        return {
+            "id": bike.id,
+            "status": bike.status,
+            "current_lat": _float(bike.current_lat),
+            "current_lng": _float(bike.current_lng),
+        }
+
+    def order_started(self, order, bike: Dict[str, Any]):
+        """开锁成功（bike 为车辆变化的字段，见 OrderService.unlock）"""
+        self.publish(
+            ORDER_STARTED,
+            order_id=order.id,
+            user_id=order.user_id,
+            bike_id=bike["id"],
+            start_time=_iso(order.start_time),
+            created_at=_iso(order.created_at),
+            bike=bike,
+        )
+
+    def order_completed(self, order, bike=None):
+        """还车成功"""
+        self.publish(
+            ORDER_COMPLETED,
+            order_id=order.id,
+            user_id=order.user_id,
+            bike_id=order.bike_id,
+            start_time=_iso(order.start_time),
+            end_time=_iso(order.end_time),
+            created_at=_iso(order.created_at),
+            duration_minutes=order.duration_minutes,
+            distance_km=_float(order.distance_km),
+            cost=_float(order.cost),
+            bike=self._bike(bike) if bike is not None else None,
+        )
+
+    def bike_status_changed(self, bike):
+        """管理员修改车辆状态"""
+        self.publish(BIKE_STATUS_CHANGED, bike_id=bike.id, status=bike.status, bike=self._bike(bike))
+
+    def balance_changed(self, user, delta, reason: str):
+        """余额变化（充值、还车扣费）"""
+        self.publish(
+            BALANCE_CHANGED,
+            user_id=user.id,
+            balance=_float(user.balance),
+            delta=_float(delta),
+            reason=reason,
+        )
+
+    def user_registered(self, user):
+        """新用户注册"""
+        self.publish(USER_REGISTERED, user_id=user.id, username=user.username, balance=_float(user.balance))
+
+    def bike_connectivity_changed(self, bike_id: int, online: bool, last_seen: float):
+        """心跳超时检测判定车辆离线/重新上线（只在本进程应用）"""
+        self._apply({
+            "event": BIKE_ONLINE if online else BIKE_OFFLINE,
+            "data": {
+                "bike_id": bike_id,
+                "last_heartbeat": _iso(datetime.fromtimestamp(last_seen)) if last_seen else None,
+                "bike": {"id": bike_id, "online": online},
+            },
+        })
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "published": self.published,
+            "pushed": self.pushed,
+            "dashboard": self.counters.snapshot(),
+        }
+
+
+# 全局领域事件发布器
+domain_events = DomainEvents(dashboard_counters)
@@ -0,0 +1,457 @@
+"""
+跨 worker 事件总线 - 多个 uvicorn worker 共用一条 MQTT 连接
+
+`uvicorn --workers N` 时每个 worker 是独立进程，各自持有车队状态和 WebSocket 连接。
+启用事件总线后：
+- 通过文件锁（flock）选出一个 leader：只有它连接 MQTT、写数据库和轨迹，
+  并在 Unix 域套接字上把收到的车辆消息广播给其他 worker
+- 其他 worker（follower）连接该套接字，把消息应用到本进程的车队状态，
+  再推送给自己的 WebSocket 客户端；follower 发布的 MQTT 指令经总线交给 leader 发布
+- 任一 worker 中由 API 引起的车辆状态、骑行开始/结束也经总线同步到所有 worker
+- 轨迹点缓冲在 leader 中：follower 还车计算距离前经总线请求 leader 写入缓冲中的轨迹点
+- 与 leader 断开期间（或选主期间）的状态变更会丢失：follower 重新连接或接替为 leader 后，
+  重新加载进行中订单索引，并执行各组件用 on_resync 注册的处理（如清空用户缓存）
+- leader 退出后文件锁随进程释放，follower 重连时抢到锁即接替
+
+协议为按行分隔的 JSON。未启用或平台不支持（Windows）时为单进程模式，行为与之前一致。
+"""
+import os
+import json
+import asyncio
+import logging
+import itertools
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows 不支持 flock，只能单进程运行
+    fcntl = None
+
+from config import settings
+from database import SessionLocal
+from mqtt_handler import mqtt_client
+from fleet_state import fleet_state
+from active_orders import active_orders
+from trajectory_writer import trajectory_writer
+
+logger = logging.getLogger(__name__)
+
+ROLE_STANDALONE = "standalone"
+ROLE_LEADER = "leader"
+ROLE_FOLLOWER = "follower"
+
+RECONNECT_DELAY = 1.0  # follower 重连/抢锁间隔（秒）
+
+# 车辆快照中需要还原为 datetime 的字段
+_DATETIME_FIELDS = ("last_heartbeat", "created_at", "updated_at")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message, ensure_ascii=False, default=_json_default).encode("utf-8") + b"\n"
+
+
+class EventBus:
+    """跨 worker 事件总线（除 emit/publish_mqtt 外均在事件循环线程中调用）"""
+
+    def __init__(self, socket_path: str = None, lock_path: str = None, max_buffer: int = None):
+        self.socket_path = socket_path or settings.EVENT_BUS_SOCKET
+        self.lock_path = lock_path or settings.EVENT_BUS_LOCK_FILE
+        self.max_buffer = max_buffer or settings.EVENT_BUS_MAX_BUFFER
+        self.role = ROLE_STANDALONE
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Set[asyncio.StreamWriter] = set()  # leader: 已连接的 follower
+        self._upstream: Optional[asyncio.StreamWriter] = None  # follower: 到 leader 的连接
+        self._task: Optional[asyncio.Task] = None
+        self._start_ingestion: Optional[Callable[[], Awaitable[None]]] = None
+        self._on_mqtt: Optional[Callable[[str, dict], Awaitable[None]]] = None
+        self._flush_ids = itertools.count(1)
+        self._flush_waiters: Dict[int, asyncio.Future] = {}  # follower: 等待 leader 写入轨迹的请求
+        self._resync_handlers: List[Callable[[], None]] = []
+
+        # 各 worker 都要执行的状态变更
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {
+            "bike": self._apply_bike,
+            "bike_upsert": self._apply_bike_upsert,
+            "ride_start": self._apply_ride_start,
+            "ride_finish": self._apply_ride_finish,
+        }
+
+        # 统计指标
+        self.events_sent = 0
+        self.events_received = 0
+        self.peers_dropped = 0
+        self.promotions = 0
+        self.flush_requests = 0
+        self.flush_timeouts = 0
+        self.resyncs = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.EVENT_BUS_ENABLED and fcntl is not None and hasattr(asyncio, "start_unix_server")
+
+    @property
+    def ingesting(self) -> bool:
+        """本进程是否负责 MQTT 接收与写库"""
+        return self.role != ROLE_FOLLOWER
+
+    # ========== 启动与选主 ==========
+
+    async def start(self, start_ingestion: Callable[[], Awaitable[None]],
+                    on_mqtt: Callable[[str, dict], Awaitable[None]]):
+        """
+        启动总线
+
+        start_ingestion: 成为 leader（或单进程模式）时调用，连接 MQTT 并启动写库
+        on_mqtt: follower 收到 leader 转发的车辆消息时调用
+        """
+        self._loop = asyncio.get_running_loop()
+        self._start_ingestion = start_ingestion
+        self._on_mqtt = on_mqtt
+
+        if not self.enabled:
+            if settings.EVENT_BUS_ENABLED:
+                logger.warning("当前平台不支持 flock/Unix 套接字，事件总线以单进程模式运行")
+            self.role = ROLE_STANDALONE
+            await start_ingestion()
+            return
+
+        if self._try_lock():
+            await self._become_leader()
+        else:
+            self.role = ROLE_FOLLOWER
+            mqtt_client.set_publish_forwarder(self.publish_mqtt)
+            self._task = asyncio.create_task(self._follow())
+            logger.info(f"事件总线: 进程 {os.getpid()} 作为 follower 运行")
+
+    def _try_lock(self) -> bool:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _become_leader(self):
+        self.role = ROLE_LEADER
+        mqtt_client.set_publish_forwarder(None)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # 上一个 leader 遗留的套接字文件
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.socket_path)
+
+        await self._start_ingestion()
+        for topic in ("bike/+/heartbeat", "bike/+/gps", "bike/+/auth"):
+            mqtt_client.subscribe(topic, self.broadcast_mqtt)
+        logger.info(f"事件总线: 进程 {os.getpid()} 成为 leader，监听 {self.socket_path}")
+
+    # ========== leader ==========
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        logger.info(f"事件总线: follower 已连接，当前 {len(self._peers)} 个")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                self.events_received += 1
+                if message.get("op") == "publish":
+                    mqtt_client.publish(message["topic"], message["message"], message.get("qos", 1))
+                elif message.get("op") == "flush_trajectory":
+                    asyncio.create_task(self._flush_for_peer(writer, message["request_id"]))
+                else:
+                    self._apply(message)
+                    self._send_to_peers(line, exclude=writer)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"事件总线: follower 连接异常: {e}")
+        finally:
+            self._drop_peer(writer)
+
+    async def _flush_for_peer(self, writer: asyncio.StreamWriter, request_id: int):
+        """写入缓冲中的轨迹点后回复请求的 follower"""
+        try:
+            await self._loop.run_in_executor(None, trajectory_writer.flush)
+        except Exception as e:
+            logger.error(f"事件总线: 写入轨迹失败: {e}")
+        if writer in self._peers:
+            writer.write(_encode({"op": "flush_trajectory_done", "request_id": request_id}))
+            self.events_sent += 1
+
+    async def broadcast_mqtt(self, topic: str, data: dict):
+        """MQTT 回调：把车辆消息转发给所有 follower"""
+        if self._peers:
+            self._send_to_peers(_encode({"op": "mqtt", "topic": topic, "data": data}))
+
+    def _send_to_peers(self, line: bytes, exclude: asyncio.StreamWriter = None):
+        for writer in list(self._peers):
+            if writer is exclude:
+                continue
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                # follower 跟不上：断开，由它重连（期间的遥测由后续心跳补齐）
+                logger.warning("事件总线: follower 处理过慢，断开连接")
+                self.peers_dropped += 1
+                self._drop_peer(writer)
+                continue
+            writer.write(line)
+            self.events_sent += 1
+
+    def _drop_peer(self, writer: asyncio.StreamWriter):
+        if writer in self._peers:
+            self._peers.discard(writer)
+            writer.close()
+            logger.info(f"事件总线: follower 已断开，当前 {len(self._peers)} 个")
+
+    # ========== follower ==========
+
+    async def _follow(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except OSError:
+                reader = writer = None
+
+            if writer is not None:
+                self._upstream = writer
+                logger.info("事件总线: 已连接 leader")
+                await self._resync()
+                try:
+                    while True:
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        self.events_received += 1
+                        await self._handle_downstream(json.loads(line))
+                except (ConnectionError, ValueError) as e:
+                    logger.warning(f"事件总线: 与 leader 的连接异常: {e}")
+                finally:
+                    self._upstream = None
+                    writer.close()
+                    for waiter in list(self._flush_waiters.values()):
+                        if not waiter.done():
+                            waiter.set_result(False)
+                logger.warning("事件总线: 与 leader 的连接断开")
+
+            # leader 不在了就尝试接替
+            if self._try_lock():
+                self.promotions += 1
+                await self._become_leader()
+                await self._resync()
+                return
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _handle_downstream(self, message: Dict[str, Any]):
+        if message.get("op") == "flush_trajectory_done":
+            waiter = self._flush_waiters.pop(message["request_id"], None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(True)
+        elif message.get("op") == "mqtt":
+            try:
+                await self._on_mqtt(message["topic"], message["data"])
+            except Exception as e:
+                logger.error(f"事件总线: 处理车辆消息失败: {e}")
+        else:
+            self._apply(message)
+
+    def publish_mqtt(self, topic: str, message: Dict[str, Any], qos: int = 1):
+        """follower 的 MQTT 发布：交给 leader 执行（线程安全）"""
+        self._call_soon(self._send_upstream, _encode(
+            {"op": "publish", "topic": topic, "message": message, "qos": qos}
+        ))
+
+    async def flush_trajectories(self, timeout: float = None) -> bool:
+        """
+        写入缓冲中的轨迹点（在事件循环中等待，不占用数据库线程池）
+
+        follower 的轨迹点缓冲在 leader 中，经总线请求 leader 写入并等待回复；
+        超时或未连接 leader 时返回 False，调用方按数据库中已有的轨迹计算
+        """
+        timeout = timeout or settings.EVENT_BUS_FLUSH_TIMEOUT
+        request_id = None
+        if self.ingesting:
+            loop = asyncio.get_running_loop()
+            waiter = loop.run_in_executor(None, trajectory_writer.flush)
+        elif self._upstream is None:
+            logger.warning("事件总线: 未连接 leader，按数据库中已有的轨迹计算")
+            return False
+        else:
+            request_id = next(self._flush_ids)
+            waiter = self._loop.create_future()
+            self._flush_waiters[request_id] = waiter
+            self.flush_requests += 1
+            self._send_upstream(_encode({"op": "flush_trajectory", "request_id": request_id}))
+        try:
+            # 与 leader 断开时等待的请求以 False 结束
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout) is not False
+        except asyncio.TimeoutError:
+            self.flush_timeouts += 1
+            logger.warning("事件总线: 写入轨迹超时，按数据库中已有的轨迹计算")
+            return False
+        finally:
+            if request_id is not None:
+                self._flush_waiters.pop(request_id, None)
+
+    def _send_upstream(self, line: bytes):
+        if self._upstream is None:
+            logger.warning("事件总线: 未连接 leader，丢弃消息")
+            return
+        self._upstream.write(line)
+        self.events_sent += 1
+
+    # ========== 重新同步 ==========
+
+    def on_resync(self, handler: Callable[[], None]):
+        """注册重新同步时的处理函数（在事件循环线程中调用，不应访问数据库）"""
+        self._resync_handlers.append(handler)
+
+    async def _resync(self):
+        """连接 leader 或接替为 leader 后，丢弃可能已过期的进程内状态"""
+        self.resyncs += 1
+        for handler in self._resync_handlers:
+            try:
+                handler()
+            except Exception as e:
+                logger.error(f"事件总线: 重新同步失败: {e}")
+        try:
+            count = await self._loop.run_in_executor(None, self._reload_active_orders)
+            logger.info(f"事件总线: 已重新同步，进行中订单 {count} 个")
+        except Exception as e:
+            logger.error(f"事件总线: 重新加载进行中订单失败: {e}")
+
+    @staticmethod
+    def _reload_active_orders() -> int:
+        db = SessionLocal()
+        try:
+            return active_orders.load(db)
+        finally:
+            db.close()
+
+    # ========== 状态变更（在所有 worker 上执行） ==========
+
+    def emit(self, kind: str, **payload):
+        """在本进程应用状态变更并同步给其他 worker（线程安全）"""
+        message = {"op": kind, **payload}
+        self._apply(message)
+        if self.role == ROLE_LEADER:
+            self._call_soon(self._send_to_peers, _encode(message))
+        elif self.role == ROLE_FOLLOWER:
+            self._call_soon(self._send_upstream, _encode(message))
+
+    def register(self, kind: str, handler: Callable[[Dict[str, Any]], None]):
+        """注册一种状态变更的处理函数（各 worker 收到该事件时执行，可能在任意线程调用）"""
+        self._handlers[kind] = handler
+
+    def _call_soon(self, func, *args):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _apply(self, message: Dict[str, Any]):
+        handler = self._handlers.get(message.get("op"))
+        if handler is None:
+            logger.warning(f"事件总线: 未知事件 {message.get('op')}")
+            return
+        handler(message)
+
+    @staticmethod
+    def _apply_bike(message: Dict[str, Any]):
+        fleet_state.apply(message["bike_id"], **message["fields"])
+
+    @staticmethod
+    def _apply_bike_upsert(message: Dict[str, Any]):
+        bike = dict(message["bike"])
+        for field in _DATETIME_FIELDS:
+            if isinstance(bike.get(field), str):
+                bike[field] = datetime.fromisoformat(bike[field])
+        fleet_state.upsert_bike(SimpleNamespace(**bike))
+
+    def _apply_ride_start(self, message: Dict[str, Any]):
+        active_orders.start(message["bike_id"], message["order_id"], message.get("user_id"))
+        if self.ingesting:
+            trajectory_writer.begin_ride(message["order_id"])
+
+    def _apply_ride_finish(self, message: Dict[str, Any]):
+        active_orders.finish(message["bike_id"], message["order_id"], message.get("user_id"))
+        if self.ingesting:
+            trajectory_writer.end_ride(message["order_id"])
+
+    # 供 API 调用的便捷方法
+
+    def apply_bike(self, bike_id: int, current_lat: float = None, current_lng: float = None,
+                   status: str = None):
+        """更新车辆位置/状态（开锁、还车等）"""
+        fields = {"current_lat": current_lat, "current_lng": current_lng, "status": status}
+        self.emit("bike", bike_id=bike_id, fields={k: v for k, v in fields.items() if v is not None})
+
+    def upsert_bike(self, bike):
+        """写入一辆车的完整状态（新增车辆、管理员修改状态）"""
+        self.emit("bike_upsert", bike={
+            "id": bike.id,
+            "bike_code": bike.bike_code,
+            "status": bike.status,
+            "current_lat": float(bike.current_lat) if bike.current_lat is not None else None,
+            "current_lng": float(bike.current_lng) if bike.current_lng is not None else None,
+            "battery": bike.battery,
+            "last_heartbeat": bike.last_heartbeat,
+            "created_at": bike.created_at,
+            "updated_at": bike.updated_at,
+        })
+
+    def start_ride(self, bike_id: int, order_id: int, user_id: int = None):
+        """骑行开始（订单已提交）"""
+        self.emit("ride_start", bike_id=bike_id, order_id=order_id, user_id=user_id)
+
+    def finish_ride(self, bike_id: int, order_id: int, user_id: int = None):
+        """骑行结束（订单已提交）"""
+        self.emit("ride_finish", bike_id=bike_id, order_id=order_id, user_id=user_id)
+
+    # ========== 关闭与统计 ==========
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._upstream is not None:
+            self._upstream.close()
+            self._upstream = None
+        for writer in list(self._peers):
+            self._drop_peer(writer)
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)  # 关闭即释放 flock
+            self._lock_fd = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "role": self.role,
+            "pid": os.getpid(),
+            "peers": len(self._peers),
+            "upstream_connected": self._upstream is not None,
+            "events_sent": self.events_sent,
+            "events_received": self.events_received,
+            "peers_dropped": self.peers_dropped,
+            "promotions": self.promotions,
+            "flush_requests": self.flush_requests,
+            "flush_timeouts": self.flush_timeouts,
+            "resyncs": self.resyncs,
+        }
+
+
+# 全局事件总线
+event_bus = EventBus()
@@ -0,0 +1,334 @@
+"""
+车队状态存储 - 进程内的权威车辆实时状态
+
+由心跳/GPS 消息处理和 main.py 中的订单状态变更维护，
+启动时从 MySQL 预热。车辆列表、详情和仪表盘车辆统计直接从这里读取，
+不再每次轮询都查询数据库。
+
+数据按列存放在 array 中（每辆车一个槽位），内存占用紧凑。
+车辆位置同时维护在网格空间索引（附近车辆查询）和
+瓦片聚合索引（地图视野聚合）中，均随位置/状态变化增量更新。
+在线标记由心跳超时检测（heartbeat_monitor）维护。
+"""
+import math
+import threading
+import logging
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import Bike, BikeStatus
+from spatial_index import GridSpatialIndex, TileClusterIndex
+
+logger = logging.getLogger(__name__)
+
+_NAN = float("nan")
+
+
+def _to_epoch(value: Optional[datetime]) -> float:
+    return value.timestamp() if value else 0.0
+
+
+def _from_epoch(value: float) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value else None
+
+
+class FleetStateStore:
+    """车队状态存储（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False  # 预热完成前由数据库提供数据
+
+        # 状态名 <-> 状态码
+        self._status_names: List[str] = [s.value for s in BikeStatus]
+        self._status_codes: Dict[str, int] = {name: i for i, name in enumerate(self._status_names)}
+        self._status_counts: List[int] = [0] * len(self._status_names)
+
+        # bike_id -> 槽位，bike_code -> bike_id
+        self._slots: Dict[int, int] = {}
+        self._by_code: Dict[str, int] = {}
+
+        # 按列存放的车辆数据
+        self._ids = array("q")
+        self._codes: List[str] = []
+        self._status = array("b")
+        self._lat = array("d")  # 无位置时为 NaN
+        self._lng = array("d")
+        self._battery = array("h")
+        self._heartbeat = array("d")  # Unix 时间戳，0 表示无
+        self._created = array("d")
+        self._updated = array("d")
+        self._version = array("Q")  # 每次变更递增
+        self._online = array("b")  # 1 表示在线（由心跳超时检测维护）
+        self._online_count = 0
+
+        # 空间索引（key 为槽位）与瓦片聚合
+        self._index = GridSpatialIndex(settings.SPATIAL_CELL_DEG)
+        self._clusters = TileClusterIndex(settings.CLUSTER_MIN_ZOOM, settings.CLUSTER_MAX_ZOOM)
+
+    # ========== 加载 ==========
+
+    def warm(self, db: Session) -> int:
+        """从数据库加载全部车辆"""
+        rows = db.query(Bike).order_by(Bike.id).all()
+        with self._lock:
+            for bike in rows:
+                self._upsert_locked(bike)
+            self.ready = True
+        logger.info(f"车队状态已预热: {len(rows)} 辆车")
+        return len(rows)
+
+    def upsert_bike(self, bike: Bike):
+        """写入（或覆盖）一辆车的完整状态"""
+        with self._lock:
+            self._upsert_locked(bike)
+
+    def _upsert_locked(self, bike: Bike):
+        slot = self._slots.get(bike.id)
+        old = self._cluster_key(slot) if slot is not None else None
+        if slot is None:
+            slot = len(self._ids)
+            self._slots[bike.id] = slot
+            self._ids.append(bike.id)
+            self._codes.append(bike.bike_code)
+            self._by_code[bike.bike_code] = bike.id
+            self._status.append(self._status_code(bike.status or BikeStatus.IDLE.value))
+            self._status_counts[self._status[slot]] += 1
+            for column in (self._lat, self._lng, self._heartbeat, self._created, self._updated):
+                column.append(0.0)
+            self._battery.append(0)
+            self._version.append(0)
+            self._online.append(0)
+        else:
+            if self._codes[slot] != bike.bike_code:
+                self._by_code.pop(self._codes[slot], None)
+                self._by_code[bike.bike_code] = bike.id
+            self._codes[slot] = bike.bike_code
+            self._set_status(slot, bike.status or BikeStatus.IDLE.value)
+
+        if bike.current_lat is not None and bike.current_lng is not None:
+            self._set_position(slot, float(bike.current_lat), float(bike.current_lng))
+        else:
+            self._lat[slot] = self._lng[slot] = _NAN
+            self._index.remove(slot)
+        self._battery[slot] = bike.battery if bike.battery is not None else 100
+        self._heartbeat[slot] = _to_epoch(bike.last_heartbeat)
+        self._created[slot] = _to_epoch(bike.created_at)
+        self._updated[slot] = _to_epoch(bike.updated_at)
+        self._version[slot] += 1
+        self._sync_clusters(slot, old)
+
+    def _status_code(self, name: str) -> int:
+        code = self._status_codes.get(name)
+        if code is None:
+            # 出现未知状态时动态分配状态码
+            code = len(self._status_names)
+            self._status_names.append(name)
+            self._status_codes[name] = code
+            self._status_counts.append(0)
+        return code
+
+    def _set_status(self, slot: int, name: str):
+        code = self._status_code(name)
+        old = self._status[slot]
+        if old != code:
+            self._status_counts[old] -= 1
+            self._status_counts[code] += 1
+            self._status[slot] = code
+
+    # ========== 更新 ==========
+
+    def apply(self, bike_id: int, current_lat: float = None, current_lng: float = None,
+              battery: int = None, status: str = None, last_heartbeat: datetime = None) -> bool:
+        """更新一辆车的部分字段（None 表示不变），车辆不存在时返回 False"""
+        with self._lock:
+            slot = self._slots.get(bike_id)
+            if slot is None:
+                return False
+            old = self._cluster_key(slot)
+            if current_lat is not None and current_lng is not None:
+                self._set_position(slot, float(current_lat), float(current_lng))
+            if battery is not None:
+                self._battery[slot] = int(battery)
+            if status is not None:
+                self._set_status(slot, status)
+            if last_heartbeat is not None:
+                self._heartbeat[slot] = last_heartbeat.timestamp()
+            self._updated[slot] = datetime.now().timestamp()
+            self._version[slot] += 1
+            self._sync_clusters(slot, old)
+            return True
+
+    def set_online(self, bike_id: int, online: bool) -> bool:
+        """设置车辆在线标记，车辆不存在或标记未变化时返回 False"""
+        with self._lock:
+            slot = self._slots.get(bike_id)
+            if slot is None or self._online[slot] == online:
+                return False
+            self._online[slot] = 1 if online else 0
+            self._online_count += 1 if online else -1
+            self._version[slot] += 1
+            return True
+
+    def _set_position(self, slot: int, lat: float, lng: float):
+        self._lat[slot] = lat
+        self._lng[slot] = lng
+        self._index.update(slot, lat, lng)
+
+    def _cluster_key(self, slot: int) -> Optional[Tuple[float, float, int]]:
+        """参与聚合的 (纬度, 经度, 状态码)，无位置时为 None"""
+        lat = self._lat[slot]
+        if math.isnan(lat):
+            return None
+        return lat, self._lng[slot], self._status[slot]
+
+    def _sync_clusters(self, slot: int, old: Optional[Tuple[float, float, int]]):
+        new = self._cluster_key(slot)
+        if old == new:
+            return
+        if old is not None and new is not None:
+            self._clusters.move(*old, *new)
+        elif old is not None:
+            self._clusters.remove(*old)
+        else:
+            self._clusters.add(*new)
+
+    # ========== 查询 ==========
+
+    def contains(self, bike_id: int) -> bool:
+        return bike_id in self._slots
+
+    def id_for_code(self, bike_code: str) -> Optional[int]:
+        """按车辆编号查找 bike_id"""
+        return self._by_code.get(bike_code)
+
+    def status_of(self, bike_id: int) -> Optional[str]:
+        """车辆当前状态，车辆不存在时为 None"""
+        slot = self._slots.get(bike_id)
+        return self._status_names[self._status[slot]] if slot is not None else None
+
+    def position(self, bike_id: int) -> Optional[Tuple[float, float]]:
+        """车辆当前位置 (纬度, 经度)，未知时为 None"""
+        slot = self._slots.get(bike_id)
+        if slot is None:
+            return None
+        lat = self._lat[slot]
+        return None if math.isnan(lat) else (lat, self._lng[slot])
+
+    def get(self, bike_id: int) -> Optional[Dict[str, Any]]:
+        """获取单辆车的状态（字段与 BikeResponse 一致）"""
+        with self._lock:
+            slot = self._slots.get(bike_id)
+            return self._row(slot) if slot is not None else None
+
+    def list_bikes(self, status: str = None, skip: int = 0, limit: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+        """分页获取车辆列表，返回 (总数, 当前页)"""
+        with self._lock:
+            if status is None:
+                total = len(self._ids)
+                slots = range(skip, min(total, skip + limit))
+            else:
+                code = self._status_codes.get(status)
+                if code is None:
+                    return 0, []
+                matched = [slot for slot, value in enumerate(self._status) if value == code]
+                total = len(matched)
+                slots = matched[skip:skip + limit]
+            return total, [self._row(slot) for slot in slots]
+
+    def nearby(self, lat: float, lng: float, radius_m: float, k: int,
+               status: str = None) -> List[Dict[str, Any]]:
+        """查找半径内最近的 k 辆车（可按状态过滤），结果附带 distance_m"""
+        with self._lock:
+            predicate = None
+            if status is not None:
+                code = self._status_codes.get(status)
+                if code is None:
+                    return []
+                status_column = self._status
+                predicate = lambda slot: status_column[slot] == code
+
+            result = []
+            for dist, slot in self._index.nearest(lat, lng, k, radius_m, predicate):
+                row = self._row(slot)
+                row["distance_m"] = round(dist, 1)
+                result.append(row)
+            return result
+
+    def viewport(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                 zoom: int) -> Dict[str, Any]:
+        """
+        地图视野查询
+
+        视野内车辆不多（或已放大到 VIEWPORT_BIKES_MIN_ZOOM）时返回单车，
+        否则返回按瓦片预聚合的簇（数量、质心、各状态数量）
+        """
+        with self._lock:
+            level = min(zoom + settings.CLUSTER_ZOOM_OFFSET, settings.CLUSTER_MAX_ZOOM)
+            tiles = self._clusters.clusters(level, min_lat, min_lng, max_lat, max_lng)
+            total = sum(agg[0] for _, agg in tiles)
+
+            if total <= settings.VIEWPORT_MAX_BIKES or zoom >= settings.VIEWPORT_BIKES_MIN_ZOOM:
+                slots = self._index.within_bbox(min_lat, min_lng, max_lat, max_lng)
+                if len(slots) <= settings.VIEWPORT_MAX_BIKES:
+                    return {
+                        "mode": "bikes",
+                        "zoom": zoom,
+                        "total": len(slots),
+                        "clusters": [],
+                        "bikes": [self._row(slot) for slot in slots],
+                    }
+
+            clusters = []
+            for (x, y), (count, sum_lat, sum_lng, counts) in tiles:
+                clusters.append({
+                    "id": f"{level}/{x}/{y}",
+                    "lat": sum_lat / count,
+                    "lng": sum_lng / count,
+                    "count": count,
+                    "status_counts": {
+                        self._status_names[code]: n for code, n in enumerate(counts) if n
+                    },
+                })
+            return {"mode": "clusters", "zoom": zoom, "total": total, "clusters": clusters, "bikes": []}
+
+    def status_counts(self) -> Dict[str, int]:
+        """各状态车辆数"""
+        with self._lock:
+            return dict(zip(self._status_names, self._status_counts))
+
+    def total(self) -> int:
+        return len(self._ids)
+
+    def online_count(self) -> int:
+        return self._online_count
+
+    def heartbeats(self) -> List[Tuple[int, float]]:
+        """全部车辆的 (bike_id, 最后心跳 Unix 时间戳)，0 表示从未上报（启动时初始化心跳超时检测）"""
+        with self._lock:
+            return list(zip(self._ids, self._heartbeat))
+
+    def _row(self, slot: int) -> Dict[str, Any]:
+        lat = self._lat[slot]
+        lng = self._lng[slot]
+        return {
+            "id": self._ids[slot],
+            "bike_code": self._codes[slot],
+            "status": self._status_names[self._status[slot]],
+            "current_lat": None if math.isnan(lat) else lat,
+            "current_lng": None if math.isnan(lng) else lng,
+            "battery": self._battery[slot],
+            "last_heartbeat": _from_epoch(self._heartbeat[slot]),
+            "created_at": _from_epoch(self._created[slot]),
+            "updated_at": _from_epoch(self._updated[slot]),
+            "version": self._version[slot],
+            "online": bool(self._online[slot]),
+        }
+
+
+# 全局车队状态存储
+fleet_state = FleetStateStore()
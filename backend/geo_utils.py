@@ -0,0 +1,22 @@
+"""
+地理计算工具
+"""
+import math
+
+EARTH_RADIUS_M = 6371008.8  # 地球平均半径（米）
+METERS_PER_DEG_LAT = 111320.0  # 每度纬度对应的米数（近似）
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """两点之间的球面距离（米）"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def meters_per_deg_lng(lat: float) -> float:
+    """指定纬度处每度经度对应的米数"""
+    return METERS_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6)
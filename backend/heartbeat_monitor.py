@@ -0,0 +1,188 @@
+"""
+心跳超时检测 - 用时间轮判定车辆离线/重新上线，不扫描全表
+
+每辆在线车辆记录一个超时时刻（最后一次心跳/GPS + HEARTBEAT_TIMEOUT_SECONDS），
+并在时间轮中恰好占一个位置（按超时时刻所在的格）：
+- 收到心跳/GPS 只更新超时时刻（字典写入，O(1)），不移动时间轮中的位置
+- 时间轮每 HEARTBEAT_CHECK_INTERVAL 秒转一格，只处理到期这一格中的车辆：
+  超时时刻已过的判定为离线，期间续期过的按新的超时时刻放回对应的格
+- 离线车辆不在时间轮中，再次上报时判定为重新上线并放回时间轮
+
+每辆在线车辆每个超时周期最多被重新放置一次，更新的均摊开销为 O(1)，
+每格的处理量约为 在线车辆数 / (超时时长 / 格长)，10 万辆车时每格约 3 千辆。
+"""
+import math
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import settings
+from fleet_state import fleet_state
+
+logger = logging.getLogger(__name__)
+
+# 在线状态变化的回调: (bike_id, 是否在线, 最后上报的 Unix 时间戳)
+Listener = Callable[[int, bool, float], None]
+
+
+class HeartbeatMonitor:
+    """心跳超时检测（线程安全：touch 由 MQTT 接收线程调用，时间轮在事件循环中转动）"""
+
+    def __init__(self, timeout: float = None, tick: float = None):
+        self.timeout = timeout or settings.HEARTBEAT_TIMEOUT_SECONDS
+        self.tick = tick or settings.HEARTBEAT_CHECK_INTERVAL
+        # 格数覆盖一个完整的超时周期，新放入的车辆不会落到当前格之前
+        self._size = int(math.ceil(self.timeout / self.tick)) + 2
+        self._wheel: List[List[int]] = [[] for _ in range(self._size)]
+        self._deadline: Dict[int, float] = {}  # 在线车辆 -> 超时时刻（与时间轮中的车辆一一对应）
+        self._cursor: Optional[int] = None  # 下一个待处理的格序号（时间 / 格长）
+        self._lock = threading.Lock()
+        self._listener: Optional[Listener] = None
+        self._task: Optional[asyncio.Task] = None
+
+        # 统计指标
+        self.touches = 0
+        self.went_offline = 0
+        self.came_online = 0
+        self.rearmed = 0  # 到期时已续期、重新放回时间轮的次数
+        self.ticks = 0
+        self.last_tick_ms = 0.0
+        self.max_tick_ms = 0.0
+
+    def _tick_of(self, ts: float) -> int:
+        return int(ts // self.tick)
+
+    def _insert(self, bike_id: int, deadline: float):
+        """放入超时时刻所在的格（须持有锁）"""
+        index = self._tick_of(deadline)
+        if self._cursor is not None and index < self._cursor:
+            index = self._cursor
+        self._wheel[index % self._size].append(bike_id)
+
+    # ========== 初始化 ==========
+
+    def load(self, heartbeats: Iterable[Tuple[int, float]], now: float = None) -> int:
+        """按最后心跳时间初始化（启动时调用一次）：仍在超时时间内的车辆标记为在线，不触发回调"""
+        now = now if now is not None else time.time()
+        loaded = 0
+        with self._lock:
+            if self._cursor is None:
+                self._cursor = self._tick_of(now)
+            for bike_id, last_seen in heartbeats:
+                deadline = last_seen + self.timeout
+                if last_seen and deadline > now and bike_id not in self._deadline:
+                    self._deadline[bike_id] = deadline
+                    self._insert(bike_id, deadline)
+                    fleet_state.set_online(bike_id, True)
+                    loaded += 1
+        logger.info(f"心跳超时检测已初始化: {loaded} 辆车在线，超时 {self.timeout:.0f} 秒")
+        return loaded
+
+    # ========== 更新 ==========
+
+    def touch(self, bike_id: int, now: float = None):
+        """收到车辆的心跳/GPS：续期，离线车辆判定为重新上线"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            self.touches += 1
+            was_online = bike_id in self._deadline
+            self._deadline[bike_id] = now + self.timeout
+            if was_online:
+                return
+            self._insert(bike_id, now + self.timeout)
+            self.came_online += 1
+            self._changed(bike_id, True, now)
+
+    def advance(self, now: float = None) -> int:
+        """把时间轮转到 now，处理所有已到期的格，返回判定离线的车辆数"""
+        now = now if now is not None else time.time()
+        start = time.perf_counter()
+        expired = 0
+        with self._lock:
+            current = self._tick_of(now)
+            if self._cursor is None:
+                self._cursor = current
+            while self._cursor < current:
+                slot = self._cursor % self._size
+                bucket, self._wheel[slot] = self._wheel[slot], []
+                self._cursor += 1
+                for bike_id in bucket:
+                    deadline = self._deadline.get(bike_id)
+                    if deadline is None:
+                        continue
+                    if deadline <= now:
+                        del self._deadline[bike_id]
+                        self._changed(bike_id, False, deadline - self.timeout)
+                        expired += 1
+                    else:
+                        self._insert(bike_id, deadline)
+                        self.rearmed += 1
+            self.went_offline += expired
+            self.ticks += 1
+
+        elapsed = (time.perf_counter() - start) * 1000
+        self.last_tick_ms = elapsed
+        self.max_tick_ms = max(self.max_tick_ms, elapsed)
+        if expired:
+            logger.info(f"心跳超时: {expired} 辆车离线")
+        return expired
+
+    def _changed(self, bike_id: int, online: bool, last_seen: float):
+        """
+        更新车队状态中的在线标记并通知回调（须持有锁）
+
+        在锁内执行，保证并发的续期与到期按同一顺序反映到车队状态和推送中；
+        回调只做入队等轻量操作
+        """
+        if not fleet_state.set_online(bike_id, online):
+            return
+        if self._listener is not None:
+            try:
+                self._listener(bike_id, online, last_seen)
+            except Exception as e:
+                logger.error(f"处理车辆在线状态变化失败: bike_id={bike_id}, {e}")
+
+    def is_online(self, bike_id: int) -> bool:
+        return bike_id in self._deadline
+
+    # ========== 启动与统计 ==========
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self.advance()
+            except Exception as e:
+                logger.error(f"心跳超时检测失败: {e}")
+
+    def start(self, listener: Listener = None):
+        """启动时间轮（须在事件循环中调用），listener 在车辆离线/重新上线时调用"""
+        self._listener = listener
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "timeout_seconds": self.timeout,
+            "tick_seconds": self.tick,
+            "wheel_slots": self._size,
+            "online": len(self._deadline),
+            "touches": self.touches,
+            "went_offline": self.went_offline,
+            "came_online": self.came_online,
+            "rearmed": self.rearmed,
+            "ticks": self.ticks,
+            "last_tick_ms": round(self.last_tick_ms, 3),
+            "max_tick_ms": round(self.max_tick_ms, 3),
+        }
+
+
+# 全局心跳超时检测
+heartbeat_monitor = HeartbeatMonitor()
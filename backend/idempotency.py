@@ -0,0 +1,114 @@
+"""
+幂等键 - 开锁/还车请求的结果缓存
+
+硬件在 Wi-Fi 不稳定时会重发 HTTP 请求。请求带上幂等键（请求头 Idempotency-Key
+或请求体 idempotency_key）后：
+- 首次请求正常执行，结果（含 4xx 错误）按幂等键保存 IDEMPOTENCY_TTL_SECONDS 秒
+- 之后带相同幂等键的重试直接返回保存的结果，不再访问数据库
+- 首次请求尚未完成时到达的重试等待同一个执行结果，不会重复开锁或扣费
+- 5xx 与未预期的异常不保存，重试会重新执行
+
+幂等键按接口和卡号区分，不同卡使用相同的键互不影响。缓存按 LRU 淘汰，
+仅在事件循环中使用，无需加锁；多 worker 部署时每个 worker 各自缓存。
+"""
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException
+
+from config import settings
+
+T = TypeVar("T")
+
+# 保存的结果: (过期时间, 是否为错误, 响应或 HTTPException)
+_Entry = Tuple[float, bool, Any]
+
+
+class IdempotencyCache:
+    """幂等键结果缓存：TTL + LRU"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0  # 首次请求执行中到达的重试
+        self.evictions = 0
+        self.expired = 0
+
+    async def run(self, scope: str, key: Optional[str], call: Callable[[], Awaitable[T]]) -> T:
+        """按幂等键执行 call()：命中时返回保存的结果，没有幂等键时直接执行"""
+        if not key:
+            return await call()
+
+        cache_key = (scope, key)
+        entry = self._items.get(cache_key)
+        if entry is not None:
+            expires, is_error, outcome = entry
+            if expires > time.monotonic():
+                self._items.move_to_end(cache_key)
+                self.hits += 1
+                if is_error:
+                    raise outcome
+                return outcome
+            del self._items[cache_key]
+            self.expired += 1
+
+        task = self._pending.get(cache_key)
+        if task is not None:
+            self.joined += 1
+        else:
+            self.misses += 1
+            # 独立任务执行：首次请求被取消时，等待中的重试仍能拿到结果
+            task = asyncio.ensure_future(call())
+            self._pending[cache_key] = task
+            task.add_done_callback(lambda done: self._settle(cache_key, done))
+        return await asyncio.shield(task)
+
+    def _settle(self, cache_key: Tuple[str, str], task: asyncio.Future):
+        self._pending.pop(cache_key, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            self._store(cache_key, False, task.result())
+        elif isinstance(error, HTTPException) and error.status_code < 500:
+            self._store(cache_key, True, error)
+
+    def _store(self, cache_key: Tuple[str, str], is_error: bool, outcome: Any):
+        now = time.monotonic()
+        self._items[cache_key] = (now + self.ttl, is_error, outcome)
+        self._items.move_to_end(cache_key)
+        # 顺带清理最久未使用一端已过期的结果
+        while self._items:
+            oldest = next(iter(self._items.values()))
+            if oldest[0] > now:
+                break
+            self._items.popitem(last=False)
+            self.expired += 1
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.joined
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "in_flight": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "joined": self.joined,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "hit_ratio": round((self.hits + self.joined) / lookups, 3) if lookups else None,
+        }
+
+
+# 全局幂等键缓存
+idempotency_cache = IdempotencyCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_TTL_SECONDS)
@@ -0,0 +1,197 @@
+"""
+MQTT 接收队列 - 在 paho 网络线程与数据库处理之间解耦
+
+网络线程只负责解码并入队，回调由工作线程池执行。
+队列按车辆编号哈希分区，每个分区由一个工作线程按顺序消费，
+因此同一辆车的消息保持有序。
+
+队列满时的处理策略：
+- drop_oldest: 丢弃分区中最旧的可丢弃消息（心跳/GPS 等遥测数据）
+- block: 阻塞网络线程等待空位，超时后再按 drop_oldest 处理（认证消息）
+
+asyncio 传输方式下 submit 运行在事件循环中，不能等待：调用方传入 timeout=0，
+分区已满且没有可丢弃的消息时，block 消息仍追加到同一分区末尾（同一辆车的消息保持有序），
+分区最多超出容量一倍；超出后丢弃并计入 dropped。
+"""
+import threading
+import time
+import logging
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_BLOCK = "block"
+
+
+def partition_key(topic: str) -> str:
+    """取主题第二层（车辆编号）作为分区键，例如 bike/001/gps -> 001"""
+    parts = topic.split("/", 2)
+    return parts[1] if len(parts) > 1 else topic
+
+
+class _IngestItem:
+    __slots__ = ("topic", "data", "callbacks", "droppable", "enqueued_at")
+
+    def __init__(self, topic: str, data: Any, callbacks: List[Callable], droppable: bool):
+        self.topic = topic
+        self.data = data
+        self.callbacks = callbacks
+        self.droppable = droppable
+        self.enqueued_at = time.perf_counter()
+
+
+class _Partition:
+    """单个分区：有界队列 + 一个工作线程"""
+
+    def __init__(self, index: int, capacity: int):
+        self.index = index
+        self.capacity = capacity
+        self.items: deque = deque()
+        self.cond = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+
+
+class IngestQueue:
+    """按车辆分区的有界接收队列与工作线程池"""
+
+    def __init__(self, workers: int, capacity: int, block_timeout: float = 5.0):
+        self.workers = max(1, workers)
+        self.block_timeout = block_timeout
+        per_partition = max(1, capacity // self.workers)
+        self._partitions = [_Partition(i, per_partition) for i in range(self.workers)]
+        self._running = False
+        self._metrics_lock = threading.Lock()
+
+        # 统计指标
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.overflowed = 0  # 不等待时超出分区容量入队的 block 消息数
+        self.callback_errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        """启动工作线程"""
+        if self._running:
+            return
+        self._running = True
+        for partition in self._partitions:
+            partition.thread = threading.Thread(
+                target=self._worker, args=(partition,),
+                name=f"mqtt-ingest-{partition.index}", daemon=True
+            )
+            partition.thread.start()
+        logger.info(f"MQTT 接收队列已启动: {self.workers} 个工作线程, 每分区容量 {self._partitions[0].capacity}")
+
+    def stop(self, timeout: float = 10.0):
+        """停止工作线程（先处理完队列中已有的消息）"""
+        if not self._running:
+            return
+        self._running = False
+        for partition in self._partitions:
+            with partition.cond:
+                partition.cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for partition in self._partitions:
+            if partition.thread:
+                partition.thread.join(max(0.0, deadline - time.monotonic()))
+                partition.thread = None
+        logger.info("MQTT 接收队列已停止")
+
+    def submit(self, key: str, topic: str, data: Any, callbacks: List[Callable],
+               policy: str = POLICY_DROP_OLDEST, timeout: Optional[float] = None) -> bool:
+        """
+        将消息放入对应分区，返回是否入队成功
+
+        timeout 为 block 策略的最长等待时间，None 表示 block_timeout，0 表示不等待
+        """
+        partition = self._partitions[hash(key) % self.workers]
+        item = _IngestItem(topic, data, callbacks, policy != POLICY_BLOCK)
+        if timeout is None:
+            timeout = self.block_timeout
+
+        with partition.cond:
+            if len(partition.items) >= partition.capacity and policy == POLICY_BLOCK and timeout > 0:
+                self._count("blocked")
+                partition.cond.wait_for(
+                    lambda: len(partition.items) < partition.capacity or not self._running,
+                    timeout=timeout,
+                )
+
+            if len(partition.items) >= partition.capacity and not self._evict_oldest(partition):
+                if policy == POLICY_BLOCK and timeout <= 0 and len(partition.items) < partition.capacity * 2:
+                    # 不能等待：超出容量追加，仍排在同一辆车之前的消息之后
+                    self._count("overflowed")
+                else:
+                    self._count("dropped")
+                    logger.warning(f"MQTT 接收队列已满，丢弃消息: {topic}")
+                    return False
+
+            partition.items.append(item)
+            partition.cond.notify_all()
+
+        self._count("enqueued")
+        return True
+
+    def _evict_oldest(self, partition: _Partition) -> bool:
+        """丢弃分区中最旧的可丢弃消息（调用方持有锁）"""
+        for i, queued in enumerate(partition.items):
+            if queued.droppable:
+                del partition.items[i]
+                self._count("dropped")
+                return True
+        return False
+
+    def _worker(self, partition: _Partition):
+        while True:
+            with partition.cond:
+                partition.cond.wait_for(lambda: partition.items or not self._running)
+                if not partition.items:
+                    return
+                item = partition.items.popleft()
+                partition.cond.notify_all()
+
+            wait = time.perf_counter() - item.enqueued_at
+            with self._metrics_lock:
+                self.processed += 1
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+
+            for callback in item.callbacks:
+                try:
+                    callback(item.topic, item.data)
+                except Exception as e:
+                    self._count("callback_errors")
+                    logger.error(f"回调函数执行失败 (topic={item.topic}): {e}")
+
+    def _count(self, name: str):
+        with self._metrics_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def depth(self) -> int:
+        """当前队列中的消息总数"""
+        return sum(len(p.items) for p in self._partitions)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取队列深度与等待时间统计"""
+        with self._metrics_lock:
+            processed = self.processed
+            return {
+                "workers": self.workers,
+                "depth": self.depth(),
+                "partition_depths": [len(p.items) for p in self._partitions],
+                "partition_capacity": self._partitions[0].capacity,
+                "enqueued": self.enqueued,
+                "processed": processed,
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+                "overflowed": self.overflowed,
+                "callback_errors": self.callback_errors,
+                "wait_avg_ms": round(self.wait_total / processed * 1000, 3) if processed else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
@@ -1,20 +1,23 @@
 from fastapi import (
     FastAPI,
-    Depends,
+    Header,
     HTTPException,
+    Query,
+    Request,
     status,
     WebSocket,
     WebSocketDisconnect,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func, desc
-from typing import List
+from typing import Any, Dict, List, Optional
 from datetime import datetime, timedelta
 from decimal import Decimal
 import asyncio
 
-from database import engine, get_db
+from database import engine, get_db, SessionLocal, configure_threadpool, db_route, get_db_metrics, run_db
 from models import (
     User,
     Bike,
@@ -37,6 +40,10 @@ from schemas import (
     BikeCreate,
     BikeResponse,
     BikeListResponse,
+    NearbyBikeResponse,
+    ViewportResponse,
+    TrajectoryPoint,
+    TrajectoryResponse,
     BikeUpdate,
     OrderUnlock,
     OrderLock,
@@ -51,13 +58,40 @@ from schemas import (
 )
 from mqtt_handler import mqtt_client
 from config import settings
+from geo_utils import haversine_m, meters_per_deg_lng, METERS_PER_DEG_LAT
 import logging
 
 # WebSocket 支持
-from websocket_server import websocket_manager, setup_mqtt_forwarding
+from websocket_server import (
+    websocket_manager, telemetry_coalescer, setup_mqtt_forwarding, forward_mqtt_message,
+    STREAM_SSE, STREAM_NDJSON,
+)
+from subscription_index import parse_subscription
 
 # MQTT消息处理
-from mqtt_message_handler import setup_mqtt_subscriptions
+from mqtt_message_handler import setup_mqtt_subscriptions, apply_fleet_update
+from bike_write_buffer import bike_write_buffer
+
+# 车队状态存储
+from fleet_state import fleet_state
+from active_orders import active_orders
+from trajectory_writer import trajectory_writer
+from event_bus import event_bus
+from domain_events import domain_events, dashboard_counters
+from heartbeat_monitor import heartbeat_monitor
+from order_service import UNLOCK_NOT_FOUND, UNLOCK_USER_RIDING, order_service
+from idempotency import idempotency_cache
+from user_cache import user_cache
+from trajectory_simplify import (
+    delta_encode,
+    encode_polyline,
+    flush_ride_points,
+    is_track_final,
+    load_track,
+    ride_distance_km,
+    select_points,
+    track_cache,
+)
 
 # 配置日志
 logging.basicConfig(
@@ -94,12 +128,40 @@ async def startup_event():
     try:
         loop = asyncio.get_running_loop()
         websocket_manager.set_event_loop(loop)
+        mqtt_client.set_event_loop(loop)
         logger.info(f"✓ 事件循环已设置: {loop}")
     except Exception as e:
         logger.error(f"✗ 设置事件循环失败: {e}")
         return
 
-    # 然后启动 MQTT 客户端
+    # 数据库线程池：访问数据库的路由在其中执行，并发上限与连接池匹配
+    configure_threadpool()
+
+    # 从数据库预热车队状态（须在处理 MQTT 消息之前）
+    db = SessionLocal()
+    try:
+        fleet_state.warm(db)
+        active_orders.load(db)
+        dashboard_counters.load(db)
+        heartbeat_monitor.load(fleet_state.heartbeats())
+        logger.info("✓ 车队状态、进行中订单和仪表盘计数已从数据库加载")
+    except Exception as e:
+        logger.warning(f"✗ 车队状态预热失败，车辆查询将直接访问数据库: {e}")
+    finally:
+        db.close()
+
+    # 心跳超时检测：车辆离线/重新上线时更新车队状态并推送给 WebSocket 客户端
+    heartbeat_monitor.start(domain_events.bike_connectivity_changed)
+
+    # 然后启动 MQTT 接收：多 worker 时只有事件总线 leader 连接 MQTT，其他 worker 由 leader 转发
+    await event_bus.start(start_ingestion, on_bus_message)
+    if not event_bus.ingesting:
+        setup_mqtt_forwarding(subscribe=False)
+        logger.info("✓ 作为事件总线 follower 运行，车辆消息由 leader 转发")
+
+
+async def start_ingestion():
+    """连接 MQTT 并启动消息处理（单进程模式或事件总线 leader）"""
     if mqtt_client.connect():
         logger.info("✓ MQTT 客户端启动成功")
 
@@ -107,18 +169,40 @@ async def startup_event():
         setup_mqtt_forwarding()
         logger.info("✓ WebSocket MQTT 转发已启用")
 
-        # 设置 MQTT 消息处理（更新数据库）
-        setup_mqtt_subscriptions(mqtt_client, get_db)
+        # 设置 MQTT 消息处理（更新数据库、写入轨迹）
+        if settings.DB_WRITE_BEHIND_ENABLED:
+            bike_write_buffer.start()
+        if settings.TRAJECTORY_ENABLED:
+            trajectory_writer.start()
+        setup_mqtt_subscriptions(
+            mqtt_client,
+            get_db,
+            bike_write_buffer if settings.DB_WRITE_BEHIND_ENABLED else None,
+            trajectory_writer if settings.TRAJECTORY_ENABLED else None,
+        )
         logger.info("✓ MQTT 消息处理已启用（心跳/GPS自动更新）")
     else:
         logger.warning("✗ MQTT 客户端启动失败")
 
 
+async def on_bus_message(topic: str, data: dict):
+    """follower 收到 leader 转发的车辆消息：更新本进程车队状态并推送给 WebSocket 客户端"""
+    apply_fleet_update(topic, data)
+    await forward_mqtt_message(topic, data)
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时执行"""
     logger.info("FastAPI 应用关闭中...")
     mqtt_client.disconnect()
+    telemetry_coalescer.stop()
+    heartbeat_monitor.stop()
+    await event_bus.stop()
+
+    # 停止接收后再写回缓冲中剩余的车辆状态和轨迹点
+    bike_write_buffer.stop()
+    trajectory_writer.stop()
 
 
 # ========== 基础路由 ==========
@@ -148,7 +232,8 @@ async def health_check():
 
 
 @app.post("/api/auth/register", response_model=UserResponse, tags=["用户认证"])
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+@db_route
+def register_user(db: Session, user: UserCreate):
     """注册新用户（不需要提供卡号）"""
     # 创建新用户（不绑定卡号）
     db_user = User(
@@ -159,6 +244,7 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    domain_events.user_registered(db_user)
 
     logger.info(f"新用户注册: ID={db_user.id}, 用户名={user.username}")
     return db_user
@@ -167,8 +253,9 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
 @app.post(
     "/api/auth/register-with-card", response_model=UserResponse, tags=["用户认证"]
 )
-async def register_user_with_card(
-    user: UserCreateWithCard, db: Session = Depends(get_db)
+@db_route
+def register_user_with_card(
+    db: Session, user: UserCreateWithCard
 ):
     """注册新用户并绑定卡号"""
     # 检查 RFID 卡是否已存在
@@ -188,13 +275,16 @@ async def register_user_with_card(
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    user_cache.update(db_user)
+    domain_events.user_registered(db_user)
 
     logger.info(f"新用户注册并绑定卡: {user.rfid_card}, 用户名={user.username}")
     return db_user
 
 
 @app.post("/api/auth/topup", response_model=UserResponse, tags=["用户认证"])
-async def topup_balance(topup: UserTopup, db: Session = Depends(get_db)):
+@db_route
+def topup_balance(db: Session, topup: UserTopup):
     """用户充值"""
     db_user = db.query(User).filter(User.id == topup.user_id).first()
     if not db_user:
@@ -204,20 +294,24 @@ async def topup_balance(topup: UserTopup, db: Session = Depends(get_db)):
     db_user.balance += Decimal(str(topup.amount))
     db.commit()
     db.refresh(db_user)
+    user_cache.update(db_user)
+    domain_events.balance_changed(db_user, topup.amount, "topup")
 
     logger.info(f"用户充值: 用户ID={topup.user_id}, 金额={topup.amount}")
     return db_user
 
 
 @app.get("/api/users", response_model=List[UserResponse], tags=["用户管理"])
-async def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+@db_route
+def get_users(db: Session, skip: int = 0, limit: int = 100):
     """获取用户列表"""
     users = db.query(User).offset(skip).limit(limit).all()
     return users
 
 
 @app.get("/api/users/{user_id}", response_model=UserResponse, tags=["用户管理"])
-async def get_user(user_id: int, db: Session = Depends(get_db)):
+@db_route
+def get_user(db: Session, user_id: int):
     """获取用户详情"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -226,8 +320,9 @@ async def get_user(user_id: int, db: Session = Depends(get_db)):
 
 
 @app.put("/api/users/{user_id}", response_model=UserResponse, tags=["用户管理"])
-async def update_user(
-    user_id: int, user_update: UserUpdate, db: Session = Depends(get_db)
+@db_route
+def update_user(
+    db: Session, user_id: int, user_update: UserUpdate
 ):
     """更新用户信息（不包括RFID卡号）"""
     # 检查用户是否存在
@@ -242,6 +337,7 @@ async def update_user(
 
     db.commit()
     db.refresh(user)
+    user_cache.update(user)
 
     logger.info(f"用户信息更新: ID={user_id}, 字段={list(update_data.keys())}")
     return user
@@ -250,8 +346,9 @@ async def update_user(
 @app.post(
     "/api/users/{user_id}/bind-card", response_model=UserResponse, tags=["用户管理"]
 )
-async def bind_card(
-    user_id: int, request: BindCardRequest, db: Session = Depends(get_db)
+@db_route
+def bind_card(
+    db: Session, user_id: int, request: BindCardRequest
 ):
     """为用户绑定 RFID 卡"""
     # 检查用户是否存在
@@ -277,13 +374,15 @@ async def bind_card(
     user.rfid_card = request.rfid_card
     db.commit()
     db.refresh(user)
+    user_cache.update(user)
 
     logger.info(f"用户绑定卡: 用户ID={user_id}, 卡号={request.rfid_card}")
     return user
 
 
 @app.post("/api/auth/auto-register", response_model=UserResponse, tags=["用户认证"])
-async def auto_register(request: AutoRegisterRequest, db: Session = Depends(get_db)):
+@db_route
+def auto_register(db: Session, request: AutoRegisterRequest):
     """硬件端自动注册（刷卡自动创建用户）"""
     # 检查卡是否已注册
     existing_user = db.query(User).filter(User.rfid_card == request.rfid_card).first()
@@ -300,6 +399,8 @@ async def auto_register(request: AutoRegisterRequest, db: Session = Depends(get_
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    user_cache.update(db_user)
+    domain_events.user_registered(db_user)
 
     logger.info(f"自动注册新用户: 卡号={request.rfid_card}, 用户名={db_user.username}")
     return db_user
@@ -309,10 +410,16 @@ async def auto_register(request: AutoRegisterRequest, db: Session = Depends(get_
 
 
 @app.get("/api/bikes", response_model=BikeListResponse, tags=["车辆管理"])
-async def get_bikes(
-    skip: int = 0, limit: int = 100, status: str = None, db: Session = Depends(get_db)
-):
+async def get_bikes(skip: int = 0, limit: int = 100, status: str = None):
     """获取车辆列表"""
+    if fleet_state.ready:
+        total, bikes = fleet_state.list_bikes(status, skip, limit)
+        return BikeListResponse(total=total, items=bikes)
+
+    return await run_db(_list_bikes_from_db, skip, limit, status)
+
+
+def _list_bikes_from_db(db: Session, skip: int, limit: int, status: Optional[str]) -> BikeListResponse:
     query = db.query(Bike)
     if status:
         query = query.filter(Bike.status == status)
@@ -323,20 +430,108 @@ async def get_bikes(
     return BikeListResponse(total=total, items=bikes)
 
 
+@app.get(
+    "/api/bikes/nearby", response_model=List[NearbyBikeResponse], tags=["车辆管理"]
+)
+async def get_nearby_bikes(
+    lat: float = Query(..., ge=-90, le=90, description="纬度"),
+    lng: float = Query(..., ge=-180, le=180, description="经度"),
+    radius: float = Query(1000, gt=0, le=settings.NEARBY_MAX_RADIUS, description="半径（米）"),
+    status: str = Query(BikeStatus.IDLE.value, description="车辆状态，默认只查空闲车辆"),
+    k: int = Query(10, ge=1, le=settings.NEARBY_MAX_K, description="最多返回数量"),
+):
+    """查询附近最近的车辆（按距离升序）"""
+    if fleet_state.ready:
+        return fleet_state.nearby(lat, lng, radius, k, status or None)
+
+    return await run_db(_nearby_bikes_from_db, lat, lng, radius, status, k)
+
+
+def _nearby_bikes_from_db(db: Session, lat: float, lng: float, radius: float,
+                          status: Optional[str], k: int) -> List[Dict[str, Any]]:
+    """车队状态不可用时，按外接矩形从数据库粗筛后计算距离"""
+    dlat = radius / METERS_PER_DEG_LAT
+    dlng = radius / meters_per_deg_lng(lat)
+    query = db.query(Bike).filter(
+        Bike.current_lat.between(lat - dlat, lat + dlat),
+        Bike.current_lng.between(lng - dlng, lng + dlng),
+    )
+    if status:
+        query = query.filter(Bike.status == status)
+
+    candidates = []
+    for bike in query.all():
+        distance = haversine_m(lat, lng, float(bike.current_lat), float(bike.current_lng))
+        if distance <= radius:
+            item = BikeResponse.model_validate(bike).model_dump()
+            item["distance_m"] = round(distance, 1)
+            candidates.append(item)
+    candidates.sort(key=lambda item: item["distance_m"])
+    return candidates[:k]
+
+
+@app.get("/api/bikes/viewport", response_model=ViewportResponse, tags=["车辆管理"])
+async def get_viewport_bikes(
+    bbox: str = Query(..., description="视野范围: min_lng,min_lat,max_lng,max_lat（WGS84）"),
+    zoom: int = Query(..., ge=0, le=22, description="地图缩放级别"),
+):
+    """地图视野查询：放大时返回单车，缩小时返回预聚合的簇"""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="bbox 格式错误，应为 min_lng,min_lat,max_lng,max_lat",
+        )
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="bbox 范围无效")
+
+    if fleet_state.ready:
+        return fleet_state.viewport(min_lat, min_lng, max_lat, max_lng, zoom)
+
+    return await run_db(_viewport_bikes_from_db, min_lat, min_lng, max_lat, max_lng, zoom)
+
+
+def _viewport_bikes_from_db(db: Session, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                            zoom: int) -> ViewportResponse:
+    """车队状态不可用时，直接查询视野内的车辆（数量受限）"""
+    bikes = (
+        db.query(Bike)
+        .filter(
+            Bike.current_lat.between(min_lat, max_lat),
+            Bike.current_lng.between(min_lng, max_lng),
+        )
+        .limit(settings.VIEWPORT_MAX_BIKES)
+        .all()
+    )
+    return ViewportResponse(mode="bikes", zoom=zoom, total=len(bikes), bikes=bikes)
+
+
 @app.get("/api/bikes/{bike_id}", response_model=BikeResponse, tags=["车辆管理"])
-async def get_bike(bike_id: int, db: Session = Depends(get_db)):
+async def get_bike(bike_id: int):
     """获取车辆详情"""
+    state = fleet_state.get(bike_id)
+    if state:
+        return state
+
+    return await run_db(_get_bike_from_db, bike_id)
+
+
+def _get_bike_from_db(db: Session, bike_id: int) -> Bike:
     bike = db.query(Bike).filter(Bike.id == bike_id).first()
     if not bike:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="车辆不存在")
+    if fleet_state.ready:
+        event_bus.upsert_bike(bike)
     return bike
 
 
 @app.patch(
     "/api/bikes/{bike_id}/status", response_model=BikeResponse, tags=["车辆管理"]
 )
-async def update_bike_status(
-    bike_id: int, bike_update: BikeUpdate, db: Session = Depends(get_db)
+@db_route
+def update_bike_status(
+    db: Session, bike_id: int, bike_update: BikeUpdate
 ):
     """更新车辆状态"""
     bike = db.query(Bike).filter(Bike.id == bike_id).first()
@@ -350,16 +545,33 @@ async def update_bike_status(
 
     db.commit()
     db.refresh(bike)
+    event_bus.upsert_bike(bike)
+    domain_events.bike_status_changed(bike)
 
     logger.info(f"车辆状态更新: {bike.bike_code}, 状态: {bike.status}")
     return bike
 
 
 @app.get("/api/bikes/{bike_id}/trajectory", tags=["车辆管理"])
-async def get_bike_trajectory(
-    bike_id: int, order_id: int = None, limit: int = 100, db: Session = Depends(get_db)
+@db_route
+def get_bike_trajectory(
+    db: Session,
+    bike_id: int,
+    order_id: int = None,
+    limit: int = 100,
+    tolerance: float = Query(None, gt=0, description="抽稀容差（米），Douglas-Peucker"),
+    max_points: int = Query(None, ge=2, description="抽稀后的目标点数"),
+    encoding: str = Query(None, pattern="^(json|polyline|delta)$", description="json / polyline / delta"),
 ):
-    """获取车辆轨迹"""
+    """
+    获取车辆轨迹
+
+    不带 tolerance / max_points / encoding 时返回最近 limit 条原始记录（时间倒序）；
+    带任一参数时返回按时间升序的抽稀轨迹（TrajectoryResponse），已完成订单的轨迹会被缓存
+    """
+    if tolerance is not None or max_points is not None or encoding is not None:
+        return simplified_trajectory(db, bike_id, order_id, tolerance, max_points, encoding or "json")
+
     query = db.query(BikeTrajectory).filter(BikeTrajectory.bike_id == bike_id)
     if order_id:
         query = query.filter(BikeTrajectory.order_id == order_id)
@@ -368,35 +580,88 @@ async def get_bike_trajectory(
     return trajectories
 
 
+def simplified_trajectory(
+    db: Session, bike_id: int, order_id: int, tolerance: float, max_points: int, encoding: str
+) -> TrajectoryResponse:
+    """读取（或从缓存获取）轨迹，抽稀后按指定格式编码"""
+    track = track_cache.get(order_id) if order_id else None
+    if track is None or track["bike_id"] != bike_id:
+        track = load_track(db, bike_id, order_id)
+        if order_id and is_track_final(db, order_id):
+            track_cache.put(order_id, track)
+
+    keep = select_points(track["importance"], tolerance, max_points)
+    lat = track["lat"][keep]
+    lng = track["lng"][keep]
+    times = track["time"][keep]
+    fields = {}
+    if encoding == "json":
+        fields["points"] = [
+            TrajectoryPoint(latitude=la, longitude=ln, recorded_at=datetime.fromtimestamp(t) if t else None)
+            for la, ln, t in zip(lat.tolist(), lng.tolist(), times.tolist())
+        ]
+    else:
+        if encoding == "polyline":
+            fields["polyline"] = encode_polyline(lat, lng)
+        else:
+            fields["precision"] = 1_000_000
+            fields["lat_deltas"] = delta_encode(lat, fields["precision"])
+            fields["lng_deltas"] = delta_encode(lng, fields["precision"])
+        if len(times):
+            fields["start_time"] = datetime.fromtimestamp(times[0])
+            fields["time_deltas"] = [0] + delta_encode(times)[1:]
+
+    return TrajectoryResponse(
+        bike_id=bike_id,
+        order_id=order_id,
+        encoding=encoding,
+        original_count=len(track["lat"]),
+        point_count=len(keep),
+        tolerance_m=tolerance,
+        **fields,
+    )
+
+
 # ========== 订单相关 API ==========
 
 
 @app.post("/api/hardware/unlock", tags=["硬件接口"])
 async def hardware_unlock(
-    request: HardwareUnlockRequest, db: Session = Depends(get_db)
+    request: HardwareUnlockRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=64),
 ):
-    """硬件端开锁接口（自动匹配车辆）"""
+    """硬件端开锁接口（自动匹配车辆；重试时携带相同的幂等键，返回首次请求的结果）"""
+    return await idempotency_cache.run(
+        f"hardware_unlock:{request.rfid_card}",
+        idempotency_key or request.idempotency_key,
+        lambda: run_db(_hardware_unlock, request),
+    )
+
+
+def _hardware_unlock(db: Session, request: HardwareUnlockRequest):
     # 1. 根据车辆编号查找车辆
-    bike = db.query(Bike).filter(Bike.bike_code == request.bike_code).first()
-    if not bike:
+    bike_id = order_service.resolve_bike_code(db, request.bike_code)
+    if bike_id is None:
         return {
             "success": False,
             "message": f"车辆 {request.bike_code} 不存在，请先在系统中注册车辆",
         }
 
     # 2. 查找用户（如果不存在则自动注册）
-    user = db.query(User).filter(User.rfid_card == request.rfid_card).first()
+    user = user_cache.get(db, request.rfid_card)
     if not user:
         # 自动注册新用户
-        user = User(
+        new_user = User(
             rfid_card=request.rfid_card,
             username=f"用户_{request.rfid_card[-4:]}",
             phone="",
             balance=Decimal("50.00"),
         )
-        db.add(user)
+        db.add(new_user)
         db.commit()
-        db.refresh(user)
+        db.refresh(new_user)
+        user = user_cache.update(new_user)
+        domain_events.user_registered(new_user)
         logger.info(f"自动注册新用户: RFID={request.rfid_card}, ID={user.id}")
 
     # 3. 检查用户状态
@@ -413,34 +678,30 @@ async def hardware_unlock(
             "message": f"余额不足，当前余额: {float(user.balance):.2f} 元，最低需要 {settings.MIN_BALANCE} 元",
         }
 
-    # 5. 检查车辆状态
-    if bike.status != BikeStatus.IDLE.value:
-        return {"success": False, "message": f"车辆正在使用中，当前状态: {bike.status}"}
+    # 5. 占用车辆（仅空闲时）并创建订单
+    result = order_service.unlock(db, user.id, bike_id, request.lat, request.lng)
+    if result.reason == UNLOCK_USER_RIDING:
+        return {"success": False, "message": "您有进行中的订单，请先还车"}
+    if result.reason == UNLOCK_NOT_FOUND:
+        return {
+            "success": False,
+            "message": f"车辆 {request.bike_code} 不存在，请先在系统中注册车辆",
+        }
+    if not result.success:
+        return {"success": False, "message": f"车辆正在使用中，当前状态: {result.bike_status}"}
 
-    # 6. 创建订单
-    order = Order(
-        user_id=user.id,
-        bike_id=bike.id,
-        start_time=datetime.now(),
-        start_lat=request.lat,
-        start_lng=request.lng,
-        status=OrderStatus.ACTIVE.value,
+    order = result.order
+    event_bus.apply_bike(
+        bike_id, current_lat=request.lat, current_lng=request.lng, status=BikeStatus.RIDING.value
     )
-    db.add(order)
+    event_bus.start_ride(bike_id, order.id, user.id)
+    domain_events.order_started(order, result.bike)
 
-    # 7. 更新车辆状态
-    bike.status = BikeStatus.RIDING.value
-    bike.current_lat = request.lat
-    bike.current_lng = request.lng
-
-    db.commit()
-    db.refresh(order)
-
-    # 7. 发送 MQTT 开锁指令
-    mqtt_client.publish_command(bike.id, "unlock", order.id, bike.bike_code)
+    # 6. 发送 MQTT 开锁指令
+    mqtt_client.publish_command(bike_id, "unlock", order.id, result.bike_code)
 
     logger.info(
-        f"硬件开锁成功: 用户={request.rfid_card}, 车辆={bike.bike_code}, 订单={order.id}"
+        f"硬件开锁成功: 用户={request.rfid_card}, 车辆={result.bike_code}, 订单={order.id}"
     )
 
     return {
@@ -453,10 +714,11 @@ async def hardware_unlock(
 
 
 @app.post("/api/orders/unlock", response_model=OrderResponse, tags=["订单管理"])
-async def unlock_bike(unlock: OrderUnlock, db: Session = Depends(get_db)):
+@db_route
+def unlock_bike(db: Session, unlock: OrderUnlock):
     """开锁（创建订单）"""
     # 查找用户
-    user = db.query(User).filter(User.rfid_card == unlock.rfid_card).first()
+    user = user_cache.get(db, unlock.rfid_card)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用户不存在")
 
@@ -474,62 +736,66 @@ async def unlock_bike(unlock: OrderUnlock, db: Session = Depends(get_db)):
             detail=f"余额不足，最低需要 {settings.MIN_BALANCE} 元",
         )
 
-    # 查找车辆
-    bike = db.query(Bike).filter(Bike.id == unlock.bike_id).first()
-    if not bike:
+    # 占用车辆（仅空闲时）并创建订单
+    result = order_service.unlock(db, user.id, unlock.bike_id, unlock.lat, unlock.lng)
+    if result.reason == UNLOCK_USER_RIDING:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="您有进行中的订单，请先还车")
+    if result.reason == UNLOCK_NOT_FOUND:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="车辆不存在")
-
-    # 检查车辆状态
-    if bike.status != BikeStatus.IDLE.value:
+    if not result.success:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"车辆状态不是空闲，当前状态: {bike.status}",
+            detail=f"车辆状态不是空闲，当前状态: {result.bike_status}",
         )
 
-    # 创建订单
-    order = Order(
-        user_id=user.id,
-        bike_id=bike.id,
-        start_time=datetime.now(),
-        start_lat=unlock.lat,
-        start_lng=unlock.lng,
-        status=OrderStatus.ACTIVE.value,
+    order = result.order
+    event_bus.apply_bike(
+        unlock.bike_id, current_lat=unlock.lat, current_lng=unlock.lng, status=BikeStatus.RIDING.value
     )
-    db.add(order)
-
-    # 更新车辆状态
-    bike.status = BikeStatus.RIDING.value
-    bike.current_lat = unlock.lat
-    bike.current_lng = unlock.lng
-
-    db.commit()
-    db.refresh(order)
+    event_bus.start_ride(unlock.bike_id, order.id, user.id)
+    domain_events.order_started(order, result.bike)
 
     # 发送 MQTT 开锁指令
-    mqtt_client.publish_command(bike.id, "unlock", order.id, bike.bike_code)
+    mqtt_client.publish_command(unlock.bike_id, "unlock", order.id, result.bike_code)
 
     logger.info(
-        f"开锁成功: 用户={unlock.rfid_card}, 车辆={bike.bike_code}, 订单={order.id}"
+        f"开锁成功: 用户={unlock.rfid_card}, 车辆={result.bike_code}, 订单={order.id}"
     )
     return order
 
 
 @app.post("/api/orders/lock", response_model=LockResponse, tags=["订单管理"])
-async def lock_bike(lock: OrderLock, db: Session = Depends(get_db)):
-    """还车（结束订单）"""
+async def lock_bike(
+    lock: OrderLock,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=64),
+):
+    """还车（结束订单；重试时携带相同的幂等键，返回首次请求的结果）"""
+    async def finish():
+        # 先写入缓冲中的轨迹点（不在数据库会话中等待），再在线程池中结算
+        await flush_ride_points(lock.order_id)
+        return await run_db(_lock_bike, lock)
+
+    return await idempotency_cache.run(
+        f"lock:{lock.rfid_card}",
+        idempotency_key or lock.idempotency_key,
+        finish,
+    )
+
+
+def _lock_bike(db: Session, lock: OrderLock) -> LockResponse:
     logger.info(
         f"收到还车请求: order_id={lock.order_id}, rfid_card={lock.rfid_card}, lat={lock.end_lat}, lng={lock.end_lng}"
     )
 
-    # 查找订单
-    order = db.query(Order).filter(Order.id == lock.order_id).first()
+    # 查找订单（同时读取下单用户，扣费以数据库中的余额为准）
+    order = db.query(Order).options(joinedload(Order.user)).filter(Order.id == lock.order_id).first()
     if not order:
         logger.error(f"订单不存在: order_id={lock.order_id}")
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="订单不存在")
 
     # 验证用户
-    user = db.query(User).filter(User.rfid_card == lock.rfid_card).first()
-    if not user or user.id != order.user_id:
+    user = order.user
+    if not user or user.rfid_card != lock.rfid_card:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="用户信息不匹配"
         )
@@ -559,12 +825,16 @@ async def lock_bike(lock: OrderLock, db: Session = Depends(get_db)):
             detail=f"余额不足，本次消费 {float(cost)} 元，当前余额 {float(user.balance)} 元",
         )
 
+    # 骑行距离（由本次骑行的轨迹计算）
+    distance_km = round(ride_distance_km(db, order.id), 2)
+
     # 更新订单
     order.end_time = end_time
     order.duration_minutes = duration_minutes
     order.end_lat = lock.end_lat
     order.end_lng = lock.end_lng
     order.cost = cost
+    order.distance_km = Decimal(str(distance_km))
     order.status = OrderStatus.COMPLETED.value
 
     # 更新车辆状态
@@ -578,17 +848,27 @@ async def lock_bike(lock: OrderLock, db: Session = Depends(get_db)):
     user.balance -= cost
 
     db.commit()
+    user_cache.update(user)
+    event_bus.finish_ride(order.bike_id, order.id, order.user_id)
+    if bike:
+        event_bus.apply_bike(
+            bike.id, current_lat=lock.end_lat, current_lng=lock.end_lng, status=BikeStatus.IDLE.value
+        )
+    domain_events.order_completed(order, bike)
+    domain_events.balance_changed(user, -cost, "ride")
 
     # 发送 MQTT 关锁指令
     mqtt_client.publish_command(bike.id, "lock", None, bike.bike_code)
 
     logger.info(
-        f"还车成功: 用户={lock.rfid_card}, 车辆={bike.bike_code}, 时长={duration_minutes}分钟, 费用={cost}元"
+        f"还车成功: 用户={lock.rfid_card}, 车辆={bike.bike_code}, 时长={duration_minutes}分钟, "
+        f"距离={distance_km}公里, 费用={cost}元"
     )
 
     return LockResponse(
         success=True,
         duration_minutes=duration_minutes,
+        distance_km=distance_km,
         cost=float(cost),
         new_balance=float(user.balance),
         message="还车成功",
@@ -596,8 +876,9 @@ async def lock_bike(lock: OrderLock, db: Session = Depends(get_db)):
 
 
 @app.get("/api/orders", response_model=List[OrderResponse], tags=["订单管理"])
-async def get_orders(
-    skip: int = 0, limit: int = 100, user_id: int = None, db: Session = Depends(get_db)
+@db_route
+def get_orders(
+    db: Session, skip: int = 0, limit: int = 100, user_id: int = None
 ):
     """获取订单列表"""
     query = db.query(Order)
@@ -609,7 +890,8 @@ async def get_orders(
 
 
 @app.get("/api/orders/{order_id}", response_model=OrderResponse, tags=["订单管理"])
-async def get_order(order_id: int, db: Session = Depends(get_db)):
+@db_route
+def get_order(db: Session, order_id: int):
     """获取订单详情"""
     order = db.query(Order).filter(Order.id == order_id).first()
     if not order:
@@ -621,10 +903,17 @@ async def get_order(order_id: int, db: Session = Depends(get_db)):
 
 
 @app.post("/api/auth/validate-card", response_model=RFIDAuthResponse, tags=["硬件认证"])
-async def validate_card(auth: RFIDAuthRequest, db: Session = Depends(get_db)):
+async def validate_card(auth: RFIDAuthRequest):
     """验证 RFID 卡（硬件端调用）"""
-    # 查找用户
-    user = db.query(User).filter(User.rfid_card == auth.rfid_uid).first()
+    if auth.action == "lock":
+        # 刷卡还车：先写入本车当前骑行缓冲中的轨迹点（不在数据库会话中等待）
+        await flush_ride_points(active_orders.order_for_bike(auth.bike_id))
+    return await run_db(_validate_card, auth)
+
+
+def _validate_card(db: Session, auth: RFIDAuthRequest) -> RFIDAuthResponse:
+    # 查找用户（命中缓存时，卡未注册以外的拒绝不访问数据库）
+    user = user_cache.get(db, auth.rfid_uid)
 
     if not user:
         # 发送认证失败响应
@@ -649,27 +938,17 @@ async def validate_card(auth: RFIDAuthRequest, db: Session = Depends(get_db)):
 
     # 处理开锁或还车
     if auth.action == "unlock":
-        # 查找车辆
-        bike = db.query(Bike).filter(Bike.id == auth.bike_id).first()
-        if not bike or bike.status != BikeStatus.IDLE.value:
-            mqtt_client.publish_response(
-                auth.bike_id, success=False, message="车辆不可用"
-            )
-            return RFIDAuthResponse(success=False, message="车辆不可用")
-
-        # 创建订单
-        order = Order(
-            user_id=user.id,
-            bike_id=auth.bike_id,
-            start_time=datetime.now(),
-            status=OrderStatus.ACTIVE.value,
-        )
-        db.add(order)
-
-        # 更新车辆状态
-        bike.status = BikeStatus.RIDING.value
-        db.commit()
-        db.refresh(order)
+        # 占用车辆（仅空闲时）并创建订单
+        result = order_service.unlock(db, user.id, auth.bike_id)
+        if not result.success:
+            message = "您有进行中的订单" if result.reason == UNLOCK_USER_RIDING else "车辆不可用"
+            mqtt_client.publish_response(auth.bike_id, success=False, message=message)
+            return RFIDAuthResponse(success=False, message=message)
+
+        order = result.order
+        event_bus.apply_bike(auth.bike_id, status=BikeStatus.RIDING.value)
+        event_bus.start_ride(auth.bike_id, order.id, user.id)
+        domain_events.order_started(order, result.bike)
 
         # 发送认证成功响应
         mqtt_client.publish_response(
@@ -689,16 +968,20 @@ async def validate_card(auth: RFIDAuthRequest, db: Session = Depends(get_db)):
         )
 
     elif auth.action == "lock":
-        # 查找进行中的订单
-        order = (
-            db.query(Order)
-            .filter(
+        # 查找进行中的订单（同时读取用户，扣费以数据库中的余额为准）
+        query = db.query(Order).options(joinedload(Order.user))
+        if active_orders.ready:
+            # 按进行中订单索引找到本车当前订单，按主键读取
+            order_id = active_orders.order_for_bike(auth.bike_id)
+            order = None
+            if order_id is not None and active_orders.order_for_user(user.id) == order_id:
+                order = query.filter(Order.id == order_id, Order.status == OrderStatus.ACTIVE.value).first()
+        else:
+            order = query.filter(
                 Order.user_id == user.id,
                 Order.bike_id == auth.bike_id,
                 Order.status == OrderStatus.ACTIVE.value,
-            )
-            .first()
-        )
+            ).first()
 
         if not order:
             mqtt_client.publish_response(
@@ -709,12 +992,13 @@ async def validate_card(auth: RFIDAuthRequest, db: Session = Depends(get_db)):
         # 计算费用（按总秒数计算，精确到 0.01 元/秒）
         total_seconds = (datetime.now() - order.start_time).total_seconds()
         duration_minutes = int(total_seconds / 60)
-        cost = round((total_seconds / 60) * settings.PRICE_PER_MINUTE, 2)
+        cost = Decimal(str(round((total_seconds / 60) * settings.PRICE_PER_MINUTE, 2)))
 
         # 更新订单
         order.end_time = datetime.now()
         order.duration_minutes = duration_minutes
         order.cost = cost
+        order.distance_km = Decimal(str(round(ride_distance_km(db, order.id), 2)))
         order.status = OrderStatus.COMPLETED.value
 
         # 更新车辆状态
@@ -723,8 +1007,15 @@ async def validate_card(auth: RFIDAuthRequest, db: Session = Depends(get_db)):
             bike.status = BikeStatus.IDLE.value
 
         # 扣除余额
+        user = order.user
         user.balance -= cost
         db.commit()
+        user_cache.update(user)
+        event_bus.finish_ride(auth.bike_id, order.id, order.user_id)
+        if bike:
+            event_bus.apply_bike(auth.bike_id, status=BikeStatus.IDLE.value)
+        domain_events.order_completed(order, bike)
+        domain_events.balance_changed(user, -cost, "ride")
 
         # 发送认证成功响应
         mqtt_client.publish_response(
@@ -743,7 +1034,8 @@ async def validate_card(auth: RFIDAuthRequest, db: Session = Depends(get_db)):
 
 
 @app.post("/api/admin/command", response_model=MessageResponse, tags=["管理员"])
-async def admin_command(command: AdminCommand, db: Session = Depends(get_db)):
+@db_route
+def admin_command(db: Session, command: AdminCommand):
     """管理员远程控制"""
     bike = db.query(Bike).filter(Bike.id == command.bike_id).first()
     if not bike:
@@ -775,13 +1067,30 @@ async def admin_command(command: AdminCommand, db: Session = Depends(get_db)):
 
 
 @app.get("/api/admin/dashboard", response_model=DashboardStats, tags=["管理员"])
-async def get_dashboard(db: Session = Depends(get_db)):
-    """获取仪表盘统计数据"""
+async def get_dashboard():
+    """获取仪表盘统计数据（计数已加载时直接取内存中的增量计数，同样的数据也随 WebSocket 事件推送）"""
+    dashboard = dashboard_counters.snapshot()
+    if dashboard is not None:
+        return DashboardStats(**dashboard)
+
+    return await run_db(_dashboard_from_db)
+
+
+def _dashboard_from_db(db: Session) -> DashboardStats:
     # 车辆统计
-    total_bikes = db.query(Bike).count()
-    idle_bikes = db.query(Bike).filter(Bike.status == BikeStatus.IDLE.value).count()
-    riding_bikes = db.query(Bike).filter(Bike.status == BikeStatus.RIDING.value).count()
-    fault_bikes = db.query(Bike).filter(Bike.status == BikeStatus.FAULT.value).count()
+    if fleet_state.ready:
+        counts = fleet_state.status_counts()
+        total_bikes = fleet_state.total()
+        idle_bikes = counts.get(BikeStatus.IDLE.value, 0)
+        riding_bikes = counts.get(BikeStatus.RIDING.value, 0)
+        fault_bikes = counts.get(BikeStatus.FAULT.value, 0)
+    else:
+        total_bikes = db.query(Bike).count()
+        idle_bikes = db.query(Bike).filter(Bike.status == BikeStatus.IDLE.value).count()
+        riding_bikes = db.query(Bike).filter(Bike.status == BikeStatus.RIDING.value).count()
+        fault_bikes = db.query(Bike).filter(Bike.status == BikeStatus.FAULT.value).count()
+    online_since = datetime.now() - timedelta(seconds=settings.HEARTBEAT_TIMEOUT_SECONDS)
+    online_bikes = db.query(Bike).filter(Bike.last_heartbeat >= online_since).count()
 
     # 用户统计
     total_users = db.query(User).count()
@@ -804,11 +1113,34 @@ async def get_dashboard(db: Session = Depends(get_db)):
         total_users=total_users,
         today_orders=today_orders,
         today_revenue=float(today_revenue),
+        online_bikes=online_bikes,
     )
 
 
+@app.get("/api/admin/metrics", tags=["管理员"])
+async def get_metrics():
+    """获取后端运行指标"""
+    return {
+        "mqtt_ingest": mqtt_client.get_ingest_metrics(),
+        "write_behind": bike_write_buffer.get_metrics(),
+        "trajectory": trajectory_writer.get_metrics(),
+        "track_cache": track_cache.get_metrics(),
+        "websocket": websocket_manager.get_metrics(),
+        "websocket_frames": telemetry_coalescer.get_metrics(),
+        "event_bus": event_bus.get_metrics(),
+        "domain_events": domain_events.get_metrics(),
+        "heartbeat": heartbeat_monitor.get_metrics(),
+        "orders": order_service.get_metrics(),
+        "active_orders": active_orders.get_metrics(),
+        "idempotency": idempotency_cache.get_metrics(),
+        "user_cache": user_cache.get_metrics(),
+        "database": get_db_metrics(),
+    }
+
+
 @app.get("/api/admin/statistics/trends", tags=["管理员"])
-async def get_statistics_trends(days: int = 7, db: Session = Depends(get_db)):
+@db_route
+def get_statistics_trends(db: Session, days: int = 7):
     """获取指定天数的统计数据趋势"""
     trends_data = []
 
@@ -838,20 +1170,87 @@ async def get_statistics_trends(days: int = 7, db: Session = Depends(get_db)):
     return {"trends": trends_data}
 
 
+# ========== HTTP 流式推送 ==========
+
+
+def _split_param(value: Optional[str]) -> Optional[List[str]]:
+    if not value:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+@app.get("/api/stream/bikes", tags=["实时推送"])
+async def stream_bikes(
+    request: Request,
+    format: str = Query(STREAM_SSE, pattern=f"^({STREAM_SSE}|{STREAM_NDJSON})$", description="sse 或 ndjson"),
+    bike_ids: Optional[str] = Query(None, description="只推送这些车辆，逗号分隔"),
+    bbox: Optional[str] = Query(None, description="只推送该范围内的车辆: min_lng,min_lat,max_lng,max_lat"),
+    topics: Optional[str] = Query(None, description="消息类型 heartbeat,gps,auth，默认全部"),
+    last_event_id: Optional[str] = Query(None, description="续传位置（同 Last-Event-ID）"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    车队实时更新的 HTTP 流（供代理不允许 WebSocket 的环境代替轮询 /api/bikes）
+
+    内容与 /ws 相同：先推送车队快照，之后是按 tick 合并的心跳/GPS 增量和认证事件。
+    SSE 每个事件带 ID "<stream>:<seq>"，断线重连时浏览器自动带上 Last-Event-ID，
+    缺失的消息仍在重放缓冲中则只补发缺失部分，否则重新推送快照
+    """
+    try:
+        subscription = parse_subscription({
+            "bike_ids": _split_param(bike_ids),
+            "topics": _split_param(topics),
+            "bbox": [float(v) for v in _split_param(bbox)] if bbox else None,
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"订阅参数无效: {e}")
+
+    stream_id, last_seq = None, None
+    resume = last_event_id_header or last_event_id
+    if resume:
+        stream_id, _, seq = resume.rpartition(":")
+        try:
+            last_seq = int(seq)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID 格式应为 <stream>:<seq>")
+
+    client = websocket_manager.open_stream(request, format, subscription, stream_id, last_seq)
+    media_type = "text/event-stream" if format == STREAM_SSE else "application/x-ndjson"
+    return StreamingResponse(
+        client.frames(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ========== WebSocket 端点 ==========
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket 端点，用于向前端推送实时数据"""
-    await websocket_manager.connect(websocket)
+    """
+    WebSocket 端点，用于向前端推送实时数据
+
+    重连时可带 ?stream=<流 ID>&last_seq=<最后收到的序号>，只补发断线期间缺失的消息；
+    ?encoding=msgpack 使用二进制 MessagePack 帧（默认 JSON 文本帧）
+    """
+    try:
+        last_seq = int(websocket.query_params["last_seq"])
+    except (KeyError, ValueError):
+        last_seq = None
+    await websocket_manager.connect(
+        websocket,
+        websocket.query_params.get("stream"),
+        last_seq,
+        websocket.query_params.get("encoding"),
+    )
 
     try:
         # 保持连接，接收客户端消息（如果有）
         while True:
             data = await websocket.receive_text()
-            # 可以处理客户端发送的消息
-            logger.debug(f"收到 WebSocket 消息: {data}")
+            # 处理客户端的订阅请求
+            await websocket_manager.handle_client_message(websocket, data)
 
     except WebSocketDisconnect:
         websocket_manager.disconnect(websocket)
@@ -869,4 +1268,5 @@ if __name__ == "__main__":
         host=settings.HOST,
         port=settings.PORT,
         reload=False,  # Windows 上禁用自动重载避免多进程问题
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE,
     )
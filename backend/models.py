@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DECIMAL, TIMESTAMP, ForeignKey, Text, Enum
+from sqlalchemy import Column, Computed, Integer, String, DECIMAL, TIMESTAMP, ForeignKey, Text, Enum
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -88,6 +88,11 @@ class Order(Base):
     distance_km = Column(DECIMAL(10, 2))
     status = Column(String(20), default=OrderStatus.ACTIVE.value)
     created_at = Column(TIMESTAMP, server_default=func.current_timestamp())
+    # 进行中的订单为 user_id，其余为 NULL；唯一索引保证每个用户最多一个进行中的订单
+    active_user_id = Column(Integer, Computed("CASE WHEN status = 'active' THEN user_id END"), unique=True)
+
+    # 生成列由数据库维护，不映射到 ORM（插入/更新订单时不涉及）
+    __mapper_args__ = {"exclude_properties": ["active_user_id"]}
 
     # 关系
     user = relationship("User", back_populates="orders")
@@ -1,20 +1,189 @@
 import paho.mqtt.client as mqtt
-from typing import Callable, Dict, Any, List
+from typing import Callable, Dict, Any, List, Optional
+import asyncio
 import json
+import os
+import sys
+import threading
 from datetime import datetime
 from config import settings
+from ingest_queue import IngestQueue, partition_key, POLICY_BLOCK, POLICY_DROP_OLDEST
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class _TopicNode:
+    """主题前缀树节点"""
+
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children: Dict[str, "_TopicNode"] = {}
+        self.callbacks: List[Callable] = []
+
+
+class TopicRouter:
+    """
+    主题路由器 - 按主题层级构建的前缀树
+
+    在 subscribe() 时插入主题模式，收到消息时按层级查找，
+    代价为 O(主题深度)，无需逐个模式匹配正则。
+    支持 MQTT 通配符：+ 匹配单个层级，# 匹配剩余所有层级（含父层级）。
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def add(self, topic_pattern: str, callback: Callable):
+        """插入主题模式及其回调"""
+        node = self._root
+        for level in topic_pattern.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicNode()
+            node = child
+        node.callbacks.append(callback)
+
+    def match(self, topic: str) -> List[Callable]:
+        """返回与主题匹配的所有回调"""
+        levels = topic.split("/")
+        # 以 $ 开头的系统主题不参与首层通配符匹配
+        allow_wildcard = not topic.startswith("$")
+        matched: List[Callable] = []
+        self._collect(self._root, levels, 0, allow_wildcard, matched)
+        return matched
+
+    def _collect(self, node: _TopicNode, levels: List[str], index: int,
+                 allow_wildcard: bool, matched: List[Callable]):
+        if allow_wildcard:
+            multi = node.children.get("#")
+            if multi is not None:
+                matched.extend(multi.callbacks)
+
+        if index == len(levels):
+            matched.extend(node.callbacks)
+            return
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._collect(child, levels, index + 1, True, matched)
+
+        if allow_wildcard:
+            single = node.children.get("+")
+            if single is not None:
+                self._collect(single, levels, index + 1, True, matched)
+
+
+class AsyncioMQTTAdapter:
+    """
+    将 paho 客户端接入 asyncio 事件循环（替代 loop_start() 网络线程）
+
+    通过 socket 回调把读写事件注册到事件循环，消息回调直接在事件循环中执行。
+    paho 的自动重连只在 loop_start()/loop_forever() 中生效，这里自行按指数退避重连。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client,
+                 min_delay: float = 1, max_delay: float = 60):
+        self.loop = loop
+        self.client = client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.stopping = False
+        self._sock = None
+        self._misc_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._loop_thread_id = threading.get_ident()  # 须在事件循环线程中创建
+
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # paho 可能在其他线程（如 publish 调用方、重连线程）触发这些回调
+    def _call(self, func, *args):
+        if self.loop.is_closed():
+            return
+        if threading.get_ident() == self._loop_thread_id:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._attach, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._detach, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._watch_write, sock, True)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._watch_write, sock, False)
+
+    def _watch_write(self, sock, enable: bool):
+        if sock is not self._sock:
+            return
+        if enable:
+            self.loop.add_writer(sock, self.client.loop_write)
+        else:
+            self.loop.remove_writer(sock)
+
+    def _attach(self, sock):
+        self._sock = sock
+        self.loop.add_reader(sock, self.client.loop_read)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _detach(self, sock):
+        if self._sock is sock:
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
+            self._sock = None
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        if not self.stopping and (self._reconnect_task is None or self._reconnect_task.done()):
+            self._reconnect_task = self.loop.create_task(self._reconnect_loop())
+
+    async def _misc_loop(self):
+        """周期性调用 loop_misc()，负责 keepalive 与超时处理"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def _reconnect_loop(self):
+        delay = self.min_delay
+        while not self.stopping:
+            await asyncio.sleep(delay)
+            try:
+                # reconnect() 内部是阻塞的 TCP 连接，放到线程池执行
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                logger.info("MQTT 已重新建立连接（asyncio 模式），等待 CONNACK...")
+                return
+            except Exception as e:
+                logger.warning(f"MQTT 重连失败，{delay}s 后重试: {e}")
+                delay = min(delay * 2, self.max_delay)
+
+    def stop(self):
+        """停止重连并注销事件循环中的读写监听"""
+        self.stopping = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+        if self._sock is not None:
+            self.loop.remove_reader(self._sock)
+            self.loop.remove_writer(self._sock)
+            self._sock = None
+
+
 class MQTTHandler:
     """MQTT 客户端处理器 - 支持自动重连"""
 
     def __init__(self):
-        # 创建客户端 - 使用自动生成的 client_id 避免冲突
+        # 创建客户端 - 使用自动生成的 client_id 避免冲突（含进程号，多 worker 时互不相同）
         import time
-        client_id = f"server_backend_{int(time.time())}"
+        client_id = f"server_backend_{os.getpid()}_{int(time.time())}"
 
         self.client = mqtt.Client(
             client_id=client_id,
@@ -26,6 +195,33 @@ class MQTTHandler:
 
         self.connected = False
         self.message_callbacks: Dict[str, List[Callable]] = {}
+        self.router = TopicRouter()  # 主题路由（subscribe 时构建）
+        self.async_router = TopicRouter()  # 协程回调的主题路由
+
+        # 传输方式: thread（paho 网络线程）或 asyncio（运行在应用事件循环中）
+        self.transport = settings.MQTT_TRANSPORT
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._aio_adapter: Optional[AsyncioMQTTAdapter] = None
+        self._tasks = set()
+        # 不直接连接 MQTT 的进程（事件总线 follower）由它代为发布消息
+        self._publish_forwarder: Optional[Callable[[str, Dict[str, Any], int], None]] = None
+
+        # 接收队列：回调由工作线程池执行，避免阻塞网络线程
+        self.ingest_queue = None
+        if self.transport == "asyncio" and settings.MQTT_INGEST_WORKERS <= 0:
+            # asyncio 模式下回调（同步访问数据库）不能在事件循环中直接执行
+            raise ValueError("MQTT_TRANSPORT=asyncio 时 MQTT_INGEST_WORKERS 必须大于 0")
+        if settings.MQTT_INGEST_WORKERS > 0:
+            self.ingest_queue = IngestQueue(
+                settings.MQTT_INGEST_WORKERS,
+                settings.MQTT_INGEST_QUEUE_SIZE,
+                settings.MQTT_INGEST_BLOCK_TIMEOUT,
+            )
+        # 队列满时需要阻塞等待（不可丢弃）的主题
+        self._block_router = TopicRouter()
+        for pattern in settings.MQTT_INGEST_BLOCK_TOPICS.split(","):
+            if pattern.strip():
+                self._block_router.add(pattern.strip(), POLICY_BLOCK)
         self.subscribed_topics: List[str] = []  # 记录已订阅的主题
 
         # 配置客户端（仅在提供了用户名密码时才设置）
@@ -71,29 +267,49 @@ class MQTTHandler:
             payload = msg.payload.decode('utf-8')
             data = json.loads(payload)
 
-            logger.debug(f"收到 MQTT 消息: {topic} -> {data}")
+            logger.debug("收到 MQTT 消息: %s -> %s", topic, data)
+
+            # 协程回调（如 WebSocket 转发）直接调度到事件循环
+            for callback in self.async_router.match(topic):
+                self._schedule(callback(topic, data))
+
+            # 通过路由树查找所有匹配的同步回调函数
+            callbacks = self.router.match(topic)
+            if not callbacks:
+                return
 
-            # 触发所有匹配的回调函数
-            for pattern, callbacks in self.message_callbacks.items():
-                if self._topic_match(topic, pattern):
-                    # 调用所有注册的回调
-                    for callback in callbacks:
-                        try:
-                            callback(topic, data)
-                        except Exception as e:
-                            logger.error(f"回调函数执行失败 (pattern={pattern}): {e}")
+            if self.ingest_queue is not None:
+                policy = POLICY_BLOCK if self._block_router.match(topic) else POLICY_DROP_OLDEST
+                # asyncio 模式下本方法运行在事件循环中，不能等待队列空位
+                timeout = 0 if self._aio_adapter is not None else None
+                self.ingest_queue.submit(partition_key(topic), topic, data, callbacks, policy, timeout)
+                return
+
+            for callback in callbacks:
+                try:
+                    callback(topic, data)
+                except Exception as e:
+                    logger.error(f"回调函数执行失败 (topic={topic}): {e}")
 
         except Exception as e:
             logger.error(f"处理 MQTT 消息错误: {e}")
 
-    def _topic_match(self, topic: str, pattern: str) -> bool:
-        """匹配主题通配符"""
-        # 将通配符转换为正则表达式
-        # + 匹配单个层级，# 匹配多个层级
-        import re
-        regex = pattern.replace("+", "[^/]+").replace("#", ".*")
-        regex = "^" + regex + "$"
-        return bool(re.match(regex, topic))
+    def _schedule(self, coro):
+        """将协程回调交给事件循环执行"""
+        if self._aio_adapter is not None:
+            # asyncio 模式下本方法就运行在事件循环中，无需跨线程
+            task = self._loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif self._loop is not None:
+            asyncio.run_coroutine_threadsafe(coro, self._loop)
+        else:
+            coro.close()
+            logger.warning("事件循环未设置，无法执行协程回调")
+
+    def set_event_loop(self, loop: asyncio.AbstractEventLoop):
+        """设置执行协程回调的事件循环"""
+        self._loop = loop
 
     def _resubscribe_topics(self):
         """重新订阅所有之前订阅的主题"""
@@ -110,6 +326,30 @@ class MQTTHandler:
     def connect(self) -> bool:
         """连接到 MQTT Broker"""
         try:
+            if self._loop is None:
+                try:
+                    self._loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    pass
+
+            if self.transport == "asyncio" and not self._loop_supports_readers():
+                logger.warning("当前事件循环不支持 add_reader，MQTT 改用线程模式")
+                self.transport = "thread"
+
+            if self.ingest_queue is not None:
+                self.ingest_queue.start()
+
+            if self.transport == "asyncio":
+                # 必须在 connect() 之前注册 socket 回调
+                self._aio_adapter = AsyncioMQTTAdapter(self._loop, self.client)
+                self.client.connect(
+                    settings.MQTT_BROKER,
+                    settings.MQTT_PORT,
+                    settings.MQTT_KEEPALIVE
+                )
+                logger.info("MQTT 客户端以 asyncio 模式运行")
+                return True
+
             self.client.connect(
                 settings.MQTT_BROKER,
                 settings.MQTT_PORT,
@@ -121,19 +361,47 @@ class MQTTHandler:
             logger.error(f"MQTT 连接失败: {e}")
             return False
 
+    def _loop_supports_readers(self) -> bool:
+        """asyncio 模式需要支持 add_reader 的事件循环（Windows 的 Proactor 循环不支持）"""
+        if self._loop is None:
+            return False
+        if sys.platform == "win32" and isinstance(self._loop, asyncio.ProactorEventLoop):
+            return False
+        return True
+
     def disconnect(self):
         """断开连接"""
-        self.client.loop_stop()
-        self.client.disconnect()
+        if self._aio_adapter is not None:
+            self._aio_adapter.stopping = True
+            self.client.disconnect()
+            self.client.loop_write()  # 发出 DISCONNECT 报文
+            self._aio_adapter.stop()
+            self._aio_adapter = None
+        else:
+            self.client.loop_stop()
+            self.client.disconnect()
         self.connected = False
+
+        # 处理完队列中剩余的消息
+        if self.ingest_queue is not None:
+            self.ingest_queue.stop()
         logger.info("MQTT 客户端已断开连接")
 
     def subscribe(self, topic_pattern: str, callback: Callable):
-        """订阅主题并注册回调函数（支持同一主题多个回调）"""
+        """
+        订阅主题并注册回调函数（支持同一主题多个回调）
+
+        普通函数回调经接收队列由工作线程执行；
+        协程函数回调调度到事件循环执行（asyncio 模式下无线程切换）
+        """
         if topic_pattern not in self.message_callbacks:
             self.message_callbacks[topic_pattern] = []
 
         self.message_callbacks[topic_pattern].append(callback)
+        if asyncio.iscoroutinefunction(callback):
+            self.async_router.add(topic_pattern, callback)
+        else:
+            self.router.add(topic_pattern, callback)
         logger.info(f"注册主题订阅: {topic_pattern} (该主题现有 {len(self.message_callbacks[topic_pattern])} 个回调)")
 
         # 如果已连接，立即订阅；否则记录待订阅的主题
@@ -151,8 +419,15 @@ class MQTTHandler:
                 self.subscribed_topics.append(topic_pattern)
                 logger.info(f"记录待订阅主题（连接后自动订阅）: {topic_pattern}")
 
+    def set_publish_forwarder(self, forwarder: Optional[Callable[[str, Dict[str, Any], int], None]]):
+        """设置代为发布消息的函数，None 表示由本进程直接发布"""
+        self._publish_forwarder = forwarder
+
     def publish(self, topic: str, message: Dict[str, Any], qos: int = 1):
         """发布消息"""
+        if self._publish_forwarder is not None:
+            self._publish_forwarder(topic, message, qos)
+            return
         try:
             payload = json.dumps(message, default=str)
             self.client.publish(topic, payload, qos=qos)
@@ -203,10 +478,17 @@ class MQTTHandler:
         """获取连接状态信息"""
         return {
             "connected": self.connected,
+            "transport": self.transport,
             "broker": f"{settings.MQTT_BROKER}:{settings.MQTT_PORT}",
             "subscribed_topics": self.subscribed_topics.copy()
         }
 
+    def get_ingest_metrics(self) -> Dict[str, Any]:
+        """获取接收队列统计（队列深度、等待时间、丢弃数）"""
+        if self.ingest_queue is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.ingest_queue.get_metrics()}
+
     def manual_reconnect(self) -> bool:
         """手动触发重连"""
         try:
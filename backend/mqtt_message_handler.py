@@ -1,15 +1,32 @@
 """
 MQTT消息处理器 - 处理硬件端发送的心跳和GPS消息
-更新数据库中的车辆位置、电量和心跳时间
+更新车队状态存储和数据库中的车辆位置、电量和心跳时间，并为心跳超时检测续期
+
+启动后新增的车辆（管理员添加、脚本导入）不在车队状态中：首次收到其消息时从数据库加载，
+数据库中也没有的车辆在 FLEET_MISS_RECHECK_SECONDS 内不再查询
 """
+import time
+import threading
 from datetime import datetime
 from typing import Dict, Any
 import logging
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
+from config import settings
+from database import engine
 from models import Bike, BikeStatus
+from fleet_state import fleet_state
+from heartbeat_monitor import heartbeat_monitor
+from event_bus import event_bus
 
 logger = logging.getLogger(__name__)
 
+VALID_BIKE_STATUSES = [BikeStatus.IDLE.value, BikeStatus.RIDING.value, BikeStatus.FAULT.value]
+
+# 数据库中也不存在的车辆 -> 下次查询的时间（单调时钟）
+_missing_bikes: Dict[int, float] = {}
+_missing_lock = threading.Lock()
+
 
 def extract_bike_id_from_topic(topic: str) -> int:
     """
@@ -62,10 +79,16 @@ def handle_heartbeat_message(topic: str, data: Dict[str, Any], db: Session):
 
         # 更新状态（如果硬件端的状态与数据库不一致）
         hw_status = data.get('status')
-        if hw_status in [BikeStatus.IDLE.value, BikeStatus.RIDING.value, BikeStatus.FAULT.value]:
+        if hw_status in VALID_BIKE_STATUSES:
             bike.status = hw_status
 
         db.commit()
+        if fleet_state.apply(
+            bike_id, current_lat=lat, current_lng=lng, battery=data.get('battery', 100),
+            status=hw_status if hw_status in VALID_BIKE_STATUSES else None,
+            last_heartbeat=datetime.now(),
+        ):
+            heartbeat_monitor.touch(bike_id)
 
         logger.info(
             f"✓ 心跳更新: bike_{bike_id} | "
@@ -108,6 +131,8 @@ def handle_gps_message(topic: str, data: Dict[str, Any], db: Session):
         bike.last_heartbeat = datetime.now()
 
         db.commit()
+        if fleet_state.apply(bike_id, current_lat=lat, current_lng=lng, last_heartbeat=datetime.now()):
+            heartbeat_monitor.touch(bike_id)
 
         logger.info(
             f"✓ GPS更新: bike_{bike_id} | "
@@ -120,11 +145,166 @@ def handle_gps_message(topic: str, data: Dict[str, Any], db: Session):
         db.rollback()
 
 
-def setup_mqtt_subscriptions(mqtt_client, get_db_func):
+def parse_heartbeat(data: Dict[str, Any]) -> Dict[str, Any]:
+    """从心跳包中提取需要写库的字段"""
+    hw_status = data.get('status')
+    return {
+        "current_lat": float(data.get('lat', 0)),
+        "current_lng": float(data.get('lng', 0)),
+        "battery": data.get('battery', 100),
+        "status": hw_status if hw_status in VALID_BIKE_STATUSES else None,
+        "last_heartbeat": datetime.now(),
+    }
+
+
+def parse_gps(data: Dict[str, Any]) -> Dict[str, Any]:
+    """从GPS上报中提取需要写库的字段"""
+    return {
+        "current_lat": float(data.get('lat', 0)),
+        "current_lng": float(data.get('lng', 0)),
+        "last_heartbeat": datetime.now(),
+    }
+
+
+def ensure_bike_loaded(bike_id: int) -> bool:
+    """
+    车辆不在车队状态中时从数据库加载（经事件总线写入所有 worker），返回车辆是否存在
+
+    车队状态未预热时返回 True，由调用方照常写库
+    """
+    if not fleet_state.ready or fleet_state.contains(bike_id):
+        return True
+    now = time.monotonic()
+    with _missing_lock:
+        if _missing_bikes.get(bike_id, 0.0) > now:
+            return False
+
+    with engine.connect() as conn:
+        bike = conn.execute(select(Bike.__table__).where(Bike.__table__.c.id == bike_id)).first()
+    if bike is None:
+        with _missing_lock:
+            _missing_bikes[bike_id] = now + settings.FLEET_MISS_RECHECK_SECONDS
+        return False
+
+    with _missing_lock:
+        _missing_bikes.pop(bike_id, None)
+    event_bus.upsert_bike(bike)
+    logger.info(f"车辆不在车队状态中，已从数据库加载: bike_id={bike_id}")
+    return True
+
+
+def write_bike_status(bike_id: int, status: str):
+    """
+    立即写入硬件上报的车辆状态
+
+    状态不经写回缓冲：缓冲中的心跳最多在 DB_FLUSH_INTERVAL 后才写库，
+    若期间用户开锁/还车，延迟写入的旧状态会覆盖已提交的状态
+    （开锁的条件 UPDATE 也会因此放行第二个用户）
+    """
+    with engine.begin() as conn:
+        conn.execute(update(Bike.__table__).where(Bike.__table__.c.id == bike_id).values(status=status))
+
+
+def record_heartbeat_message(topic: str, data: Dict[str, Any], write_buffer):
+    """处理心跳包消息（位置、电量和心跳时间进入写回缓冲，状态变化时立即写库）"""
+    try:
+        bike_id = extract_bike_id_from_topic(topic)
+        if not bike_id:
+            return
+        if not ensure_bike_loaded(bike_id):
+            logger.warning(f"收到心跳但车辆不存在: bike_id={bike_id}")
+            return
+        fields = parse_heartbeat(data)
+        status = fields.pop("status")
+        previous = fleet_state.status_of(bike_id)
+        if fleet_state.apply(bike_id, status=status, **fields):
+            heartbeat_monitor.touch(bike_id)
+        # 状态与当前一致时（绝大多数心跳）不访问数据库
+        if status is not None and status != previous:
+            write_bike_status(bike_id, status)
+        write_buffer.record(bike_id, **fields)
+    except Exception as e:
+        logger.error(f"处理心跳消息失败: {e}, data={data}")
+
+
+def record_gps_message(topic: str, data: Dict[str, Any], write_buffer):
+    """处理GPS上报消息（写回缓冲模式，不直接访问数据库）"""
+    try:
+        bike_id = extract_bike_id_from_topic(topic)
+        if not bike_id:
+            return
+        if not ensure_bike_loaded(bike_id):
+            logger.warning(f"收到GPS但车辆不存在: bike_id={bike_id}")
+            return
+        fields = parse_gps(data)
+        if fleet_state.apply(bike_id, **fields):
+            heartbeat_monitor.touch(bike_id)
+        write_buffer.record(bike_id, **fields)
+    except Exception as e:
+        logger.error(f"处理GPS消息失败: {e}, data={data}")
+
+
+def apply_fleet_update(topic: str, data: Dict[str, Any]):
+    """只更新本进程的车队状态和心跳超时检测，不写库（事件总线 follower 收到 leader 转发的消息时使用）"""
+    try:
+        bike_id = extract_bike_id_from_topic(topic)
+        if not bike_id:
+            return
+        kind = topic.rsplit('/', 1)[-1]
+        if kind == 'heartbeat':
+            applied = fleet_state.apply(bike_id, **parse_heartbeat(data))
+        elif kind == 'gps':
+            applied = fleet_state.apply(bike_id, **parse_gps(data))
+        else:
+            return
+        if applied:
+            heartbeat_monitor.touch(bike_id)
+    except Exception as e:
+        logger.error(f"更新车队状态失败: {e}, data={data}")
+
+
+def record_trajectory_point(topic: str, data: Dict[str, Any], trajectory_writer):
+    """把GPS上报追加到轨迹写入管道"""
+    try:
+        bike_id = extract_bike_id_from_topic(topic)
+        if not bike_id:
+            return
+        if not ensure_bike_loaded(bike_id):
+            return
+        trajectory_writer.append(
+            bike_id, float(data.get('lat', 0)), float(data.get('lng', 0)), data.get('mode')
+        )
+    except Exception as e:
+        logger.error(f"记录轨迹点失败: {e}, data={data}")
+
+
+def setup_mqtt_subscriptions(mqtt_client, get_db_func, write_buffer=None, trajectory_writer=None):
     """
     设置MQTT订阅和回调
     在应用启动时调用此函数
+
+    传入 write_buffer 时，心跳/GPS 更新先合并到写回缓冲，再由其批量写库
+    传入 trajectory_writer 时，GPS 上报同时追加到轨迹写入管道
     """
+    if trajectory_writer is not None:
+        mqtt_client.subscribe(
+            "bike/+/gps",
+            lambda topic, data: record_trajectory_point(topic, data, trajectory_writer)
+        )
+        logger.info("✓ 已订阅主题: bike/+/gps (轨迹写入)")
+
+    if write_buffer is not None:
+        mqtt_client.subscribe(
+            "bike/+/heartbeat",
+            lambda topic, data: record_heartbeat_message(topic, data, write_buffer)
+        )
+        mqtt_client.subscribe(
+            "bike/+/gps",
+            lambda topic, data: record_gps_message(topic, data, write_buffer)
+        )
+        logger.info("✓ 已订阅主题: bike/+/heartbeat, bike/+/gps (写回缓冲模式)")
+        return
+
     def create_db_callback(handler_func):
         """创建一个带数据库会话的回调函数"""
         def callback(topic: str, data: Dict[str, Any]):
@@ -0,0 +1,213 @@
+"""
+订单服务 - 开锁
+
+开锁在一个事务中完成，不再先查询车辆、在 Python 中判断状态后再更新：
+1. 条件 UPDATE 占用车辆:
+   UPDATE bikes SET status='riding', ... WHERE id=? AND status='idle'
+   影响行数为 1 表示占用成功；两次几乎同时的刷卡只有一个能占用，另一个得到 0 行
+2. INSERT 订单后提交
+
+占用成功时事务内只有这两条语句（UPDATE + INSERT），一人一单的检查由唯一约束在 INSERT 中完成，
+车辆行锁从 UPDATE 持有到提交，期间不再有其他查询。
+
+每个用户同时只能有一个进行中的订单，由数据库约束保证：orders.active_user_id 是生成列
+（进行中的订单为 user_id，其余为 NULL）并有唯一索引，同一用户的第二个进行中订单 INSERT 失败，
+此时回滚并返回 UNLOCK_USER_RIDING。多 worker 时各进程的索引不共享，因此不能只依赖索引。
+进行中订单索引只用于提前拒绝：本进程已知用户有进行中的订单（或正在开锁）时不访问数据库。
+
+车辆编号、位置和占用失败时的当前状态优先取车队状态，不额外查询数据库。
+开锁接口、硬件开锁接口和刷卡认证共用本服务，提交后的事件发布与指令下发仍由各接口负责。
+"""
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import Bike, BikeStatus, Order, OrderStatus
+from fleet_state import fleet_state
+from active_orders import active_orders
+
+logger = logging.getLogger(__name__)
+
+# 开锁失败原因
+UNLOCK_NOT_FOUND = "not_found"
+UNLOCK_UNAVAILABLE = "unavailable"
+UNLOCK_USER_RIDING = "user_riding"
+
+
+class UnlockResult:
+    """开锁结果"""
+
+    def __init__(self, order: Optional[Order] = None, bike: Dict[str, Any] = None,
+                 bike_code: str = None, reason: str = None, bike_status: str = None,
+                 current_order_id: int = None):
+        self.order = order  # 已提交的订单（已移出会话，可在会话关闭后读取）
+        self.bike = bike  # 车辆变化的字段: {"id", "status", "current_lat", "current_lng"}
+        self.bike_code = bike_code
+        self.reason = reason  # 失败原因: UNLOCK_NOT_FOUND / UNLOCK_UNAVAILABLE / UNLOCK_USER_RIDING
+        self.bike_status = bike_status  # 占用失败时车辆的当前状态
+        self.current_order_id = current_order_id  # 用户已有进行中的订单时为该订单号（开锁中为 0）
+
+    @property
+    def success(self) -> bool:
+        return self.order is not None
+
+
+class OrderService:
+    """订单服务（线程安全，各请求使用自己的会话）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.unlocks = 0
+        self.conflicts = 0  # 车辆不是空闲（含并发刷卡时占用失败的一方）
+        self.not_found = 0
+        self.user_riding = 0  # 用户已有进行中的订单
+        self.total_ms = 0.0
+
+    def resolve_bike_code(self, db: Session, bike_code: str) -> Optional[int]:
+        """车辆编号 -> bike_id（优先取车队状态）"""
+        bike_id = fleet_state.id_for_code(bike_code)
+        if bike_id is None:
+            bike_id = db.query(Bike.id).filter(Bike.bike_code == bike_code).scalar()
+        return bike_id
+
+    def unlock(self, db: Session, user_id: int, bike_id: int,
+               lat: float = None, lng: float = None) -> UnlockResult:
+        """
+        为用户开锁：条件 UPDATE 占用车辆并创建订单（调用方已检查用户状态和余额）
+
+        用户已有进行中的订单（本进程索引或数据库中）时返回 UNLOCK_USER_RIDING
+
+        成功时事务已提交，订单已移出会话（提交后读取不会再查询数据库）
+        """
+        start = time.perf_counter()
+        if active_orders.ready:
+            current = active_orders.claim_user(user_id)
+        else:
+            current = db.query(Order.id).filter(
+                Order.user_id == user_id, Order.status == OrderStatus.ACTIVE.value
+            ).scalar()
+        if current is not None:
+            self._record(start, UNLOCK_USER_RIDING)
+            return UnlockResult(reason=UNLOCK_USER_RIDING, current_order_id=current)
+
+        try:
+            result = self._claim_bike(db, user_id, bike_id, lat, lng)
+        except Exception:
+            active_orders.release_user(user_id)
+            raise
+        if result.success:
+            active_orders.start(bike_id, result.order.id, user_id)
+        else:
+            active_orders.release_user(user_id)
+        self._record(start, result.reason)
+        return result
+
+    def _claim_bike(self, db: Session, user_id: int, bike_id: int,
+                    lat: Optional[float], lng: Optional[float]) -> UnlockResult:
+        """条件 UPDATE 占用车辆，成功时创建订单并提交（用户已有进行中的订单时 INSERT 违反唯一约束）"""
+        now = datetime.now()
+        values = {"status": BikeStatus.RIDING.value}
+        if lat is not None and lng is not None:
+            values.update(current_lat=lat, current_lng=lng)
+
+        claimed = db.execute(
+            update(Bike)
+            .where(Bike.id == bike_id, Bike.status == BikeStatus.IDLE.value)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed != 1:
+            db.rollback()
+            return self._claim_failed(db, bike_id)
+
+        order = Order(
+            user_id=user_id,
+            bike_id=bike_id,
+            start_time=now,
+            start_lat=lat,
+            start_lng=lng,
+            status=OrderStatus.ACTIVE.value,
+            created_at=now,
+        )
+        db.add(order)
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            # 其他 worker 已为该用户开锁（本进程的索引尚未同步）：回滚后在新事务中读取其订单
+            current = db.query(Order.id).filter(
+                Order.user_id == user_id, Order.status == OrderStatus.ACTIVE.value
+            ).scalar()
+            if current is None:
+                raise
+            return UnlockResult(reason=UNLOCK_USER_RIDING, current_order_id=current)
+        # 订单字段已齐全：移出会话后提交，提交时不会被过期，之后读取无需再查询
+        db.expunge(order)
+        db.commit()
+        # 提交后再取车辆编号与位置：车队状态中没有时的查询不在持有车辆行锁的事务中
+        bike_code, position = self._bike_info(db, bike_id)
+
+        if lat is None or lng is None:
+            lat, lng = position if position else (None, None)
+        bike = {
+            "id": bike_id,
+            "status": BikeStatus.RIDING.value,
+            "current_lat": float(lat) if lat is not None else None,
+            "current_lng": float(lng) if lng is not None else None,
+        }
+        return UnlockResult(order=order, bike=bike, bike_code=bike_code)
+
+    def _bike_info(self, db: Session, bike_id: int):
+        """车辆编号与位置（车队状态中没有时查询数据库）"""
+        state = fleet_state.get(bike_id)
+        if state is not None:
+            return state["bike_code"], fleet_state.position(bike_id)
+        row = db.query(Bike.bike_code, Bike.current_lat, Bike.current_lng).filter(Bike.id == bike_id).first()
+        if row is None:
+            return None, None
+        position = (float(row.current_lat), float(row.current_lng)) if row.current_lat is not None else None
+        return row.bike_code, position
+
+    def _claim_failed(self, db: Session, bike_id: int) -> UnlockResult:
+        """占用失败：区分车辆不存在与车辆不是空闲"""
+        state = fleet_state.get(bike_id)
+        current = state["status"] if state is not None else None
+        if current is None or current == BikeStatus.IDLE.value:
+            # 车队状态中没有或仍显示空闲（其他请求刚占用、尚未同步）时以数据库为准
+            current = db.query(Bike.status).filter(Bike.id == bike_id).scalar()
+        if current is None:
+            return UnlockResult(reason=UNLOCK_NOT_FOUND)
+        return UnlockResult(reason=UNLOCK_UNAVAILABLE, bike_status=current)
+
+    def _record(self, start: float, reason: Optional[str]):
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.total_ms += elapsed
+            if reason is None:
+                self.unlocks += 1
+            elif reason == UNLOCK_NOT_FOUND:
+                self.not_found += 1
+            elif reason == UNLOCK_USER_RIDING:
+                self.user_riding += 1
+            else:
+                self.conflicts += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        attempts = self.unlocks + self.conflicts + self.not_found + self.user_riding
+        return {
+            "unlocks": self.unlocks,
+            "conflicts": self.conflicts,
+            "not_found": self.not_found,
+            "user_riding": self.user_riding,
+            "avg_unlock_ms": round(self.total_ms / attempts, 3) if attempts else 0.0,
+        }
+
+
+# 全局订单服务
+order_service = OrderService()
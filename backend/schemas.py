@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, validator
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 from decimal import Decimal
 
@@ -107,6 +107,8 @@ class BikeResponse(BikeBase):
     last_heartbeat: Optional[datetime]
     created_at: datetime
     updated_at: datetime
+    version: Optional[int] = Field(None, description="车队状态版本号（每次状态变更递增）")
+    online: Optional[bool] = Field(None, description="最近 HEARTBEAT_TIMEOUT_SECONDS 内是否上报过心跳/GPS")
 
     class Config:
         from_attributes = True
@@ -119,6 +121,62 @@ class BikeListResponse(BaseModel):
     items: List[BikeResponse]
 
 
+class NearbyBikeResponse(BikeResponse):
+    """附近车辆响应"""
+
+    distance_m: float = Field(..., description="与查询点的距离（米）")
+
+
+class BikeCluster(BaseModel):
+    """地图聚合簇"""
+
+    id: str = Field(..., description="瓦片标识 zoom/x/y")
+    lat: float = Field(..., description="质心纬度")
+    lng: float = Field(..., description="质心经度")
+    count: int
+    status_counts: Dict[str, int] = Field(..., description="各状态车辆数")
+
+
+class ViewportResponse(BaseModel):
+    """地图视野查询响应"""
+
+    mode: str = Field(..., description="bikes: 单车; clusters: 聚合簇")
+    zoom: int
+    total: int
+    clusters: List[BikeCluster] = []
+    bikes: List[BikeResponse] = []
+
+
+class TrajectoryPoint(BaseModel):
+    """轨迹点"""
+
+    latitude: float
+    longitude: float
+    recorded_at: Optional[datetime] = None
+
+
+class TrajectoryResponse(BaseModel):
+    """抽稀后的轨迹（按时间升序）"""
+
+    bike_id: int
+    order_id: Optional[int] = None
+    encoding: str = Field(..., description="json / polyline / delta")
+    original_count: int = Field(..., description="抽稀前的点数")
+    point_count: int = Field(..., description="抽稀后的点数")
+    tolerance_m: Optional[float] = None
+    # encoding=json
+    points: Optional[List[TrajectoryPoint]] = None
+    # encoding=polyline: Google Encoded Polyline（精度 1e-5）
+    polyline: Optional[str] = None
+    # encoding=delta: 首值 + 逐点差值，坐标乘以 precision 后取整
+    precision: Optional[int] = None
+    lat_deltas: Optional[List[int]] = None
+    lng_deltas: Optional[List[int]] = None
+    # polyline / delta: 起始时间 + 逐点时间差（秒）
+    start_time: Optional[datetime] = None
+    time_deltas: Optional[List[int]] = None
+
+
 # ========== 订单相关 Schemas ==========
 
 
@@ -143,6 +201,7 @@ class HardwareUnlockRequest(BaseModel):
     lat: float = Field(..., ge=-90, le=90, description="纬度")
     lng: float = Field(..., ge=-180, le=180, description="经度")
     bike_code: Optional[str] = Field("001", description="车辆编号，默认 001")
+    idempotency_key: Optional[str] = Field(None, max_length=64, description="幂等键，重试时携带相同的值")
 
 
 class OrderLock(BaseModel):
@@ -152,6 +211,7 @@ class OrderLock(BaseModel):
     rfid_card: str
     end_lat: float = Field(..., ge=-90, le=90)
     end_lng: float = Field(..., ge=-180, le=180)
+    idempotency_key: Optional[str] = Field(None, max_length=64, description="幂等键，重试时携带相同的值")
 
 
 class OrderResponse(BaseModel):
@@ -261,6 +321,7 @@ class DashboardStats(BaseModel):
     total_users: int
     today_orders: int
     today_revenue: float
+    online_bikes: int = 0
 
 
 # ========== 通用响应 Schemas ==========
@@ -0,0 +1,223 @@
+"""
+空间索引
+
+GridSpatialIndex - 均匀网格
+把经纬度平面按固定角度切成网格，每个格子记录其中的对象。
+位置更新时只在格子变化时移动对象，代价 O(1)；
+最近邻查询从查询点所在格子按环向外扩展，找到 k 个且下一环不可能更近时停止。
+
+TileClusterIndex - 按缩放级别的瓦片聚合
+为每个缩放级别维护 Web 墨卡托瓦片内的车辆数、坐标和与状态分布，
+车辆移动时增量更新，地图缩小时直接返回聚合结果而不是逐辆车计算。
+"""
+import heapq
+import math
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from geo_utils import haversine_m, meters_per_deg_lng, METERS_PER_DEG_LAT
+
+Cell = Tuple[int, int]
+
+
+class GridSpatialIndex:
+    """均匀网格空间索引（非线程安全，由调用方加锁）"""
+
+    def __init__(self, cell_deg: float = 0.005):
+        self.cell_deg = cell_deg
+        self._cells: Dict[Cell, Set[Hashable]] = {}
+        self._points: Dict[Hashable, Tuple[float, float, Cell]] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def cell_of(self, lat: float, lng: float) -> Cell:
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def update(self, key: Hashable, lat: float, lng: float):
+        """插入或移动对象"""
+        cell = self.cell_of(lat, lng)
+        old = self._points.get(key)
+        if old is not None and old[2] != cell:
+            self._discard(key, old[2])
+        if old is None or old[2] != cell:
+            self._cells.setdefault(cell, set()).add(key)
+        self._points[key] = (lat, lng, cell)
+
+    def remove(self, key: Hashable):
+        old = self._points.pop(key, None)
+        if old is not None:
+            self._discard(key, old[2])
+
+    def _discard(self, key: Hashable, cell: Cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self._cells[cell]
+
+    def position(self, key: Hashable) -> Optional[Tuple[float, float]]:
+        point = self._points.get(key)
+        return (point[0], point[1]) if point else None
+
+    def nearest(self, lat: float, lng: float, k: int, radius_m: float,
+                predicate: Callable[[Hashable], bool] = None) -> List[Tuple[float, Hashable]]:
+        """
+        查找半径内最近的 k 个对象，返回按距离升序的 [(距离米, key)]
+        predicate 用于过滤（例如只要空闲车辆）
+        """
+        if k <= 0 or not self._points:
+            return []
+
+        center_row, center_col = self.cell_of(lat, lng)
+        cell_h = self.cell_deg * METERS_PER_DEG_LAT
+        cell_w = self.cell_deg * meters_per_deg_lng(lat)
+        min_cell_m = min(cell_h, cell_w)
+        max_ring = int(math.ceil(radius_m / min_cell_m)) + 1
+
+        heap: List[Tuple[float, Hashable]] = []  # 最大堆（距离取负）
+        for ring in range(max_ring + 1):
+            # 第 ring 环的格子与查询点的距离至少为 (ring - 1) 个格子宽度
+            if ring > 1 and len(heap) == k and (ring - 1) * min_cell_m > -heap[0][0]:
+                break
+            for cell in self._ring_cells(center_row, center_col, ring):
+                members = self._cells.get(cell)
+                if not members:
+                    continue
+                for key in members:
+                    if predicate is not None and not predicate(key):
+                        continue
+                    p_lat, p_lng, _ = self._points[key]
+                    dist = haversine_m(lat, lng, p_lat, p_lng)
+                    if dist > radius_m:
+                        continue
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-dist, key))
+                    elif dist < -heap[0][0]:
+                        heapq.heapreplace(heap, (-dist, key))
+
+        return sorted((-neg, key) for neg, key in heap)
+
+    def within_bbox(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[Hashable]:
+        """返回矩形范围内的所有对象"""
+        row0, col0 = self.cell_of(min_lat, min_lng)
+        row1, col1 = self.cell_of(max_lat, max_lng)
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > len(self._cells):
+            cells = [cell for cell in self._cells if row0 <= cell[0] <= row1 and col0 <= cell[1] <= col1]
+        else:
+            cells = [(r, c) for r in range(row0, row1 + 1) for c in range(col0, col1 + 1)]
+
+        result = []
+        for cell in cells:
+            for key in self._cells.get(cell, ()):
+                p_lat, p_lng, _ = self._points[key]
+                if min_lat <= p_lat <= max_lat and min_lng <= p_lng <= max_lng:
+                    result.append(key)
+        return result
+
+    @staticmethod
+    def _ring_cells(row: int, col: int, ring: int):
+        if ring == 0:
+            yield (row, col)
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield (row - ring, c)
+            yield (row + ring, c)
+        for r in range(row - ring + 1, row + ring):
+            yield (r, col - ring)
+            yield (r, col + ring)
+
+
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def lnglat_to_tile(lat: float, lng: float, zoom: int) -> Tuple[int, int]:
+    """经纬度转 Web 墨卡托瓦片坐标"""
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    n = 1 << zoom
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+class TileClusterIndex:
+    """
+    瓦片聚合索引（非线程安全，由调用方加锁）
+
+    每个级别: {(x, y): [数量, 纬度和, 经度和, [各状态数量...]]}
+    只在最高级别计算一次瓦片坐标，低级别通过右移得到。
+    """
+
+    def __init__(self, min_zoom: int, max_zoom: int):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self._levels: Dict[int, Dict[Tuple[int, int], list]] = {
+            zoom: {} for zoom in range(min_zoom, max_zoom + 1)
+        }
+
+    def add(self, lat: float, lng: float, status: int):
+        tx, ty = lnglat_to_tile(lat, lng, self.max_zoom)
+        for zoom, tiles in self._levels.items():
+            shift = self.max_zoom - zoom
+            self._add(tiles, (tx >> shift, ty >> shift), lat, lng, status)
+
+    def remove(self, lat: float, lng: float, status: int):
+        tx, ty = lnglat_to_tile(lat, lng, self.max_zoom)
+        for zoom, tiles in self._levels.items():
+            shift = self.max_zoom - zoom
+            self._remove(tiles, (tx >> shift, ty >> shift), lat, lng, status)
+
+    def move(self, old_lat: float, old_lng: float, old_status: int,
+             new_lat: float, new_lng: float, new_status: int):
+        """车辆移动或状态变化；同一瓦片内只调整坐标和"""
+        ox, oy = lnglat_to_tile(old_lat, old_lng, self.max_zoom)
+        nx, ny = lnglat_to_tile(new_lat, new_lng, self.max_zoom)
+        for zoom, tiles in self._levels.items():
+            shift = self.max_zoom - zoom
+            old_key = (ox >> shift, oy >> shift)
+            new_key = (nx >> shift, ny >> shift)
+            if old_key == new_key and old_status == new_status:
+                agg = tiles[old_key]
+                agg[1] += new_lat - old_lat
+                agg[2] += new_lng - old_lng
+            else:
+                self._remove(tiles, old_key, old_lat, old_lng, old_status)
+                self._add(tiles, new_key, new_lat, new_lng, new_status)
+
+    @staticmethod
+    def _add(tiles, key, lat, lng, status):
+        agg = tiles.get(key)
+        if agg is None:
+            agg = tiles[key] = [0, 0.0, 0.0, []]
+        agg[0] += 1
+        agg[1] += lat
+        agg[2] += lng
+        counts = agg[3]
+        if status >= len(counts):
+            counts.extend([0] * (status + 1 - len(counts)))
+        counts[status] += 1
+
+    @staticmethod
+    def _remove(tiles, key, lat, lng, status):
+        agg = tiles.get(key)
+        if agg is None:
+            return
+        agg[0] -= 1
+        if agg[0] <= 0:
+            del tiles[key]
+            return
+        agg[1] -= lat
+        agg[2] -= lng
+        agg[3][status] -= 1
+
+    def clusters(self, zoom: int, min_lat: float, min_lng: float,
+                 max_lat: float, max_lng: float) -> List[Tuple[Tuple[int, int], list]]:
+        """返回指定级别下与矩形相交的瓦片聚合 [((x, y), 聚合)]"""
+        zoom = max(self.min_zoom, min(self.max_zoom, zoom))
+        tiles = self._levels[zoom]
+        x0, y0 = lnglat_to_tile(max_lat, min_lng, zoom)  # 瓦片 y 轴向南递增
+        x1, y1 = lnglat_to_tile(min_lat, max_lng, zoom)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(tiles):
+            return [(key, agg) for key, agg in tiles.items()
+                    if x0 <= key[0] <= x1 and y0 <= key[1] <= y1]
+        return [((x, y), tiles[(x, y)]) for x in range(x0, x1 + 1)
+                for y in range(y0, y1 + 1) if (x, y) in tiles]
@@ -0,0 +1,202 @@
+"""
+WebSocket 订阅索引 - 按车辆、地理范围和消息类型路由推送
+
+客户端可以订阅：
+- topics: 消息类型（heartbeat / gps / auth / event），不填表示全部
+- bike_ids: 指定车辆
+- bbox: 地理范围 [min_lng, min_lat, max_lng, max_lat]
+bike_ids 与 bbox 满足其一即可；两者都不填表示全部车辆。
+领域事件（event）中与车辆无关的（如余额变化）只推送给不限车辆的订阅。
+
+路由时不逐个检查订阅条件：
+- 不限车辆的订阅按消息类型建索引
+- 指定车辆的订阅按 bike_id 建索引
+- 地理范围订阅登记到其覆盖的粗粒度网格，消息只需检查所在网格内的订阅
+  （覆盖网格过多的大范围订阅单独存放，逐条检查）
+"""
+import math
+from typing import Dict, Hashable, Iterable, Optional, Set, Tuple
+
+BBox = Tuple[float, float, float, float]  # min_lng, min_lat, max_lng, max_lat
+Cell = Tuple[int, int]
+
+TOPIC_KINDS = ("heartbeat", "gps", "auth", "event")
+
+MAX_BBOX_CELLS = 1024
+
+
+class Subscription:
+    """单个客户端的订阅条件"""
+
+    __slots__ = ("kinds", "bike_ids", "bbox")
+
+    def __init__(self, kinds: Iterable[str] = None, bike_ids: Iterable[int] = None, bbox: BBox = None):
+        self.kinds: Optional[Set[str]] = set(kinds) if kinds else None
+        self.bike_ids: Optional[Set[int]] = set(bike_ids) if bike_ids else None
+        self.bbox: Optional[BBox] = tuple(bbox) if bbox else None
+
+    @property
+    def unfiltered(self) -> bool:
+        """不限车辆"""
+        return self.bike_ids is None and self.bbox is None
+
+    def accepts_kind(self, kind: str) -> bool:
+        return self.kinds is None or kind in self.kinds
+
+    def in_bbox(self, lat: Optional[float], lng: Optional[float]) -> bool:
+        if self.bbox is None or lat is None or lng is None:
+            return False
+        min_lng, min_lat, max_lng, max_lat = self.bbox
+        return min_lat <= lat <= max_lat and min_lng <= lng <= max_lng
+
+    def matches(self, kind: str, bike_id: Optional[int], lat: Optional[float], lng: Optional[float]) -> bool:
+        """单独判断一条消息是否符合订阅（路由请用 SubscriptionIndex.match）"""
+        if not self.accepts_kind(kind):
+            return False
+        return self.unfiltered or (bool(self.bike_ids) and bike_id in self.bike_ids) or self.in_bbox(lat, lng)
+
+    def to_dict(self) -> dict:
+        return {
+            "topics": sorted(self.kinds) if self.kinds else None,
+            "bike_ids": sorted(self.bike_ids) if self.bike_ids else None,
+            "bbox": list(self.bbox) if self.bbox else None,
+        }
+
+
+class SubscriptionIndex:
+    """订阅索引（非线程安全，在事件循环线程中使用）"""
+
+    def __init__(self, cell_deg: float = 0.05):
+        self.cell_deg = cell_deg
+        self._subs: Dict[Hashable, Subscription] = {}
+        self._unfiltered_all: Set[Hashable] = set()  # 不限车辆、不限类型
+        self._unfiltered_by_kind: Dict[str, Set[Hashable]] = {}  # 不限车辆、限定类型
+        self._by_bike: Dict[int, Set[Hashable]] = {}
+        self._by_cell: Dict[Cell, Set[Hashable]] = {}
+        self._large_bbox: Set[Hashable] = set()
+
+    def __len__(self) -> int:
+        return len(self._subs)
+
+    def get(self, key: Hashable) -> Optional[Subscription]:
+        return self._subs.get(key)
+
+    def set(self, key: Hashable, sub: Subscription):
+        """设置（替换）客户端的订阅"""
+        self.remove(key)
+        self._subs[key] = sub
+        if sub.unfiltered:
+            if sub.kinds is None:
+                self._unfiltered_all.add(key)
+            else:
+                for kind in sub.kinds:
+                    self._unfiltered_by_kind.setdefault(kind, set()).add(key)
+            return
+        for bike_id in sub.bike_ids or ():
+            self._by_bike.setdefault(bike_id, set()).add(key)
+        if self._is_large(sub.bbox):
+            self._large_bbox.add(key)
+        else:
+            for cell in self._bbox_cells(sub.bbox):
+                self._by_cell.setdefault(cell, set()).add(key)
+
+    def remove(self, key: Hashable):
+        sub = self._subs.pop(key, None)
+        if sub is None:
+            return
+        self._unfiltered_all.discard(key)
+        for kind in sub.kinds or ():
+            self._discard(self._unfiltered_by_kind, kind, key)
+        for bike_id in sub.bike_ids or ():
+            self._discard(self._by_bike, bike_id, key)
+        if key in self._large_bbox:
+            self._large_bbox.discard(key)
+        else:
+            for cell in self._bbox_cells(sub.bbox):
+                self._discard(self._by_cell, cell, key)
+
+    @staticmethod
+    def _discard(index: dict, bucket, key: Hashable):
+        members = index.get(bucket)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del index[bucket]
+
+    def _cell_of(self, lat: float, lng: float) -> Cell:
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def _is_large(self, bbox: Optional[BBox]) -> bool:
+        if bbox is None:
+            return False
+        row0, col0 = self._cell_of(bbox[1], bbox[0])
+        row1, col1 = self._cell_of(bbox[3], bbox[2])
+        return (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_BBOX_CELLS
+
+    def _bbox_cells(self, bbox: Optional[BBox]):
+        if bbox is None:
+            return
+        min_lng, min_lat, max_lng, max_lat = bbox
+        row0, col0 = self._cell_of(min_lat, min_lng)
+        row1, col1 = self._cell_of(max_lat, max_lng)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                yield (row, col)
+
+    def unfiltered_all(self) -> Set[Hashable]:
+        """接收全部消息的客户端"""
+        return set(self._unfiltered_all)
+
+    def match(self, kind: str, bike_id: Optional[int], lat: float = None, lng: float = None,
+              include_all: bool = True) -> Set[Hashable]:
+        """返回应收到该消息的客户端；include_all=False 时不含接收全部消息的客户端"""
+        result = set(self._unfiltered_all) if include_all else set()
+        kind_subs = self._unfiltered_by_kind.get(kind)
+        if kind_subs:
+            result |= kind_subs
+
+        if bike_id is not None:
+            for key in self._by_bike.get(bike_id, ()):
+                if self._subs[key].accepts_kind(kind):
+                    result.add(key)
+        if lat is not None and lng is not None:
+            for candidates in (self._by_cell.get(self._cell_of(lat, lng), ()), self._large_bbox):
+                for key in candidates:
+                    if key not in result:
+                        sub = self._subs[key]
+                        if sub.accepts_kind(kind) and sub.in_bbox(lat, lng):
+                            result.add(key)
+        return result
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {
+            "subscriptions": len(self._subs),
+            "unfiltered": len(self._unfiltered_all) + sum(len(v) for v in self._unfiltered_by_kind.values()),
+            "indexed_bikes": len(self._by_bike),
+            "indexed_cells": len(self._by_cell),
+            "large_bbox": len(self._large_bbox),
+        }
+
+
+def parse_subscription(message: dict) -> Subscription:
+    """解析客户端的订阅请求，格式错误时抛出 ValueError"""
+    kinds = message.get("topics")
+    if kinds is not None:
+        if not isinstance(kinds, list) or any(kind not in TOPIC_KINDS for kind in kinds):
+            raise ValueError(f"topics 只能包含 {', '.join(TOPIC_KINDS)}")
+
+    bike_ids = message.get("bike_ids")
+    if bike_ids is not None:
+        if not isinstance(bike_ids, list):
+            raise ValueError("bike_ids 必须是数组")
+        bike_ids = [int(bike_id) for bike_id in bike_ids]
+
+    bbox = message.get("bbox")
+    if bbox is not None:
+        if not isinstance(bbox, list) or len(bbox) != 4:
+            raise ValueError("bbox 格式应为 [min_lng, min_lat, max_lng, max_lat]")
+        bbox = [float(v) for v in bbox]
+        if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError("bbox 范围无效")
+
+    return Subscription(kinds, bike_ids, bbox)
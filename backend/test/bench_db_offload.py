@@ -0,0 +1,276 @@
+"""
+数据库路由基准测试 - 在事件循环中查询 vs 在线程池中查询
+
+在本进程内启动完整的后端应用（uvicorn + main:app，临时 SQLite 数据库），
+用 SQLAlchemy 的 before_cursor_execute 事件给每条 SQL 加上固定延迟，模拟 MySQL 往返。
+压测客户端运行在独立的子进程中，按并发数持续请求订单列表，对比两种执行方式：
+- loop:   async def 路由直接调用同步会话（改造前的写法，查询期间事件循环被阻塞）
+- thread: @db_route 路由（现在的写法，在数据库线程池中执行，并发上限 DB_THREADPOOL_SIZE）
+
+每档测量：
+1. 订单列表的吞吐与延迟分位数
+2. 同时请求 /health（不访问数据库）的延迟：查询阻塞事件循环时它也会被拖慢
+3. 事件循环延迟（每 10ms 一次的定时器超时量），即 WebSocket 推送会被推迟的时间
+
+loop 方式下并发超过连接池容量时，事件循环阻塞在等待连接上，而归还连接的会话关闭
+又需要事件循环调度，直到 DB_POOL_TIMEOUT 超时才恢复，表现为吞吐归零、请求报错。
+
+运行: python test/bench_db_offload.py [--concurrency 1,10,50] [--db-latency-ms 20] [--modes loop,thread] [--duration 5]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+LAG_INTERVAL = 0.01  # 事件循环延迟的采样间隔（秒）
+HEALTH_INTERVAL = 0.02  # /health 探测间隔（秒）
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    n = len(values)
+
+    def pick(q):
+        return round(values[min(n - 1, int(q * n))], 2)
+
+    return {"count": n, "p50": pick(0.50), "p99": pick(0.99), "max": round(values[-1], 2)}
+
+
+# ========== 客户端进程 ==========
+
+
+async def _load(base_url: str, path: str, concurrency: int, duration: float) -> dict:
+    import httpx
+
+    latencies, health, errors = [], [], 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    # /health 使用独立的连接，不与压测请求争用连接池
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client, \
+            httpx.AsyncClient(base_url=base_url, timeout=30) as probe_client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                if response.status_code == 200:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                else:
+                    errors += 1
+
+        async def probe():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    await probe_client.get("/health")
+                except httpx.HTTPError:
+                    continue
+                health.append((time.perf_counter() - start) * 1000)
+                await asyncio.sleep(HEALTH_INTERVAL)
+
+        await asyncio.gather(probe(), *(worker() for _ in range(concurrency)))
+
+    return {"latencies": latencies, "health": health, "errors": errors}
+
+
+def load_client(base_url: str, path: str, concurrency: int, duration: float) -> dict:
+    return asyncio.run(_load(base_url, path, concurrency, duration))
+
+
+# ========== 服务端 ==========
+
+
+class LoopLagMonitor:
+    """事件循环延迟：定时器实际唤醒时间与预期的差值"""
+
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append((time.perf_counter() - start - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def take(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+def seed_database(users: int, orders: int):
+    """在临时 SQLite 数据库中建表并写入用户、车辆和已完成订单"""
+    from decimal import Decimal
+    from database import engine, Base, SessionLocal
+    from models import Bike, Order, User
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        db.add_all([
+            User(id=i, username=f"user{i}", rfid_card=f"CARD{i}", balance=Decimal("50.00"),
+                 created_at=now, updated_at=now)
+            for i in range(1, users + 1)
+        ])
+        db.add_all([
+            Bike(id=i, bike_code=f"{i:03d}", status="idle", battery=90,
+                 current_lat=30.27, current_lng=120.15, created_at=now, updated_at=now)
+            for i in range(1, users + 1)
+        ])
+        db.add_all([
+            Order(user_id=i % users + 1, bike_id=i % users + 1, start_time=now, end_time=now,
+                  duration_minutes=5, cost=Decimal("1.00"), status="completed", created_at=now)
+            for i in range(orders)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def add_db_latency(seconds: float):
+    """每条 SQL 执行前等待固定时间（模拟数据库往返，等待期间释放 GIL，与真实网络 IO 一致）"""
+    from sqlalchemy import event
+    from database import engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _delay(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(seconds)
+
+
+def add_loop_route(app):
+    """改造前的写法：async def 路由在事件循环中直接执行同步查询（调用 @db_route 包装前的函数）"""
+    from fastapi import Depends
+    from sqlalchemy.orm import Session
+    from database import get_db
+    from main import get_orders
+
+    @app.get("/bench/orders-on-loop")
+    async def orders_on_loop(skip: int = 0, limit: int = 20, db: Session = Depends(get_db)):
+        return get_orders.__wrapped__(db, skip=skip, limit=limit)
+
+
+async def run(args) -> list:
+    import uvicorn
+    import logging
+    from config import settings
+
+    seed_database(args.users, args.orders)
+    add_db_latency(args.db_latency_ms / 1000)
+    from main import app
+    add_loop_route(app)
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning", backlog=4096)
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    loop = asyncio.get_running_loop()
+    lag = LoopLagMonitor()
+    lag.start()
+    base_url = f"http://127.0.0.1:{args.port}"
+    paths = {"loop": "/bench/orders-on-loop?limit=20", "thread": "/api/orders?limit=20"}
+
+    results = []
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            for concurrency in args.concurrency:
+                for mode in args.modes:
+                    await asyncio.sleep(1.0)  # 上一档阻塞事件循环时积压的定时器不计入本档
+                    lag.take()
+                    stats = await loop.run_in_executor(
+                        executor, load_client, base_url, paths[mode], concurrency, args.duration,
+                    )
+                    row = {
+                        "mode": mode,
+                        "concurrency": concurrency,
+                        "threadpool": settings.db_threadpool_size,
+                        "rps": round(len(stats["latencies"]) / args.duration, 1),
+                        "errors": stats["errors"],
+                        "latency_ms": percentiles(stats["latencies"]),
+                        "health_ms": percentiles(stats["health"]),
+                        "loop_lag_ms": percentiles(lag.take()),
+                    }
+                    results.append(row)
+                    print_row(row)
+        finally:
+            lag.stop()
+            server.should_exit = True
+            await server_task
+    return results
+
+
+HEADER = (
+    f"{'方式':>6}{'并发':>6}{'吞吐':>9}{'p50':>9}{'p99':>9}"
+    f"{'health p50':>12}{'health p99':>12}{'循环p99':>10}{'循环max':>10}{'错误':>6}"
+)
+
+
+def print_row(r: dict):
+    latency, health, lag = r["latency_ms"], r["health_ms"], r["loop_lag_ms"]
+    print(
+        f"{r['mode']:>8}{r['concurrency']:>7}{r['rps']:>9.0f}"
+        f"{latency.get('p50', 0):>7.1f}ms{latency.get('p99', 0):>7.1f}ms"
+        f"{health.get('p50', 0):>10.1f}ms{health.get('p99', 0):>10.1f}ms"
+        f"{lag.get('p99', 0):>8.1f}ms{lag.get('max', 0):>8.1f}ms{r['errors']:>6}",
+        flush=True,
+    )
+
+
+def parse_args():
+    def int_list(value):
+        return [int(v) for v in value.split(",") if v]
+
+    parser = argparse.ArgumentParser(description="数据库路由基准测试")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 10, 50], help="并发请求数，逗号分隔")
+    parser.add_argument("--modes", type=lambda v: v.split(","), default=["loop", "thread"], help="loop,thread")
+    parser.add_argument("--db-latency-ms", type=float, default=20.0, help="每条 SQL 的模拟往返延迟（毫秒）")
+    parser.add_argument("--duration", type=float, default=5.0, help="每档压测时长（秒）")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=18766)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # 须在导入 config 之前设置：独立的临时数据库，不连接真实的 broker，单进程模式
+    workdir = tempfile.mkdtemp(prefix="bench_db_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["MQTT_BROKER"] = "127.0.0.1"
+    os.environ["MQTT_PORT"] = "1"
+    os.environ["EVENT_BUS_ENABLED"] = "false"
+
+    print("=" * 100)
+    print(f"数据库路由基准: 每条 SQL 延迟 {args.db_latency_ms:.0f}ms, 每档 {args.duration:.0f} 秒")
+    print("=" * 100)
+    print(HEADER)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+心跳超时检测基准测试 - 时间轮 vs 全表扫描
+
+用模拟时钟驱动 10 万辆车按固定周期上报心跳，其中一部分车辆中途停止上报、
+之后部分恢复，测量：
+1. 收到心跳时续期（touch）的开销
+2. 时间轮每格处理耗时，与每次扫描全部车辆最后心跳时间的开销对比
+3. 判定正确性：停报车辆在 超时时长 ~ 超时时长 + 格长 内判定离线，
+   正常上报的车辆不会被误判，恢复上报的车辆判定为重新上线
+
+运行: python test/bench_heartbeat_monitor.py [车辆数] [模拟秒数]
+"""
+import os
+import sys
+import time
+import random
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fleet_state import fleet_state
+from heartbeat_monitor import HeartbeatMonitor
+from models import Bike
+
+REPORT_INTERVAL = 10.0  # 心跳周期（秒）
+TIMEOUT = 30.0
+TICK = 1.0
+SILENT_RATIO = 0.02  # 中途停止上报的车辆比例
+RESUME_AT = 90.0  # 一半停报车辆在此时刻恢复上报
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    bike_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 120.0
+    random.seed(7)
+
+    now = datetime.now()
+    for bike_id in range(1, bike_count + 1):
+        fleet_state.upsert_bike(Bike(
+            id=bike_id, bike_code=f"{bike_id:06d}", status="idle",
+            current_lat=30.2741, current_lng=120.1551, battery=100,
+            last_heartbeat=None, created_at=now, updated_at=now,
+        ))
+    fleet_state.ready = True
+
+    # 每辆车的上报相位；停报车辆在 [10, 50) 秒内的某一时刻停止上报
+    phase = {bike_id: random.uniform(0, REPORT_INTERVAL) for bike_id in range(1, bike_count + 1)}
+    silent = random.sample(range(1, bike_count + 1), int(bike_count * SILENT_RATIO))
+    silent_at = {bike_id: random.uniform(10, 50) for bike_id in silent}
+    resumed = set(silent[: len(silent) // 2])
+
+    def reporting(bike_id, t):
+        stop = silent_at.get(bike_id)
+        if stop is None or t < stop:
+            return True
+        return bike_id in resumed and t >= RESUME_AT
+
+    # 按格预先排好上报事件: 格序号 -> [(时刻, bike_id)]
+    steps = int(duration / TICK)
+    schedule = [[] for _ in range(steps)]
+    for bike_id, offset in phase.items():
+        t = offset
+        while t < duration:
+            if reporting(bike_id, t):
+                schedule[int(t / TICK)].append((t, bike_id))
+            t += REPORT_INTERVAL
+
+    monitor = HeartbeatMonitor(timeout=TIMEOUT, tick=TICK)
+    clock = {"now": 0.0}
+    offline_at = {}
+    online_again = set()
+    last_seen = {}
+
+    def listener(bike_id, online, seen):
+        if online:
+            if bike_id in offline_at:
+                online_again.add(bike_id)
+        else:
+            offline_at[bike_id] = (clock["now"], seen)
+
+    monitor.load([], now=0.0)
+    monitor._listener = listener  # 模拟时钟下不启动后台任务，手动转动时间轮
+
+    touch_time = 0.0
+    touches = 0
+    tick_ms = []
+    scan_ms = []
+    for step in range(steps):
+        for t, bike_id in schedule[step]:
+            t0 = time.perf_counter()
+            monitor.touch(bike_id, now=t)
+            touch_time += time.perf_counter() - t0
+            touches += 1
+            last_seen[bike_id] = t
+
+        clock["now"] = (step + 1) * TICK
+        t0 = time.perf_counter()
+        monitor.advance(now=clock["now"])
+        tick_ms.append((time.perf_counter() - t0) * 1000)
+
+        # 对照：每格扫描全部车辆的最后心跳时间
+        t0 = time.perf_counter()
+        cutoff = clock["now"] - TIMEOUT
+        sum(1 for seen in last_seen.values() if seen <= cutoff)
+        scan_ms.append((time.perf_counter() - t0) * 1000)
+
+    # 正确性
+    expected_offline = {
+        bike_id for bike_id in silent
+        if silent_at[bike_id] + TIMEOUT + REPORT_INTERVAL < min(duration, RESUME_AT)
+    }
+    false_offline = [bike_id for bike_id in offline_at if bike_id not in silent_at]
+    missed = [bike_id for bike_id in expected_offline if bike_id not in offline_at]
+    late = [
+        bike_id for bike_id, (detected, seen) in offline_at.items()
+        if not (seen + TIMEOUT <= detected <= seen + TIMEOUT + TICK)
+    ]
+    expected_online = {bike_id for bike_id in resumed if bike_id in offline_at and duration > RESUME_AT + REPORT_INTERVAL}
+    missed_online = expected_online - online_again
+
+    print("=" * 60)
+    print(f"心跳超时检测基准: {bike_count} 辆车，模拟 {duration:.0f} 秒，"
+          f"超时 {TIMEOUT:.0f}s，格长 {TICK:.0f}s")
+    print("=" * 60)
+    print(f"  续期: {touches:,} 次，平均 {touch_time / touches * 1e6:.2f}us/次")
+    print(f"  时间轮每格: p50={percentile(tick_ms, 50):.3f}ms "
+          f"p99={percentile(tick_ms, 99):.3f}ms max={max(tick_ms):.3f}ms")
+    print(f"  全表扫描每格: p50={percentile(scan_ms, 50):.3f}ms "
+          f"p99={percentile(scan_ms, 99):.3f}ms max={max(scan_ms):.3f}ms")
+    print(f"  重新放回时间轮: {monitor.rearmed:,} 次")
+    print(f"  判定离线: {len(offline_at)}（停报 {len(silent)}，应判定 {len(expected_offline)}）")
+    print(f"  误判离线: {len(false_offline)}，漏判: {len(missed)}，判定时刻超出范围: {len(late)}")
+    print(f"  重新上线: {len(online_again)}（应判定 {len(expected_online)}，漏判 {len(missed_online)}）")
+    print(f"  当前在线: {fleet_state.online_count()}（时间轮 {len(monitor._deadline)}）")
+    ok = not false_offline and not missed and not late and not missed_online
+    print(f"  结果: {'通过' if ok else '失败'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+附近车辆查询基准测试 - 网格空间索引
+
+在约 30km x 30km 范围内随机生成车辆，测量：
+1. 位置更新吞吐（模拟 GPS 上报）
+2. k 近邻查询的 p50/p99 延迟
+3. 与暴力扫描结果对比，验证正确性
+
+运行: python test/bench_spatial_index.py [车辆数] [查询次数]
+"""
+import os
+import sys
+import time
+import random
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fleet_state import FleetStateStore
+from geo_utils import haversine_m
+from models import Bike
+
+CENTER_LAT = 30.2741  # 杭州
+CENTER_LNG = 120.1551
+SPAN_DEG = 0.27  # 约 30km
+
+
+def random_point():
+    return (
+        CENTER_LAT + random.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+        CENTER_LNG + random.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+    )
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    bike_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    query_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+    random.seed(7)
+    statuses = ["idle"] * 7 + ["riding"] * 2 + ["fault"]
+
+    store = FleetStateStore()
+    now = datetime.now()
+    start = time.perf_counter()
+    for bike_id in range(1, bike_count + 1):
+        lat, lng = random_point()
+        store.upsert_bike(Bike(
+            id=bike_id, bike_code=f"{bike_id:06d}", status=random.choice(statuses),
+            current_lat=lat, current_lng=lng, battery=100,
+            last_heartbeat=now, created_at=now, updated_at=now,
+        ))
+    print("=" * 60)
+    print(f"附近车辆查询基准: {bike_count} 辆车")
+    print("=" * 60)
+    print(f"  加载耗时: {time.perf_counter() - start:.2f}s")
+
+    # 位置更新吞吐
+    updates = [(random.randint(1, bike_count), *random_point()) for _ in range(200_000)]
+    start = time.perf_counter()
+    for bike_id, lat, lng in updates:
+        store.apply(bike_id, current_lat=lat, current_lng=lng)
+    elapsed = time.perf_counter() - start
+    print(f"  位置更新: {len(updates) / elapsed:,.0f} 次/秒")
+
+    # 查询延迟
+    for radius, k in [(500, 10), (1000, 10), (3000, 20)]:
+        latencies = []
+        for _ in range(query_count):
+            lat, lng = random_point()
+            t0 = time.perf_counter()
+            store.nearby(lat, lng, radius, k, "idle")
+            latencies.append((time.perf_counter() - t0) * 1000)
+        print(
+            f"  radius={radius:>5}m k={k:>2}: "
+            f"p50={percentile(latencies, 50):.3f}ms "
+            f"p99={percentile(latencies, 99):.3f}ms "
+            f"max={max(latencies):.3f}ms"
+        )
+
+    # 正确性校验
+    points = {}
+    for bike_id in range(1, bike_count + 1):
+        row = store.get(bike_id)
+        points[bike_id] = (row["current_lat"], row["current_lng"], row["status"])
+    mismatches = 0
+    for _ in range(50):
+        lat, lng = random_point()
+        expected = sorted(
+            (haversine_m(lat, lng, p_lat, p_lng), bike_id)
+            for bike_id, (p_lat, p_lng, status) in points.items()
+            if status == "idle"
+        )
+        expected = [bike_id for dist, bike_id in expected if dist <= 1000][:10]
+        actual = [row["id"] for row in store.nearby(lat, lng, 1000, 10, "idle")]
+        if actual != expected:
+            mismatches += 1
+    print(f"  正确性校验: 50 次查询中 {mismatches} 次与暴力扫描不一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+轨迹写入管道基准测试 - GPS 轨迹点批量写入 bike_trajectories
+
+使用 .env / DATABASE_URL 配置的数据库（目标为 MySQL），
+多个线程模拟 MQTT 工作线程并发追加轨迹点，测量端到端写入吞吐
+（从第一个点追加到最后一个点落库）。目标: ≥ 10k 点/秒。
+
+测试数据 mode 为 "bench"，结束后自动删除。数据库为空时自动建表，
+并临时写入 BENCH 开头的测试车辆（结束后同样删除）。
+
+运行: python test/bench_trajectory_writer.py [点数] [生产线程数] [批量大小]
+"""
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sqlalchemy import delete, select
+
+from config import settings
+from database import engine, Base
+from models import Bike, BikeTrajectory
+from trajectory_writer import TrajectoryWriter
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    producers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else settings.TRAJECTORY_BATCH_SIZE
+
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        bike_ids = [row[0] for row in conn.execute(select(Bike.id))]
+    seeded = not bike_ids
+    if seeded:
+        with engine.begin() as conn:
+            conn.execute(Bike.__table__.insert(), [{"bike_code": f"BENCH{i:03d}"} for i in range(100)])
+            bike_ids = [row[0] for row in conn.execute(select(Bike.id))]
+
+    writer = TrajectoryWriter(batch_size=batch_size, max_pending=total)
+    per_thread = total // producers
+
+    def produce():
+        rnd = random.Random()
+        for _ in range(per_thread):
+            writer.append(
+                rnd.choice(bike_ids),
+                30.27 + rnd.uniform(-0.1, 0.1),
+                120.15 + rnd.uniform(-0.1, 0.1),
+                "bench",
+            )
+
+    print("=" * 60)
+    print(f"轨迹写入基准: {per_thread * producers} 个点, {producers} 个生产线程, 批量 {batch_size}")
+    print(f"数据库: {engine.url.render_as_string(hide_password=True)}")
+    print("=" * 60)
+
+    writer.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=produce) for _ in range(producers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    append_elapsed = time.perf_counter() - start
+
+    while writer.rows_written + writer.dropped < per_thread * producers and writer.failed_flushes == 0:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    writer.stop()
+
+    metrics = writer.get_metrics()
+    print(f"  追加耗时: {append_elapsed:.2f}s ({metrics['received'] / append_elapsed:,.0f} 点/秒)")
+    print(f"  落库耗时: {elapsed:.2f}s ({metrics['rows_written'] / elapsed:,.0f} 点/秒)")
+    print(f"  写入批次: {metrics['flush_count']}, 平均每批 {metrics['rows_written'] / max(metrics['flush_count'], 1):,.0f} 点")
+    print(f"  失败批次: {metrics['failed_flushes']}, 丢弃: {metrics['dropped']}")
+
+    with engine.begin() as conn:
+        conn.execute(delete(BikeTrajectory.__table__).where(BikeTrajectory.mode == "bench"))
+        if seeded:
+            conn.execute(delete(Bike.__table__).where(Bike.bike_code.like("BENCH%")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+开锁并发基准测试 - 先查询后更新 vs 条件 UPDATE
+
+在临时 SQLite 数据库上用多个线程并发开锁（每条 SQL 加固定延迟模拟数据库往返），对比：
+- legacy: 改造前的写法：查询用户、查询车辆、Python 中判断状态、INSERT 订单、更新车辆、提交、刷新订单
+- atomic: OrderService.unlock：查询用户后，条件 UPDATE 占用车辆 + INSERT 订单 + 提交
+
+两种方式都受 orders.active_user_id 唯一约束保护，legacy 同一用户的第二个订单提交失败（计为错误）
+
+测量：
+1. 抢同一辆车：每轮所有线程同时开锁同一辆空闲车，统计一轮中成功的订单数（正确应为 1）
+2. 同一用户多辆车：每轮所有线程用同一张卡同时开锁不同的车，统计该用户进行中的订单数（正确应为 1）
+3. 持续争用：线程在少量车辆上反复开锁（成功后立即还车），统计开锁吞吐、延迟分位数
+   和每次成功开锁的 SQL 往返次数
+
+运行: python test/bench_unlock_contention.py [--threads 16] [--bikes 8] [--rounds 50] [--duration 5] [--db-latency-ms 2]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class StatementCounter:
+    """按线程统计执行的 SQL 条数，并给每条 SQL 加固定延迟"""
+
+    def __init__(self, engine, latency: float):
+        from sqlalchemy import event
+
+        self._local = threading.local()
+        self.latency = latency
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            self._local.count = getattr(self._local, "count", 0) + 1
+            if self.latency:
+                time.sleep(self.latency)
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self) -> int:
+        return getattr(self._local, "count", 0)
+
+
+def seed_database(bikes: int, users: int):
+    from database import engine, Base, SessionLocal
+    from models import Bike, User
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        db.add_all([
+            Bike(id=i, bike_code=f"{i:03d}", status="idle", battery=90,
+                 current_lat=30.27, current_lng=120.15, created_at=now, updated_at=now)
+            for i in range(1, bikes + 1)
+        ])
+        db.add_all([
+            User(id=i, username=f"user{i}", rfid_card=f"CARD{i}", balance=Decimal("50.00"),
+                 status="active", created_at=now, updated_at=now)
+            for i in range(1, users + 1)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def reset_database():
+    """所有车辆恢复空闲，删除全部订单"""
+    from sqlalchemy import delete, update
+    from active_orders import active_orders
+    from database import SessionLocal
+    from models import Bike, Order
+
+    db = SessionLocal()
+    try:
+        db.execute(delete(Order))
+        db.execute(update(Bike).values(status="idle"))
+        db.commit()
+        active_orders.load(db)
+    finally:
+        db.close()
+
+
+def legacy_unlock(db, rfid_card: str, bike_id: int) -> bool:
+    """改造前 /api/orders/unlock 的数据库访问"""
+    from models import Bike, BikeStatus, Order, OrderStatus, User
+
+    user = db.query(User).filter(User.rfid_card == rfid_card).first()
+    bike = db.query(Bike).filter(Bike.id == bike_id).first()
+    if not bike or bike.status != BikeStatus.IDLE.value:
+        return False
+    order = Order(user_id=user.id, bike_id=bike.id, start_time=datetime.now(),
+                  start_lat=30.27, start_lng=120.15, status=OrderStatus.ACTIVE.value)
+    db.add(order)
+    bike.status = BikeStatus.RIDING.value
+    bike.current_lat = 30.27
+    bike.current_lng = 120.15
+    db.commit()
+    db.refresh(order)
+    return True
+
+
+def atomic_unlock(db, rfid_card: str, bike_id: int) -> bool:
+    """现在 /api/orders/unlock 的数据库访问"""
+    from models import User
+    from order_service import order_service
+
+    user = db.query(User).filter(User.rfid_card == rfid_card).first()
+    return order_service.unlock(db, user.id, bike_id, 30.27, 120.15).success
+
+
+def release(db, bike_id: int):
+    """还车（两种方式相同，不计入统计）"""
+    from sqlalchemy import update
+    from active_orders import active_orders
+    from models import Bike, Order
+
+    order = db.query(Order.id, Order.user_id).filter(Order.bike_id == bike_id, Order.status == "active").first()
+    db.execute(update(Order).where(Order.bike_id == bike_id, Order.status == "active").values(status="completed"))
+    db.execute(update(Bike).where(Bike.id == bike_id).values(status="idle"))
+    db.commit()
+    if order is not None:
+        active_orders.finish(bike_id, order.id, order.user_id)
+
+
+def active_orders_per_bike():
+    from sqlalchemy import func
+    from database import SessionLocal
+    from models import Order
+
+    db = SessionLocal()
+    try:
+        return dict(
+            db.query(Order.bike_id, func.count(Order.id))
+            .filter(Order.status == "active")
+            .group_by(Order.bike_id)
+            .all()
+        )
+    finally:
+        db.close()
+
+
+def race_same_bike(unlock, threads: int, rounds: int, users: int) -> dict:
+    """每轮所有线程同时开锁 1 号车，统计成功数"""
+    from database import SessionLocal
+
+    winners = []
+    for _ in range(rounds):
+        reset_database()
+        barrier = threading.Barrier(threads)
+        successes = []
+
+        def tap(index):
+            db = SessionLocal()
+            try:
+                barrier.wait()
+                if unlock(db, f"CARD{index % users + 1}", 1):
+                    successes.append(index)
+            except Exception:
+                db.rollback()
+            finally:
+                db.close()
+
+        workers = [threading.Thread(target=tap, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        winners.append(active_orders_per_bike().get(1, 0))
+    return {
+        "rounds": rounds,
+        "double_unlock_rounds": sum(1 for count in winners if count > 1),
+        "max_orders_per_round": max(winners),
+    }
+
+
+def race_same_user(unlock, threads: int, rounds: int, bikes: int) -> dict:
+    """每轮所有线程用 CARD1 同时开锁不同的车，统计用户 1 进行中的订单数"""
+    from sqlalchemy import func
+    from database import SessionLocal
+    from models import Order
+
+    winners = []
+    for _ in range(rounds):
+        reset_database()
+        barrier = threading.Barrier(threads)
+
+        def tap(index):
+            db = SessionLocal()
+            try:
+                barrier.wait()
+                unlock(db, "CARD1", index % bikes + 1)
+            except Exception:
+                db.rollback()
+            finally:
+                db.close()
+
+        workers = [threading.Thread(target=tap, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        db = SessionLocal()
+        try:
+            winners.append(
+                db.query(func.count(Order.id)).filter(Order.user_id == 1, Order.status == "active").scalar()
+            )
+        finally:
+            db.close()
+    return {
+        "rounds": rounds,
+        "double_ride_rounds": sum(1 for count in winners if count > 1),
+        "max_orders_per_round": max(winners),
+    }
+
+
+def sustained(unlock, counter: StatementCounter, threads: int, bikes: int, users: int, duration: float) -> dict:
+    """线程在 bikes 辆车上反复开锁，成功后立即还车"""
+    from database import SessionLocal
+
+    reset_database()
+    lock = threading.Lock()
+    latencies, statements = [], []
+    totals = {"attempts": 0, "unlocks": 0, "errors": 0}
+    deadline = time.perf_counter() + duration
+
+    def run(index):
+        rng = random.Random(index)
+        local_latencies, local_statements = [], []
+        attempts = unlocks = errors = 0
+        while time.perf_counter() < deadline:
+            bike_id = rng.randint(1, bikes)
+            db = SessionLocal()
+            try:
+                counter.reset()
+                start = time.perf_counter()
+                ok = unlock(db, f"CARD{rng.randint(1, users)}", bike_id)
+                local_latencies.append((time.perf_counter() - start) * 1000)
+                attempts += 1
+                if ok:
+                    unlocks += 1
+                    local_statements.append(counter.count)
+                    release(db, bike_id)
+            except Exception:
+                errors += 1
+                db.rollback()
+            finally:
+                db.close()
+        with lock:
+            latencies.extend(local_latencies)
+            statements.extend(local_statements)
+            totals["attempts"] += attempts
+            totals["unlocks"] += unlocks
+            totals["errors"] += errors
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {
+        **totals,
+        "unlocks_per_sec": totals["unlocks"] / duration,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "statements_per_unlock": sum(statements) / len(statements) if statements else 0.0,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="开锁并发基准测试")
+    parser.add_argument("--threads", type=int, default=16, help="并发线程数")
+    parser.add_argument("--bikes", type=int, default=8, help="持续争用阶段的车辆数")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=50, help="抢同一辆车的轮数")
+    parser.add_argument("--duration", type=float, default=5.0, help="持续争用阶段每种方式的时长（秒）")
+    parser.add_argument("--db-latency-ms", type=float, default=2.0, help="每条 SQL 的模拟往返延迟（毫秒）")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # 须在导入 config 之前设置：独立的临时数据库，连接池容纳全部线程
+    workdir = tempfile.mkdtemp(prefix="bench_unlock_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["DB_POOL_SIZE"] = str(args.threads + 2)
+
+    from database import engine, SessionLocal
+    from fleet_state import fleet_state
+
+    seed_database(max(args.bikes, 1), args.users)
+    db = SessionLocal()
+    try:
+        fleet_state.warm(db)  # 与线上一致：车辆编号、位置取车队状态
+    finally:
+        db.close()
+    counter = StatementCounter(engine, args.db_latency_ms / 1000)
+
+    print("=" * 72)
+    print(f"开锁并发基准: {args.threads} 个线程, 每条 SQL 延迟 {args.db_latency_ms:.0f}ms")
+    print("=" * 72)
+    print(f"抢同一辆车（{args.rounds} 轮，每轮 {args.threads} 个线程同时开锁）:")
+    for name, unlock in (("legacy", legacy_unlock), ("atomic", atomic_unlock)):
+        r = race_same_bike(unlock, args.threads, args.rounds, args.users)
+        print(f"  {name}: 重复开锁的轮数 {r['double_unlock_rounds']}/{r['rounds']}，"
+              f"单轮最多 {r['max_orders_per_round']} 个订单")
+
+    print(f"同一用户多辆车（{args.rounds} 轮，每轮 {args.threads} 个线程用同一张卡开锁 {args.bikes} 辆车）:")
+    for name, unlock in (("legacy", legacy_unlock), ("atomic", atomic_unlock)):
+        r = race_same_user(unlock, args.threads, args.rounds, args.bikes)
+        print(f"  {name}: 同时多个订单的轮数 {r['double_ride_rounds']}/{r['rounds']}，"
+              f"单轮最多 {r['max_orders_per_round']} 个订单")
+
+    print(f"持续争用（{args.bikes} 辆车，每种方式 {args.duration:.0f} 秒）:")
+    for name, unlock in (("legacy", legacy_unlock), ("atomic", atomic_unlock)):
+        r = sustained(unlock, counter, args.threads, args.bikes, args.users, args.duration)
+        print(f"  {name}: 开锁 {r['unlocks_per_sec']:.0f} 次/秒（尝试 {r['attempts']}，成功 {r['unlocks']}，"
+              f"错误 {r['errors']}），延迟 p50={r['p50_ms']:.1f}ms p99={r['p99_ms']:.1f}ms，"
+              f"每次开锁 {r['statements_per_unlock']:.1f} 条 SQL")
+
+
+if __name__ == "__main__":
+    main()
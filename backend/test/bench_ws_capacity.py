@@ -0,0 +1,597 @@
+"""
+WebSocket 容量基准测试 - 单实例能承载多少 /ws 客户端（同时接收 MQTT）
+
+在本进程内启动完整的后端应用（uvicorn + main:app，临时 SQLite 数据库），
+不连接 MQTT broker，由注入线程按目标速率直接调用 MQTTHandler._on_message
+注入心跳/GPS（与 paho 网络线程相同的路径：WebSocket 转发 + 接收队列 + 写库）。
+客户端运行在独立的子进程中，避免与服务端争用事件循环。
+
+按 客户端数 × 消息速率 逐档测量：
+1. 投递延迟分位数（消息注入到探针客户端收到，含合并推送的 tick 等待）
+2. 丢失的消息（探针客户端的序号缺口、服务端丢弃/断开的慢客户端、接收队列丢弃）
+3. 每个连接的内存（建立连接并推送快照后服务进程 RSS 的增量）
+4. 事件循环延迟（每 10ms 一次的定时器超时量）
+5. 服务端与客户端进程的 CPU 占用（客户端 CPU 饱和时结果受客户端限制）
+
+只有少量探针客户端解析消息并统计延迟与序号，其余客户端只计数帧和字节。
+加 --json 输出机器可读的结果，便于跟踪性能回归（--json - 输出到标准输出）。
+
+运行: python test/bench_ws_capacity.py --clients 500,1000,2000 --rates 1000,5000 [--duration 10] [--json result.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+LAG_INTERVAL = 0.01  # 事件循环延迟的采样间隔（秒）
+LATENCY_SAMPLES = 100_000  # 每个客户端进程保留的延迟样本数（蓄水池抽样）
+CONNECT_CONCURRENCY = 200  # 每个客户端进程同时发起的连接数
+DRAIN_SECONDS = 1.5  # 停止注入后等待推送完成的时间
+
+
+# ========== 通用工具 ==========
+
+
+def raise_fd_limit():
+    """把文件描述符软限制提高到硬限制，数千个连接需要同样多的 socket"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def cpu_seconds() -> float:
+    """本进程（含所有线程）消耗的 CPU 秒数"""
+    return time.process_time()
+
+
+def rss_mb() -> float:
+    """本进程当前常驻内存（MB），无法读取 /proc 时返回峰值"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return 0.0
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    n = len(values)
+
+    def pick(q):
+        return round(values[min(n - 1, int(q * n))], 2)
+
+    return {
+        "count": n,
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": round(values[-1], 2),
+    }
+
+
+# ========== 客户端进程 ==========
+
+
+class ClientStats:
+    """一个客户端进程内所有连接的统计（report 后清零）"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.bytes = 0
+        self.messages = 0  # 探针客户端收到的遥测消息数
+        self.seq_gaps = 0
+        self.latencies = []
+        self._seen = 0  # 蓄水池抽样已见的延迟数
+        self.closed = 0  # 被服务端关闭的连接数
+        self.close_codes = {}
+        self.cpu_start = cpu_seconds()
+        self.wall_start = time.monotonic()
+
+    def add_latency(self, ms: float):
+        self._seen += 1
+        if len(self.latencies) < LATENCY_SAMPLES:
+            self.latencies.append(ms)
+        else:
+            i = random.randrange(self._seen)
+            if i < LATENCY_SAMPLES:
+                self.latencies[i] = ms
+
+    def report(self) -> dict:
+        wall = max(time.monotonic() - self.wall_start, 1e-6)
+        result = {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "messages": self.messages,
+            "seq_gaps": self.seq_gaps,
+            "latencies": self.latencies,
+            "closed": self.closed,
+            "close_codes": self.close_codes,
+            "cpu_pct": round((cpu_seconds() - self.cpu_start) / wall * 100, 1),
+        }
+        self.reset()
+        return result
+
+
+class Probe:
+    """探针客户端的序号跟踪"""
+
+    def __init__(self):
+        self.last_seq = None
+
+    def reset(self):
+        self.last_seq = None
+
+
+def decode(frame, encoding: str) -> dict:
+    if encoding == "msgpack":
+        import msgpack
+        return msgpack.unpackb(frame)
+    return json.loads(frame)
+
+
+async def read_frames(ws, stats: ClientStats, probe, encoding: str):
+    from websockets.exceptions import ConnectionClosed
+
+    try:
+        async for frame in ws:
+            stats.frames += 1
+            stats.bytes += len(frame)
+            if probe is None:
+                continue
+            received_at = time.time()
+            message = decode(frame, encoding)
+            if message.get("type") == "batch":
+                items = message["messages"]
+            elif message.get("type") == "mqtt":
+                items = [message]
+            else:
+                continue
+            for item in items:
+                seq = item["seq"]
+                if probe.last_seq is not None and seq > probe.last_seq + 1:
+                    stats.seq_gaps += seq - probe.last_seq - 1
+                probe.last_seq = seq
+                stats.messages += 1
+                sent_at = item["data"].get("ts")
+                if sent_at is not None:
+                    stats.add_latency((received_at - sent_at) * 1000)
+    except ConnectionClosed as e:
+        stats.closed += 1
+        code = str(e.rcvd.code) if e.rcvd else "none"
+        stats.close_codes[code] = stats.close_codes.get(code, 0) + 1
+
+
+async def client_main(conn, url: str, compression, encoding: str):
+    import websockets
+
+    raise_fd_limit()
+    loop = asyncio.get_running_loop()
+    stats = ClientStats()
+    sockets, tasks, probes = [], [], []
+
+    async def open_one(semaphore):
+        async with semaphore:
+            return await websockets.connect(
+                url, compression=compression, max_size=None, ping_interval=None,
+                open_timeout=60, close_timeout=2,
+            )
+
+    while True:
+        command = await loop.run_in_executor(None, conn.recv)
+        op = command[0]
+        if op == "connect":
+            _, count, probe_count = command
+            start = time.monotonic()
+            semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+            results = await asyncio.gather(*(open_one(semaphore) for _ in range(count)), return_exceptions=True)
+            failed = 0
+            for ws in results:
+                if isinstance(ws, BaseException):
+                    failed += 1
+                    continue
+                probe = Probe() if len(probes) < probe_count else None
+                if probe is not None:
+                    probes.append(probe)
+                sockets.append(ws)
+                tasks.append(asyncio.create_task(read_frames(ws, stats, probe, encoding)))
+            conn.send(("connected", len(sockets), failed, time.monotonic() - start))
+        elif op == "report":
+            for probe in probes:
+                probe.reset()
+            conn.send(("report", stats.report()))
+        elif op == "close":
+            await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+            for task in tasks:
+                task.cancel()
+            sockets, tasks, probes = [], [], []
+            conn.send(("closed",))
+        elif op == "exit":
+            return
+
+
+def client_process(conn, url: str, compression, encoding: str):
+    asyncio.run(client_main(conn, url, compression, encoding))
+
+
+class ClientPool:
+    """客户端子进程池（多进程 spawn，不继承服务端状态）"""
+
+    def __init__(self, procs: int, url: str, compression, encoding: str):
+        ctx = multiprocessing.get_context("spawn")
+        self.conns = []
+        self.procs = []
+        for _ in range(procs):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=client_process, args=(child, url, compression, encoding), daemon=True)
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    async def _call(self, commands):
+        loop = asyncio.get_running_loop()
+        for conn, command in zip(self.conns, commands):
+            conn.send(command)
+        return await asyncio.gather(*(loop.run_in_executor(None, conn.recv) for conn in self.conns))
+
+    async def connect(self, clients: int, probes: int):
+        n = len(self.conns)
+        commands = [
+            ("connect", clients // n + (i < clients % n), probes // n + (i < probes % n))
+            for i in range(n)
+        ]
+        replies = await self._call(commands)
+        return sum(r[1] for r in replies), sum(r[2] for r in replies), max(r[3] for r in replies)
+
+    async def report(self) -> dict:
+        replies = [r[1] for r in await self._call([("report",)] * len(self.conns))]
+        close_codes = {}
+        for r in replies:
+            for code, count in r["close_codes"].items():
+                close_codes[code] = close_codes.get(code, 0) + count
+        return {
+            "frames": sum(r["frames"] for r in replies),
+            "bytes": sum(r["bytes"] for r in replies),
+            "messages": sum(r["messages"] for r in replies),
+            "seq_gaps": sum(r["seq_gaps"] for r in replies),
+            "latencies": [v for r in replies for v in r["latencies"]],
+            "closed": sum(r["closed"] for r in replies),
+            "close_codes": close_codes,
+            "cpu_pct": [r["cpu_pct"] for r in replies],
+        }
+
+    async def close(self):
+        await self._call([("close",)] * len(self.conns))
+
+    def exit(self):
+        for conn in self.conns:
+            conn.send(("exit",))
+        for proc in self.procs:
+            proc.join(5)
+
+
+# ========== 服务端 ==========
+
+
+class FakeMessage:
+    """模拟 paho 的 MQTTMessage"""
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+class LoopLagMonitor:
+    """事件循环延迟：定时器实际唤醒时间与预期的差值"""
+
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append((time.perf_counter() - start - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def take(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+def inject(mqtt_client, rate: int, duration: float, bikes: int) -> int:
+    """按目标速率注入心跳/GPS（在独立线程中运行，模拟 paho 网络线程），返回注入条数"""
+    slot = 0.01
+    positions = {i: [30.27 + random.uniform(-0.1, 0.1), 120.15 + random.uniform(-0.1, 0.1)] for i in range(1, bikes + 1)}
+    sent = 0
+    due = 0.0
+    start = time.perf_counter()
+    deadline = start + duration
+    next_slot = start
+    while time.perf_counter() < deadline:
+        due += rate * slot
+        while sent < due:
+            bike_id = sent % bikes + 1
+            position = positions[bike_id]
+            position[0] += random.uniform(-0.0002, 0.0002)
+            position[1] += random.uniform(-0.0002, 0.0002)
+            data = {"lat": round(position[0], 6), "lng": round(position[1], 6), "ts": time.time()}
+            if sent % 2:
+                topic = f"bike/{bike_id:03d}/gps"
+                data["mode"] = "real"
+            else:
+                topic = f"bike/{bike_id:03d}/heartbeat"
+                data.update(battery=90, status="idle")
+            mqtt_client._on_message(None, None, FakeMessage(topic, json.dumps(data).encode("utf-8")))
+            sent += 1
+        next_slot += slot
+        pause = next_slot - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+    return sent
+
+
+def seed_database(bikes: int):
+    """在临时 SQLite 数据库中建表并写入车辆"""
+    from database import engine, Base, SessionLocal
+    from models import Bike
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        db.add_all([
+            Bike(id=i, bike_code=f"{i:03d}", status="idle", battery=90,
+                 current_lat=30.27, current_lng=120.15, created_at=now, updated_at=now)
+            for i in range(1, bikes + 1)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def enable_ingestion():
+    """与 main.start_ingestion 相同的消息处理，只是不连接 MQTT broker（消息由注入线程直接送入）"""
+    from config import settings
+    from database import get_db
+    from mqtt_handler import mqtt_client
+    from websocket_server import setup_mqtt_forwarding
+    from mqtt_message_handler import setup_mqtt_subscriptions
+    from bike_write_buffer import bike_write_buffer
+    from trajectory_writer import trajectory_writer
+
+    # 接收队列已在 mqtt_client.connect() 中启动（连接失败之前）
+    setup_mqtt_forwarding()
+    if settings.DB_WRITE_BEHIND_ENABLED:
+        bike_write_buffer.start()
+    if settings.TRAJECTORY_ENABLED:
+        trajectory_writer.start()
+    setup_mqtt_subscriptions(
+        mqtt_client,
+        get_db,
+        bike_write_buffer if settings.DB_WRITE_BEHIND_ENABLED else None,
+        trajectory_writer if settings.TRAJECTORY_ENABLED else None,
+    )
+
+
+async def run(args) -> dict:
+    import uvicorn
+    import logging
+    from config import settings
+
+    seed_database(args.bikes)
+    from main import app
+    from mqtt_handler import mqtt_client
+    from websocket_server import websocket_manager, telemetry_coalescer
+
+    config = uvicorn.Config(
+        app, host="127.0.0.1", port=args.port, log_level="warning",
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE, backlog=4096,
+    )
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    logging.getLogger().setLevel(logging.WARNING)  # 每个连接一条 INFO 日志会拖慢服务端
+    enable_ingestion()
+
+    loop = asyncio.get_running_loop()
+    lag = LoopLagMonitor()
+    lag.start()
+    compression = "deflate" if settings.WS_PER_MESSAGE_DEFLATE and not args.no_deflate else None
+    url = f"ws://127.0.0.1:{args.port}/ws" + ("?encoding=msgpack" if args.encoding == "msgpack" else "")
+    pool = ClientPool(args.client_procs, url, compression, args.encoding)
+
+    results = []
+    try:
+        for clients in args.clients:
+            rss_before = rss_mb()
+            connected, failed, connect_seconds = await pool.connect(clients, args.probes)
+            await asyncio.sleep(1.0)  # 等待快照推送完成
+            rss_connected = rss_mb()
+
+            for rate in args.rates:
+                await pool.report()  # 清零客户端统计
+                lag.take()
+                ws_before = websocket_manager.get_metrics()
+                coalescer_before = telemetry_coalescer.get_metrics()
+                ingest_before = mqtt_client.get_ingest_metrics()
+                cpu_before = cpu_seconds()
+                wall_start = time.monotonic()
+
+                injected = await loop.run_in_executor(None, inject, mqtt_client, rate, args.duration, args.bikes)
+                inject_seconds = time.monotonic() - wall_start
+                await asyncio.sleep(DRAIN_SECONDS)
+
+                wall = time.monotonic() - wall_start
+                server_cpu = (cpu_seconds() - cpu_before) / wall * 100
+                ws_after = websocket_manager.get_metrics()
+                coalescer_after = telemetry_coalescer.get_metrics()
+                ingest_after = mqtt_client.get_ingest_metrics()
+                client = await pool.report()
+
+                result = {
+                    "clients": clients,
+                    "connected": connected,
+                    "connect_failed": failed,
+                    "connect_seconds": round(connect_seconds, 2),
+                    "connections_open": ws_after["connections"],
+                    "rate_target": rate,
+                    "rate_achieved": round(injected / inject_seconds),
+                    "duration_s": round(inject_seconds, 2),
+                    "injected": injected,
+                    "pushed_messages": coalescer_after["messages_out"] - coalescer_before["messages_out"],
+                    "frames_received": client["frames"],
+                    "bytes_received": client["bytes"],
+                    "probe_messages": client["messages"],
+                    "latency_ms": percentiles(client["latencies"]),
+                    "seq_gaps": client["seq_gaps"],
+                    "server_dropped": ws_after["total_dropped"] - ws_before["total_dropped"],
+                    "slow_disconnects": ws_after["slow_disconnects"] - ws_before["slow_disconnects"],
+                    "closed_by_server": client["closed"],
+                    "close_codes": client["close_codes"],
+                    "max_queue_depth": ws_after["max_queue_depth"],
+                    "ingest_dropped": ingest_after.get("dropped", 0) - ingest_before.get("dropped", 0),
+                    "loop_lag_ms": percentiles(lag.take()),
+                    "rss_mb": round(rss_mb(), 1),
+                    "rss_per_conn_kb": round((rss_connected - rss_before) * 1024 / connected, 1) if connected else None,
+                    "server_cpu_pct": round(server_cpu, 1),
+                    "client_cpu_pct": client["cpu_pct"],
+                }
+                results.append(result)
+                if args.json != "-":
+                    print_row(result)
+            await pool.close()
+            await asyncio.sleep(0.5)
+    finally:
+        pool.exit()
+        lag.stop()
+        server.should_exit = True
+        await server_task
+
+    return {
+        "benchmark": "ws_capacity",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "bikes": args.bikes,
+            "probes": args.probes,
+            "client_procs": args.client_procs,
+            "encoding": args.encoding,
+            "deflate": compression is not None,
+            "ws_tick_ms": settings.WS_TICK_MS,
+            "ws_send_queue_size": settings.WS_SEND_QUEUE_SIZE,
+            "ws_slow_client_policy": settings.WS_SLOW_CLIENT_POLICY,
+            "mqtt_transport": settings.MQTT_TRANSPORT,
+            "mqtt_ingest_workers": settings.MQTT_INGEST_WORKERS,
+            "db_write_behind": settings.DB_WRITE_BEHIND_ENABLED,
+        },
+        "results": results,
+    }
+
+
+HEADER = (
+    f"{'客户端':>8}{'速率':>8}{'实际':>8}{'延迟p50':>10}{'p99':>9}{'max':>9}"
+    f"{'缺口':>7}{'服务端丢弃':>10}{'断开':>6}{'循环p99':>9}{'循环max':>9}"
+    f"{'KB/连接':>9}{'RSS':>8}{'服务CPU':>9}{'客户端CPU':>12}"
+)
+
+
+def print_row(r: dict):
+    latency = r["latency_ms"]
+    lag = r["loop_lag_ms"]
+    print(
+        f"{r['connected']:>8}{r['rate_target']:>8}{r['rate_achieved']:>8}"
+        f"{latency.get('p50', 0):>8.1f}ms{latency.get('p99', 0):>7.1f}ms{latency.get('max', 0):>7.1f}ms"
+        f"{r['seq_gaps']:>7}{r['server_dropped']:>10}{r['slow_disconnects']:>6}"
+        f"{lag.get('p99', 0):>7.1f}ms{lag.get('max', 0):>7.1f}ms"
+        f"{r['rss_per_conn_kb'] or 0:>9.1f}{r['rss_mb']:>6.0f}MB{r['server_cpu_pct']:>8.0f}%"
+        f"{'/'.join(f'{c:.0f}' for c in r['client_cpu_pct']):>11}%",
+        flush=True,
+    )
+
+
+def parse_args():
+    def int_list(value):
+        return [int(v) for v in value.split(",") if v]
+
+    parser = argparse.ArgumentParser(description="WebSocket 容量基准测试")
+    parser.add_argument("--clients", type=int_list, default=[200, 1000], help="客户端数，逗号分隔")
+    parser.add_argument("--rates", type=int_list, default=[1000, 5000], help="注入速率（条/秒），逗号分隔")
+    parser.add_argument("--duration", type=float, default=10.0, help="每档注入时长（秒）")
+    parser.add_argument("--bikes", type=int, default=1000, help="车辆数")
+    parser.add_argument("--probes", type=int, default=20, help="解析消息并统计延迟的探针客户端数")
+    parser.add_argument("--client-procs", type=int, default=4, help="客户端子进程数")
+    parser.add_argument("--encoding", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--no-deflate", action="store_true", help="客户端不协商 permessage-deflate")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--json", help="结果写入该 JSON 文件（- 表示标准输出）")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+
+    # 须在导入 config 之前设置：独立的临时数据库，不连接真实的 broker，单进程模式
+    workdir = tempfile.mkdtemp(prefix="bench_ws_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["MQTT_BROKER"] = "127.0.0.1"
+    os.environ["MQTT_PORT"] = "1"  # 连接被拒绝，消息由注入线程送入
+    os.environ["MQTT_TRANSPORT"] = "thread"
+    os.environ["EVENT_BUS_ENABLED"] = "false"
+
+    if args.json != "-":
+        print("=" * 132)
+        print(f"WebSocket 容量基准: {args.bikes} 辆车, 每档 {args.duration:.0f} 秒, "
+              f"{args.probes} 个探针客户端, {args.client_procs} 个客户端进程, 编码 {args.encoding}")
+        print("=" * 132)
+        print(HEADER)
+
+    report = asyncio.run(run(args))
+
+    if args.json == "-":
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
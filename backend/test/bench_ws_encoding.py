@@ -0,0 +1,163 @@
+"""
+WebSocket 帧编码基准测试 - JSON / MessagePack，是否启用 permessage-deflate
+
+模拟一个 tick 内的心跳/GPS 合并帧，测量每种编码：
+1. 帧大小与每个客户端的带宽（字节/秒）
+2. 序列化 CPU（每个订阅分组每种编码只做一次）
+3. permessage-deflate 压缩 CPU（按连接压缩，与客户端数成正比）
+最后用 WebSocketManager 实际推送给 1k 个混合编码的客户端，验证每个帧只编码一次。
+
+运行: python test/bench_ws_encoding.py [每 tick 车辆数] [客户端数] [订阅分组数]
+"""
+import os
+import sys
+import time
+import zlib
+import random
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from config import settings
+from websocket_server import WebSocketManager, encode_frame, supported_encodings
+
+FRAMES = 40  # 每种编码测量的连续帧数
+
+
+def make_messages(bikes: int, seq_start: int):
+    """一个 tick 内的遥测消息：一半 GPS、一半心跳"""
+    messages = []
+    for i in range(bikes):
+        bike_id = random.randint(1, 100_000)
+        lat = round(30.27 + random.uniform(-0.15, 0.15), 6)
+        lng = round(120.15 + random.uniform(-0.15, 0.15), 6)
+        if i % 2:
+            topic = f"bike/{bike_id:05d}/gps"
+            data = {"lat": lat, "lng": lng, "mode": "real"}
+        else:
+            topic = f"bike/{bike_id:05d}/heartbeat"
+            data = {"lat": lat, "lng": lng, "battery": random.randint(5, 100), "status": "idle"}
+        messages.append((topic, data))
+    return messages
+
+
+def make_frame(messages, seq_start: int):
+    return {
+        "type": "batch",
+        "ts": time.time(),
+        "seq": seq_start + len(messages),
+        "messages": [
+            {"seq": seq_start + i + 1, "topic": topic, "data": data}
+            for i, (topic, data) in enumerate(messages)
+        ],
+    }
+
+
+def deflate_message(compressor, payload: bytes) -> bytes:
+    """与 websockets 的 permessage-deflate 相同：共享上下文，SYNC_FLUSH 后去掉尾部 4 字节"""
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+def measure(frames, encoding: str):
+    encode_s = 0.0
+    deflate_s = 0.0
+    raw_bytes = 0
+    deflated_bytes = 0
+    compressor = zlib.compressobj(wbits=-15, memLevel=5)
+    for frame in frames:
+        start = time.perf_counter()
+        payload = encode_frame(frame, encoding)
+        encode_s += time.perf_counter() - start
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        raw_bytes += len(payload)
+
+        start = time.perf_counter()
+        deflated_bytes += len(deflate_message(compressor, payload))
+        deflate_s += time.perf_counter() - start
+    n = len(frames)
+    return {
+        "encode_ms": encode_s / n * 1000,
+        "deflate_ms": deflate_s / n * 1000,
+        "raw_bytes": raw_bytes / n,
+        "deflated_bytes": deflated_bytes / n,
+    }
+
+
+class NullWebSocket:
+    """只计数、不发送的 WebSocket"""
+
+    client = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+
+async def measure_fanout(messages, clients: int):
+    """通过 WebSocketManager 推送给混合编码的客户端，统计编码次数与入队耗时"""
+    manager = WebSocketManager(queue_size=FRAMES * 2)
+    encodings = supported_encodings()
+    for i in range(clients):
+        await manager.connect(NullWebSocket(), encoding=encodings[i % len(encodings)])
+
+    start = time.perf_counter()
+    frames, bytes_out = await manager.publish_batch(messages)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.1)  # 让写协程清空队列
+    for websocket in manager.active_connections:
+        manager.disconnect(websocket)
+    return frames, bytes_out, elapsed
+
+
+def main():
+    bikes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    groups = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    ticks_per_sec = 1000 / settings.WS_TICK_MS if settings.WS_TICK_MS > 0 else 4
+
+    random.seed(42)
+    frames = [make_frame(make_messages(bikes, 0), k * bikes) for k in range(FRAMES)]
+
+    print("=" * 92)
+    print(f"WebSocket 帧编码基准: 每帧 {bikes} 条消息, {ticks_per_sec:.0f} 帧/秒, "
+          f"{clients} 个客户端, {groups} 个订阅分组")
+    print("=" * 92)
+    print(f"{'编码':<10}{'压缩':<8}{'帧大小':>12}{'每客户端带宽':>16}{'1k 客户端带宽':>16}"
+          f"{'编码 CPU/帧':>14}{'1k 客户端 CPU':>16}")
+
+    for encoding in supported_encodings():
+        result = measure(frames, encoding)
+        for deflate in (False, True):
+            size = result["deflated_bytes"] if deflate else result["raw_bytes"]
+            # 序列化每个分组只做一次；permessage-deflate 每个连接各压缩一次
+            cpu_ms = result["encode_ms"] * groups + (result["deflate_ms"] * 1000 if deflate else 0.0)
+            print(
+                f"{encoding:<10}{'deflate' if deflate else '-':<8}"
+                f"{size / 1024:>10.1f}KB"
+                f"{size * ticks_per_sec / 1024:>12.1f}KB/s"
+                f"{size * ticks_per_sec * 1000 / 1024 / 1024:>14.1f}MB/s"
+                f"{result['encode_ms']:>12.2f}ms"
+                f"{cpu_ms * ticks_per_sec / 10:>14.1f}% 核"
+            )
+
+    print("-" * 92)
+    messages = make_messages(bikes, 0)
+    encoded, bytes_out, elapsed = asyncio.run(measure_fanout(messages, clients))
+    print(f"WebSocketManager 推送 {clients} 个客户端（编码: {', '.join(supported_encodings())}）: "
+          f"编码 {encoded} 次, 入队 {bytes_out / 1024 / 1024:.1f}MB, 耗时 {elapsed * 1000:.1f}ms")
+    if not settings.WS_PER_MESSAGE_DEFLATE:
+        print("注意: 当前配置未启用 permessage-deflate (WS_PER_MESSAGE_DEFLATE=False)")
+
+
+if __name__ == "__main__":
+    main()
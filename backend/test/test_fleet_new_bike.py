@@ -0,0 +1,83 @@
+"""
+测试启动后新增的车辆：首次收到其心跳/GPS 时从数据库加载到车队状态
+
+在临时 SQLite 数据库上模拟：
+1. 车队状态预热后再向数据库添加车辆，其心跳被处理（车队状态、列表、写回缓冲）
+2. GPS 轨迹点照常进入轨迹写入管道
+3. 数据库中也不存在的车辆仍被丢弃，且短时间内不重复查询数据库
+
+运行: python test/test_fleet_new_bike.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# 须在导入 config 之前设置：独立的临时数据库
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_fleet_'), 'test.db')}"
+
+from sqlalchemy import event
+
+from database import engine, Base, SessionLocal
+from models import Bike
+from fleet_state import fleet_state
+from bike_write_buffer import BikeWriteBuffer
+from trajectory_writer import TrajectoryWriter
+from mqtt_message_handler import record_heartbeat_message, record_trajectory_point
+
+
+def seed():
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        fleet_state.warm(db)  # 预热时数据库中还没有车辆
+        now = datetime.now()
+        db.add(Bike(id=7, bike_code="007", status="idle", battery=90,
+                    current_lat=30.27, current_lng=120.15, created_at=now, updated_at=now))
+        db.commit()
+    finally:
+        db.close()
+
+
+def check(name: str, ok: bool) -> bool:
+    print(f"  {'通过' if ok else '失败'}: {name}")
+    return ok
+
+
+def main():
+    seed()
+    buffer = BikeWriteBuffer(flush_interval=60)  # 不启动后台线程，手动写库
+    writer = TrajectoryWriter()
+    results = []
+
+    # 1. 新车辆的心跳
+    record_heartbeat_message("bike/007/heartbeat", {"lat": 30.28, "lng": 120.16, "battery": 80, "status": "idle"}, buffer)
+    bike = fleet_state.get(7)
+    results.append(check("新车辆已加载到车队状态", bike is not None))
+    results.append(check("心跳已应用", bike is not None and bike["battery"] == 80))
+    results.append(check("出现在车辆列表中", fleet_state.list_bikes()[0] == 1))
+    results.append(check("心跳进入写回缓冲", buffer.flush() == 1))
+
+    # 2. 新车辆的轨迹点
+    record_trajectory_point("bike/007/gps", {"lat": 30.29, "lng": 120.17, "mode": "real"}, writer)
+    results.append(check("轨迹点进入写入管道", writer.get_metrics()["received"] == 1))
+
+    # 3. 不存在的车辆
+    queries = []
+    listener = lambda conn, cursor, statement, *args: queries.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    for _ in range(3):
+        record_heartbeat_message("bike/099/heartbeat", {"lat": 30.28, "lng": 120.16, "battery": 80}, buffer)
+    event.remove(engine, "before_cursor_execute", listener)
+    results.append(check("不存在的车辆被丢弃", fleet_state.get(99) is None and buffer.flush() == 0))
+    results.append(check("不存在的车辆只查询一次数据库", len(queries) == 1))
+
+    ok = all(results)
+    print(f"结果: {'通过' if ok else '失败'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
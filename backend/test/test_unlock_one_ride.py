@@ -0,0 +1,105 @@
+"""
+测试一人一单由数据库保证（多 worker 时各进程的进行中订单索引互不共享）
+
+在临时 SQLite 数据库上模拟：用户在 worker A 上开锁后，worker B 的索引中还没有该订单，
+同一用户在 worker B 上开锁另一辆车应被拒绝，且车辆不被占用；
+直接插入第二个进行中的订单也会违反唯一约束。
+
+运行: python test/test_unlock_one_ride.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# 须在导入 config 之前设置：独立的临时数据库
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_unlock_'), 'test.db')}"
+
+from sqlalchemy.exc import IntegrityError
+
+from database import engine, Base, SessionLocal
+from models import Bike, Order, OrderStatus, User
+from fleet_state import fleet_state
+from active_orders import active_orders
+from order_service import order_service, UNLOCK_USER_RIDING
+
+
+def seed():
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        db.add_all([
+            Bike(id=i, bike_code=f"00{i}", status="idle", battery=90,
+                 current_lat=30.27, current_lng=120.15, created_at=now, updated_at=now)
+            for i in (1, 2)
+        ])
+        db.add(User(id=1, username="user1", rfid_card="CARD1", balance=Decimal("50.00"),
+                    status="active", created_at=now, updated_at=now))
+        db.commit()
+        fleet_state.warm(db)
+        active_orders.load(db)
+    finally:
+        db.close()
+
+
+def unlock(bike_id: int):
+    db = SessionLocal()
+    try:
+        return order_service.unlock(db, 1, bike_id, 30.27, 120.15)
+    finally:
+        db.close()
+
+
+def check(name: str, ok: bool) -> bool:
+    print(f"  {'通过' if ok else '失败'}: {name}")
+    return ok
+
+
+def main():
+    seed()
+    results = []
+
+    # worker A 开锁 1 号车
+    first = unlock(1)
+    results.append(check("第一次开锁成功", first.success))
+
+    # worker B 的索引中没有该订单
+    active_orders.finish(1, first.order.id, 1)
+    second = unlock(2)
+    results.append(check("同一用户开锁第二辆车被拒绝", second.reason == UNLOCK_USER_RIDING))
+    results.append(check("返回当前订单号", second.current_order_id == first.order.id))
+    results.append(check("占用已释放", active_orders.order_for_user(1) is None
+                         and active_orders.get_metrics()["pending_unlocks"] == 0))
+
+    db = SessionLocal()
+    try:
+        bike_status = db.query(Bike.status).filter(Bike.id == 2).scalar()
+        active = db.query(Order).filter(Order.user_id == 1, Order.status == OrderStatus.ACTIVE.value).count()
+    finally:
+        db.close()
+    results.append(check("第二辆车仍为 idle", bike_status == "idle"))
+    results.append(check("用户只有一个进行中的订单", active == 1))
+
+    db = SessionLocal()
+    try:
+        db.add(Order(user_id=1, bike_id=2, status=OrderStatus.ACTIVE.value))
+        db.commit()
+        rejected = False
+    except IntegrityError:
+        db.rollback()
+        rejected = True
+    finally:
+        db.close()
+    results.append(check("数据库拒绝第二个进行中的订单", rejected))
+
+    ok = all(results)
+    print(f"结果: {'通过' if ok else '失败'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+测试写回缓冲不会覆盖开锁/还车提交的车辆状态
+
+在临时 SQLite 数据库上模拟：
+1. 空闲心跳进入写回缓冲 -> 用户开锁 -> 缓冲写库：车辆仍为 riding，第二个用户不能再开锁
+2. 骑行心跳进入写回缓冲 -> 还车 -> 缓冲写库：车辆仍为 idle
+3. 心跳上报的状态与当前不同时立即写库
+
+运行: python test/test_write_buffer_status.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# 须在导入 config 之前设置：独立的临时数据库
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_wb_'), 'test.db')}"
+
+from sqlalchemy import update
+
+from database import engine, Base, SessionLocal
+from models import Bike, User
+from fleet_state import fleet_state
+from active_orders import active_orders
+from bike_write_buffer import BikeWriteBuffer
+from mqtt_message_handler import record_heartbeat_message
+from order_service import order_service
+
+TOPIC = "bike/001/heartbeat"
+
+
+def heartbeat(status: str) -> dict:
+    return {"lat": 30.27, "lng": 120.15, "battery": 90, "status": status}
+
+
+def seed():
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        db.add(Bike(id=1, bike_code="001", status="idle", battery=90,
+                    current_lat=30.27, current_lng=120.15, created_at=now, updated_at=now))
+        db.add_all([
+            User(id=i, username=f"user{i}", rfid_card=f"CARD{i}", balance=Decimal("50.00"),
+                 status="active", created_at=now, updated_at=now)
+            for i in (1, 2)
+        ])
+        db.commit()
+        fleet_state.warm(db)
+        active_orders.load(db)
+    finally:
+        db.close()
+
+
+def db_status() -> str:
+    db = SessionLocal()
+    try:
+        return db.query(Bike.status).filter(Bike.id == 1).scalar()
+    finally:
+        db.close()
+
+
+def check(name: str, ok: bool) -> bool:
+    print(f"  {'通过' if ok else '失败'}: {name}")
+    return ok
+
+
+def main():
+    seed()
+    buffer = BikeWriteBuffer(flush_interval=60)  # 不启动后台线程，手动写库
+    results = []
+
+    # 1. 空闲心跳排队 -> 开锁 -> 写库
+    record_heartbeat_message(TOPIC, heartbeat("idle"), buffer)
+    db = SessionLocal()
+    try:
+        first = order_service.unlock(db, 1, 1, 30.27, 120.15)
+    finally:
+        db.close()
+    fleet_state.apply(1, status="riding")
+    buffer.flush()
+    results.append(check("开锁成功", first.success))
+    results.append(check("缓冲写库后车辆仍为 riding", db_status() == "riding"))
+    db = SessionLocal()
+    try:
+        second = order_service.unlock(db, 2, 1, 30.27, 120.15)
+    finally:
+        db.close()
+    results.append(check("第二个用户不能开锁同一辆车", not second.success))
+
+    # 2. 骑行心跳排队 -> 还车 -> 写库
+    record_heartbeat_message(TOPIC, heartbeat("riding"), buffer)
+    with engine.begin() as conn:
+        conn.execute(update(Bike.__table__).where(Bike.__table__.c.id == 1).values(status="idle"))
+    fleet_state.apply(1, status="idle")
+    buffer.flush()
+    results.append(check("缓冲写库后车辆仍为 idle", db_status() == "idle"))
+
+    # 3. 状态变化立即写库
+    record_heartbeat_message(TOPIC, heartbeat("fault"), buffer)
+    results.append(check("状态变化的心跳立即写库", db_status() == "fault"))
+
+    ok = all(results)
+    print(f"结果: {'通过' if ok else '失败'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
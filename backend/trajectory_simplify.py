@@ -0,0 +1,291 @@
+"""
+轨迹计算 - 抽稀、编码与骑行距离
+
+Douglas-Peucker 抽稀按层向量化：每一轮用 NumPy 同时计算所有未确定点到
+所在线段的距离，并为每个线段选出最远点，轮数约为 log(n)。
+计算结果是每个点的"重要度"（被选中时的距离，已按父线段截断），因此：
+- 按容差抽稀: 保留重要度 > 容差的点，与经典递归 DP 结果一致
+- 按目标点数抽稀: 保留重要度最高的 N 个点
+同一条轨迹的重要度只需计算一次，已完成订单的结果缓存在 TrackCache 中。
+
+骑行距离为相邻点球面距离之和（向量化），计算前剔除速度不合理的漂移点。
+"""
+import threading
+import logging
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import desc
+from sqlalchemy.orm import Session
+
+from config import settings
+from geo_utils import EARTH_RADIUS_M, METERS_PER_DEG_LAT
+from models import BikeTrajectory, Order, OrderStatus
+from trajectory_writer import trajectory_writer
+from event_bus import event_bus
+
+logger = logging.getLogger(__name__)
+
+
+def project_xy(lat: np.ndarray, lng: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """以轨迹平均纬度做等距投影，得到以米为单位的平面坐标"""
+    lat0 = np.radians(lat.mean()) if len(lat) else 0.0
+    return lng * (METERS_PER_DEG_LAT * np.cos(lat0)), lat * METERS_PER_DEG_LAT
+
+
+def dp_importance(lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    """计算每个点的 Douglas-Peucker 重要度（米），首尾点为 inf"""
+    n = len(lat)
+    importance = np.zeros(n)
+    if n == 0:
+        return importance
+    importance[0] = importance[-1] = np.inf
+    if n <= 2:
+        return importance
+
+    x, y = project_xy(np.asarray(lat, dtype=float), np.asarray(lng, dtype=float))
+    selected = np.zeros(n, dtype=bool)
+    selected[0] = selected[-1] = True
+    breaks = np.array([0, n - 1])
+    pending = np.arange(1, n - 1)
+
+    while len(pending):
+        # 每个未确定点所在线段 (a, b)
+        seg = np.searchsorted(breaks, pending) - 1
+        a = breaks[seg]
+        b = breaks[seg + 1]
+
+        # 点到线段的距离
+        dx = x[b] - x[a]
+        dy = y[b] - y[a]
+        px = x[pending] - x[a]
+        py = y[pending] - y[a]
+        length2 = dx * dx + dy * dy
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.where(length2 > 0, (px * dx + py * dy) / length2, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        dist = np.hypot(px - t * dx, py - t * dy)
+
+        # 每个线段的最远点（pending 按线段连续分组）
+        starts = np.flatnonzero(np.r_[True, seg[1:] != seg[:-1]])
+        seg_max = np.maximum.reduceat(dist, starts)
+        group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(pending)]))
+        candidates = np.flatnonzero(dist == seg_max[group])
+        first = candidates[np.r_[True, group[candidates][1:] != group[candidates][:-1]]]
+
+        # 重要度不超过父线段的重要度（端点重要度的较小值）
+        parent = np.minimum(importance[a[first]], importance[b[first]])
+        chosen = pending[first]
+        importance[chosen] = np.minimum(dist[first], parent)
+        selected[chosen] = True
+
+        # 最远距离为 0 的线段（全部共线）一次性确定
+        flat = seg_max[group] == 0
+        if flat.any():
+            selected[pending[flat]] = True
+
+        pending = pending[~selected[pending]]
+        breaks = np.flatnonzero(selected)
+
+    return importance
+
+
+def select_points(importance: np.ndarray, tolerance_m: float = None,
+                  max_points: int = None) -> np.ndarray:
+    """按容差和/或目标点数选出保留点的下标（升序）"""
+    keep = np.arange(len(importance))
+    if tolerance_m is not None:
+        keep = keep[importance > tolerance_m]
+    if max_points is not None and len(keep) > max_points:
+        # 重要度降序，相同重要度按下标
+        order = np.lexsort((keep, -importance[keep]))
+        keep = np.sort(keep[order[:max(max_points, 2)]])
+    return keep
+
+
+def encode_polyline(lat: np.ndarray, lng: np.ndarray, precision: int = 5) -> str:
+    """Google Encoded Polyline 编码"""
+    factor = 10 ** precision
+    coords = np.column_stack((np.round(lat * factor), np.round(lng * factor))).astype(np.int64)
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    chunks: List[str] = []
+    for value in zigzag.tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def delta_encode(values: np.ndarray, factor: float = 1) -> List[int]:
+    """首值 + 逐点差值的整数编码"""
+    ints = np.round(np.asarray(values, dtype=float) * factor).astype(np.int64)
+    return np.diff(ints, prepend=0).tolist()
+
+
+def haversine_np(lat1: np.ndarray, lng1: np.ndarray, lat2: np.ndarray, lng2: np.ndarray) -> np.ndarray:
+    """逐元素计算球面距离（米）"""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = np.radians(lng2 - lng1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def trip_distance_m(lat: np.ndarray, lng: np.ndarray, times: np.ndarray,
+                    max_speed_mps: float) -> Tuple[float, int]:
+    """
+    计算轨迹总长度（米），返回 (距离, 剔除的点数)
+
+    前后两段速度都超过 max_speed_mps 的点视为漂移（瞬移后又跳回），
+    剔除后重新计算；剩余的超速段（如长时间无信号后的跳变）不计入距离。
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    times = np.asarray(times, dtype=float)
+    if len(lat) < 2:
+        return 0.0, 0
+
+    keep = np.ones(len(lat), dtype=bool)
+    for _ in range(5):
+        idx = np.flatnonzero(keep)
+        if len(idx) < 3:
+            break
+        dist = haversine_np(lat[idx[:-1]], lng[idx[:-1]], lat[idx[1:]], lng[idx[1:]])
+        speed = dist / np.maximum(np.diff(times[idx]), 1.0)
+        fast = speed > max_speed_mps
+        spikes = fast[:-1] & fast[1:]
+        if not spikes.any():
+            break
+        keep[idx[1:-1][spikes]] = False
+
+    idx = np.flatnonzero(keep)
+    dist = haversine_np(lat[idx[:-1]], lng[idx[:-1]], lat[idx[1:]], lng[idx[1:]])
+    speed = dist / np.maximum(np.diff(times[idx]), 1.0)
+    return float(dist[speed <= max_speed_mps].sum()), len(lat) - len(idx)
+
+
+async def flush_ride_points(order_id: Optional[int]):
+    """
+    还车前写入缓冲中的轨迹点（须在打开数据库会话之前调用，等待期间不占用连接）
+
+    本进程内存中有该骑行的轨迹时无需写入；否则（服务重启后，或本进程是事件总线 follower、
+    轨迹点缓冲在 leader 中）经事件总线写入，最多等待 EVENT_BUS_FLUSH_TIMEOUT，
+    超时后 ride_distance_km 按数据库中已有的轨迹计算
+    """
+    if order_id is not None and trajectory_writer.ride_points(order_id) is not None:
+        return
+    await event_bus.flush_trajectories()
+
+
+def ride_distance_km(db: Session, order_id: int) -> float:
+    """
+    计算订单的骑行距离（公里）
+
+    优先使用轨迹写入管道在内存中保留的本次骑行轨迹，没有时查询数据库
+    （调用方已先调用 flush_ride_points，本函数不等待缓冲写入）
+    """
+    points = trajectory_writer.ride_points(order_id)
+    if points is None:
+        rows = (
+            db.query(BikeTrajectory.latitude, BikeTrajectory.longitude, BikeTrajectory.recorded_at)
+            .filter(BikeTrajectory.order_id == order_id)
+            .order_by(BikeTrajectory.recorded_at, BikeTrajectory.id)
+            .limit(settings.TRAJECTORY_QUERY_MAX_POINTS)
+            .all()
+        )
+        points = (
+            [float(row[0]) for row in rows],
+            [float(row[1]) for row in rows],
+            [row[2].timestamp() if row[2] else 0.0 for row in rows],
+        )
+
+    lat, lng, times = (np.frombuffer(column) if isinstance(column, array) else np.array(column)
+                       for column in points)
+    distance_m, rejected = trip_distance_m(lat, lng, times, settings.RIDE_MAX_SPEED_MPS)
+    if rejected:
+        logger.info(f"订单 {order_id} 计算距离时剔除 {rejected} 个漂移点")
+    return distance_m / 1000
+
+
+class TrackCache:
+    """已完成订单轨迹的 LRU 缓存：保存坐标、时间和重要度（线程安全）"""
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._items: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, order_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            track = self._items.get(order_id)
+            if track is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(order_id)
+            self.hits += 1
+            return track
+
+    def put(self, order_id: int, track: Dict[str, Any]):
+        with self._lock:
+            self._items[order_id] = track
+            self._items.move_to_end(order_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._items)
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+def load_track(db: Session, bike_id: int, order_id: int = None,
+               max_points: int = None) -> Dict[str, Any]:
+    """从数据库读取轨迹（时间升序，最多最近 max_points 个点）并计算重要度"""
+    query = db.query(
+        BikeTrajectory.latitude, BikeTrajectory.longitude, BikeTrajectory.recorded_at
+    ).filter(BikeTrajectory.bike_id == bike_id)
+    if order_id:
+        query = query.filter(BikeTrajectory.order_id == order_id)
+    limit = max_points or settings.TRAJECTORY_QUERY_MAX_POINTS
+    rows = query.order_by(desc(BikeTrajectory.recorded_at), desc(BikeTrajectory.id)).limit(limit).all()
+    rows.reverse()
+
+    lat = np.array([float(row[0]) for row in rows])
+    lng = np.array([float(row[1]) for row in rows])
+    times = np.array([row[2].timestamp() if row[2] else 0.0 for row in rows])
+    return {
+        "bike_id": bike_id,
+        "lat": lat,
+        "lng": lng,
+        "time": times,
+        "importance": dp_importance(lat, lng),
+    }
+
+
+def is_track_final(db: Session, order_id: int) -> bool:
+    """订单已完成且最后的轨迹点已落库，轨迹不会再变化，可以缓存"""
+    order = db.query(Order.status, Order.end_time).filter(Order.id == order_id).first()
+    if not order or order.status != OrderStatus.COMPLETED.value or not order.end_time:
+        return False
+    settle = timedelta(milliseconds=settings.TRAJECTORY_FLUSH_INTERVAL_MS * 2)
+    return datetime.now() - order.end_time > settle
+
+
+# 全局轨迹缓存
+track_cache = TrackCache(settings.TRAJECTORY_CACHE_SIZE)
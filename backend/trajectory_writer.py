@@ -0,0 +1,193 @@
+"""
+轨迹写入管道 - GPS 轨迹点批量写入 bike_trajectories
+
+GPS 消息只把轨迹点追加到内存缓冲，后台线程每 TRAJECTORY_FLUSH_INTERVAL_MS 毫秒
+或缓冲满 TRAJECTORY_BATCH_SIZE 个点时批量 INSERT。
+每个点写入时按车辆从进行中订单索引取当前订单号，不查询数据库。
+
+本进程内开始的骑行（begin_ride）还会在内存中保留完整轨迹，
+还车时直接用于计算骑行距离，无需再查询轨迹表。
+"""
+import threading
+import time
+import logging
+from array import array
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import settings
+from database import engine
+from models import BikeTrajectory
+from active_orders import active_orders
+
+logger = logging.getLogger(__name__)
+
+trajectories_table = BikeTrajectory.__table__
+
+
+class TrajectoryWriter:
+    """轨迹批量写入器（线程安全）"""
+
+    def __init__(self, flush_interval_ms: int = None, batch_size: int = None, max_pending: int = None):
+        self.flush_interval = (flush_interval_ms or settings.TRAJECTORY_FLUSH_INTERVAL_MS) / 1000
+        self.batch_size = batch_size or settings.TRAJECTORY_BATCH_SIZE
+        self.max_pending = max_pending or settings.TRAJECTORY_MAX_PENDING
+
+        # 数据库不可用时最多缓存 max_pending 个点，超出丢弃最旧的
+        self._pending: deque = deque(maxlen=self.max_pending)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+        # 进行中骑行的轨迹: order_id -> (纬度, 经度, 时间戳)，超过上限时置为 None
+        self.ride_max_points = settings.RIDE_BUFFER_MAX_POINTS
+        self._rides: Dict[int, Optional[Tuple[array, array, array]]] = {}
+
+        # 统计指标
+        self.received = 0
+        self.rows_written = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.last_flush_rows = 0
+
+    def append(self, bike_id: int, lat: float, lng: float, mode: str = None,
+               recorded_at: datetime = None):
+        """追加一个轨迹点，订单号取自进行中订单索引"""
+        order_id = active_orders.order_for_bike(bike_id)
+        row = {
+            "bike_id": bike_id,
+            "order_id": order_id,
+            "latitude": lat,
+            "longitude": lng,
+            "mode": mode,
+            "recorded_at": recorded_at or datetime.now(),
+        }
+        with self._lock:
+            self.received += 1
+            if len(self._pending) == self.max_pending:
+                self.dropped += 1
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+
+            ride = self._rides.get(order_id) if order_id is not None else None
+            if ride is not None:
+                if len(ride[0]) >= self.ride_max_points:
+                    self._rides[order_id] = None
+                else:
+                    ride[0].append(lat)
+                    ride[1].append(lng)
+                    ride[2].append(row["recorded_at"].timestamp())
+        if full:
+            self._wake.set()
+
+    def begin_ride(self, order_id: int):
+        """开锁成功后调用，开始在内存中记录该订单的轨迹"""
+        with self._lock:
+            self._rides[order_id] = (array("d"), array("d"), array("d"))
+
+    def ride_points(self, order_id: int) -> Optional[Tuple[array, array, array]]:
+        """
+        获取进行中骑行的完整轨迹副本 (纬度, 经度, 时间戳)
+
+        骑行不是在本进程内开始的，或轨迹超过上限时返回 None（需查询数据库）
+        """
+        with self._lock:
+            ride = self._rides.get(order_id)
+            if ride is None:
+                return None
+            return tuple(array("d", column) for column in ride)
+
+    def end_ride(self, order_id: int):
+        """还车成功后调用，释放内存中的轨迹"""
+        with self._lock:
+            self._rides.pop(order_id, None)
+
+    def flush(self) -> int:
+        """将缓冲中的轨迹点批量写入数据库，返回写入的点数"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                rows = list(self._pending)
+                self._pending.clear()
+
+            start = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    for i in range(0, len(rows), self.batch_size):
+                        # executemany：PyMySQL 会改写为多行 INSERT ... VALUES (...), (...)
+                        conn.execute(trajectories_table.insert(), rows[i:i + self.batch_size])
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error(f"写入轨迹失败: {e}")
+                self._restore(rows)
+                return 0
+
+            self.flush_count += 1
+            self.rows_written += len(rows)
+            self.last_flush_rows = len(rows)
+            self.last_flush_ms = (time.perf_counter() - start) * 1000
+            logger.debug("写入轨迹: %d 个点, 耗时 %.1f ms", len(rows), self.last_flush_ms)
+            return len(rows)
+
+    def _restore(self, rows: List[Dict[str, Any]]):
+        """写库失败时放回缓冲头部，超出容量时丢弃最旧的点"""
+        with self._lock:
+            merged = rows + list(self._pending)
+            overflow = max(0, len(merged) - self.max_pending)
+            self.dropped += overflow
+            self._pending.clear()
+            self._pending.extend(merged[overflow:])
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        """启动后台写入线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="trajectory-writer", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"轨迹写入管道已启动，间隔 {self.flush_interval * 1000:.0f}ms，批量 {self.batch_size} 个点"
+        )
+
+    def stop(self):
+        """停止后台线程并写入剩余轨迹点"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        flushed = self.flush()
+        logger.info(f"轨迹写入管道已停止，关闭前写入 {flushed} 个点")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取写入统计"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "received": self.received,
+            "rows_written": self.rows_written,
+            "pending": pending,
+            "dropped": self.dropped,
+            "flush_count": self.flush_count,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_rows": self.last_flush_rows,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "active_orders": len(active_orders),
+            "buffered_rides": len(self._rides),
+        }
+
+
+# 全局轨迹写入器
+trajectory_writer = TrajectoryWriter()
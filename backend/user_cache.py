@@ -0,0 +1,152 @@
+"""
+RFID 卡 -> 用户缓存
+
+每次刷卡（硬件开锁、开锁接口、刷卡认证）都要按卡号查询用户，而常用的卡只有几千张。
+缓存保存卡号对应的用户 ID、状态和余额：
+- 读穿透: 未命中时查询数据库并放入缓存；命中时冻结、余额不足等判断不访问数据库
+- 写穿透: 充值、修改用户、绑卡、注册和还车扣费提交后，经事件总线在所有 worker 上更新缓存
+- 按 LRU 淘汰，最多 USER_CACHE_SIZE 张卡
+- 与其他 worker 断开期间的写穿透会丢失：重新连接事件总线或接替为 leader 时清空缓存，
+  并且每条缓存最多保留 USER_CACHE_TTL_SECONDS，过期后重新查询数据库
+
+只缓存已注册的卡，未注册的卡每次都查询数据库。扣费以数据库中的余额为准，
+缓存的余额只用于开锁前的最低余额判断。
+"""
+import time
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Any, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from config import settings
+from event_bus import event_bus
+from models import User
+
+
+class CachedUser:
+    """缓存的用户字段（只读快照）"""
+
+    __slots__ = ("id", "rfid_card", "status", "balance", "cached_at")
+
+    def __init__(self, id: int, rfid_card: str, status: str, balance: Decimal):
+        self.id = id
+        self.rfid_card = rfid_card
+        self.status = status
+        self.balance = balance
+        self.cached_at = time.monotonic()
+
+
+class UserCache:
+    """RFID 卡 -> 用户缓存（线程安全）"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_card: "OrderedDict[str, CachedUser]" = OrderedDict()
+        self._card_of_user: Dict[int, str] = {}  # user_id -> 卡号（换卡时移除旧卡）
+        self._version = 0  # 每次写穿透加 1，查询期间有写入时不放入查询结果
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.clears = 0
+        event_bus.register("user", self._apply)
+        event_bus.on_resync(self.clear)
+
+    def get(self, db: Session, rfid_card: str) -> Optional[CachedUser]:
+        """按卡号查找用户，未命中时查询数据库（卡未注册返回 None）"""
+        with self._lock:
+            user = self._by_card.get(rfid_card)
+            if user is not None and time.monotonic() - user.cached_at > self.ttl:
+                self._remove_locked(user)
+                self.expirations += 1
+                user = None
+            if user is not None:
+                self._by_card.move_to_end(rfid_card)
+                self.hits += 1
+                return user
+            self.misses += 1
+            version = self._version
+
+        row = (
+            db.query(User.id, User.rfid_card, User.status, User.balance)
+            .filter(User.rfid_card == rfid_card)
+            .first()
+        )
+        if row is None:
+            return None
+        user = CachedUser(row.id, row.rfid_card, row.status, Decimal(str(row.balance or 0)))
+        with self._lock:
+            if self._version == version:
+                self._put_locked(user)
+        return user
+
+    def update(self, user) -> CachedUser:
+        """用户字段已提交后调用（写穿透，同步给其他 worker），返回新的缓存值"""
+        cached = CachedUser(user.id, user.rfid_card, user.status, Decimal(str(user.balance or 0)))
+        event_bus.emit("user", user={
+            "id": cached.id,
+            "rfid_card": cached.rfid_card,
+            "status": cached.status,
+            "balance": cached.balance,
+        })
+        return cached
+
+    def _apply(self, message: Dict[str, Any]):
+        data = message["user"]
+        user = CachedUser(data["id"], data["rfid_card"], data["status"], Decimal(str(data["balance"])))
+        with self._lock:
+            self._version += 1
+            self.updates += 1
+            old_card = self._card_of_user.get(user.id)
+            if old_card is not None and old_card != user.rfid_card:
+                self._by_card.pop(old_card, None)
+                del self._card_of_user[user.id]
+            if user.rfid_card:
+                self._put_locked(user)
+
+    def clear(self):
+        """清空缓存（可能漏掉了其他 worker 的写穿透）"""
+        with self._lock:
+            self._version += 1
+            self._by_card.clear()
+            self._card_of_user.clear()
+            self.clears += 1
+
+    def _remove_locked(self, user: CachedUser):
+        self._by_card.pop(user.rfid_card, None)
+        if self._card_of_user.get(user.id) == user.rfid_card:
+            del self._card_of_user[user.id]
+
+    def _put_locked(self, user: CachedUser):
+        self._by_card[user.rfid_card] = user
+        self._by_card.move_to_end(user.rfid_card)
+        self._card_of_user[user.id] = user.rfid_card
+        while len(self._by_card) > self.max_size:
+            _, evicted = self._by_card.popitem(last=False)
+            self._card_of_user.pop(evicted.id, None)
+            self.evictions += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._by_card)
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "updates": self.updates,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "clears": self.clears,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+# 全局用户缓存
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_SECONDS)
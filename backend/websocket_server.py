@@ -10,60 +10,562 @@ WebSocket 服务器 - 为前端提供 MQTT 数据桥接
 """
 
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import List
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 import json
+import time
+import uuid
 import logging
 import asyncio
 import threading
+from config import settings
 from mqtt_handler import mqtt_client
+from fleet_state import fleet_state
+from subscription_index import Subscription, SubscriptionIndex, parse_subscription
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖，未安装时只支持 JSON
+    msgpack = None
 
 logger = logging.getLogger(__name__)
 
+# 帧编码：json 为文本帧，msgpack 为二进制帧（连接时 ?encoding=msgpack 协商）
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+# 落后客户端的处理策略
+POLICY_DROP = "drop"  # 丢弃最旧的遥测消息（心跳/GPS），事件消息仍保留
+POLICY_DISCONNECT = "disconnect"  # 直接断开，由客户端重连
+
+# 跟不上推送时的关闭码（1013: Try Again Later）
+CLOSE_CODE_SLOW_CLIENT = 1013
+
+# HTTP 流式推送格式
+STREAM_SSE = "sse"
+STREAM_NDJSON = "ndjson"
+
+# 领域事件的推送主题前缀（见 domain_events）
+EVENT_TOPIC_PREFIX = "event/"
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"无法序列化 {type(value).__name__}")
+
+
+def supported_encodings() -> List[str]:
+    return [ENCODING_JSON, ENCODING_MSGPACK] if msgpack is not None else [ENCODING_JSON]
+
+
+def encode_frame(frame: dict, encoding: str = ENCODING_JSON) -> Union[str, bytes]:
+    """按编码序列化一个帧：json 返回 str（文本帧），msgpack 返回 bytes（二进制帧）"""
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(frame, default=_json_default)
+    return json.dumps(frame, ensure_ascii=False, default=_json_default)
+
+
+def _is_telemetry(topic: str) -> bool:
+    """心跳/GPS 消息：会被同一车辆的后续上报覆盖"""
+    return topic.endswith("/heartbeat") or topic.endswith("/gps")
+
+
+class ReplayBuffer:
+    """
+    推送消息的序号与重放缓冲（在事件循环线程中使用）
+
+    每条推送给前端的 MQTT 消息分配一个递增序号，最近 size 条保存在环形缓冲中。
+    stream_id 每次进程启动时重新生成，客户端据此判断序号是否仍然有效。
+    """
+
+    def __init__(self, size: int):
+        self.stream_id = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self._entries: deque = deque(maxlen=size)  # (seq, topic, data)
+
+    def record(self, topic: str, data: dict) -> int:
+        self.seq += 1
+        self._entries.append((self.seq, topic, data))
+        return self.seq
+
+    def since(self, stream_id: str, last_seq: int) -> Optional[List[Tuple[int, str, dict]]]:
+        """last_seq 之后的消息；流已变化或缺口超出缓冲范围时返回 None"""
+        if stream_id != self.stream_id or last_seq > self.seq:
+            return None
+        oldest = self._entries[0][0] if self._entries else self.seq + 1
+        if last_seq < oldest - 1:
+            return None
+        return list(islice(self._entries, last_seq - oldest + 1, None))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ClientConnection:
+    """
+    单个 WebSocket 客户端的发送端
+
+    广播只把消息放入该客户端的有界队列，由独立的写协程逐条发送，
+    一个慢客户端不会拖慢其他客户端。
+    队列元素: (入队时间, 是否可丢弃, 已编码的帧, 序号)
+    """
+
+    transport = "ws"
+
+    def __init__(self, websocket: WebSocket, manager: "WebSocketManager", encoding: str = ENCODING_JSON):
+        self.websocket = websocket
+        self.manager = manager
+        self.encoding = encoding
+        self.queue: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.connected_at = time.time()
+
+        # 统计指标
+        self.sent = 0
+        self.dropped = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self._lag_total_ms = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        self.closed = True
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def close(self, code: int = 1000):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def enqueue(self, payload: Union[str, bytes], droppable: bool = False, seq: int = None) -> bool:
+        """放入发送队列（须在事件循环线程中调用），客户端被判定为过慢时返回 False"""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.manager.queue_size:
+            if self.manager.policy != POLICY_DROP or not self._drop_stale():
+                return False
+        self.queue.append((time.monotonic(), droppable, payload, seq))
+        self._wakeup.set()
+        return True
+
+    def _drop_stale(self) -> bool:
+        """丢弃队列中最旧的一条可丢弃消息"""
+        for i, (_, droppable, _, _) in enumerate(self.queue):
+            if droppable:
+                del self.queue[i]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _writer(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                enqueued_at, _, payload, _ = self.queue.popleft()
+                send = self.websocket.send_bytes if isinstance(payload, bytes) else self.websocket.send_text
+                await asyncio.wait_for(send(payload), timeout=self.manager.send_timeout)
+                self._record_sent(enqueued_at)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"WebSocket 发送失败，断开连接: {e}")
+            self.manager.disconnect(self.websocket)
+
+    def _record_sent(self, enqueued_at: float):
+        lag = (time.monotonic() - enqueued_at) * 1000
+        self.sent += 1
+        self.last_lag_ms = lag
+        self._lag_total_ms += lag
+        if lag > self.max_lag_ms:
+            self.max_lag_ms = lag
+
+    def get_metrics(self) -> Dict[str, Any]:
+        client = self.websocket.client
+        return {
+            "client": f"{client.host}:{client.port}" if client else None,
+            "transport": self.transport,
+            "connected_seconds": round(time.time() - self.connected_at, 1),
+            "encoding": self.encoding,
+            "queue_depth": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "last_lag_ms": round(self.last_lag_ms, 2),
+            "avg_lag_ms": round(self._lag_total_ms / self.sent, 2) if self.sent else 0.0,
+            "max_lag_ms": round(self.max_lag_ms, 2),
+        }
+
+
+class StreamClient(ClientConnection):
+    """
+    HTTP 流式推送的客户端（SSE 或 NDJSON），供代理不允许 WebSocket 的环境使用
+
+    与 WebSocket 客户端共用同一套订阅、快照/补发和有界队列，
+    不启动写协程，由响应体的生成器直接消费发送队列。
+    SSE 事件 ID 为 "<stream>:<seq>"，浏览器重连时通过 Last-Event-ID 续传。
+    """
+
+    def __init__(self, request, manager: "WebSocketManager", fmt: str):
+        super().__init__(request, manager, ENCODING_JSON)
+        self.transport = fmt
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.closed = True
+        self._wakeup.set()
+
+    async def close(self, code: int = 1000):
+        self.stop()
+
+    def _format(self, payload: str, seq: Optional[int]) -> str:
+        if self.transport == STREAM_NDJSON:
+            return payload + "\n"
+        if seq is None:
+            return f"data: {payload}\n\n"
+        return f"id: {self.manager.replay.stream_id}:{seq}\ndata: {payload}\n\n"
+
+    async def frames(self):
+        """响应体：逐帧输出，空闲时定期发送保活行"""
+        try:
+            if self.transport == STREAM_SSE:
+                yield f"retry: {settings.STREAM_RETRY_MS}\n\n"
+            while not self.closed:
+                if not self.queue:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), settings.STREAM_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n" if self.transport == STREAM_SSE else "\n"
+                    continue
+                enqueued_at, _, payload, seq = self.queue.popleft()
+                yield self._format(payload, seq)
+                self._record_sent(enqueued_at)
+        finally:
+            self.manager.disconnect(self.websocket)
+
+
 class WebSocketManager:
-    """WebSocket 连接管理器"""
+    """
+    WebSocket 连接管理器（除 broadcast_sync 外均在事件循环线程中调用）
+
+    客户端可发送 {"type": "subscribe", "bike_ids": [...], "bbox": [...], "topics": [...]}
+    只接收关心的车辆消息（见 subscription_index），默认接收全部。
 
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    连接建立时先推送车队快照 {"type": "snapshot", "stream", "seq", "bikes"}，
+    之后的 MQTT 消息和领域事件（{"type": "event"}）均带序号。断线重连时客户端在 URL 中带上 stream 和 last_seq，
+    缺失的消息仍在重放缓冲中则只补发缺失部分（{"type": "replay"}），否则重新推送快照。
+
+    连接时可用 ?encoding=msgpack 选择二进制编码；同一个帧对每种编码只序列化一次，
+    由收到它的所有客户端共用。permessage-deflate 压缩由 uvicorn 按连接协商。
+
+    快照、补发和事件帧附带最新的仪表盘数据（"dashboard"），前端无需轮询统计接口。
+    """
+
+    def __init__(self, queue_size: int = None, policy: str = None, send_timeout: float = None):
+        self.clients: Dict[WebSocket, ClientConnection] = {}
         self._loop = None
+        self._dashboard_provider: Optional[Callable[[], Optional[dict]]] = None
+        self.queue_size = queue_size or settings.WS_SEND_QUEUE_SIZE
+        self.policy = policy or settings.WS_SLOW_CLIENT_POLICY
+        self.send_timeout = send_timeout or settings.WS_SEND_TIMEOUT
+        self.subscriptions = SubscriptionIndex(settings.WS_FILTER_CELL_DEG)
+        self.replay = ReplayBuffer(settings.WS_REPLAY_BUFFER_SIZE)
+
+        # 统计指标
+        self.broadcasts = 0
+        self.slow_disconnects = 0
+        self.snapshots_sent = 0
+        self.replays_sent = 0
+        self.events_sent = 0
+        self.encoded_frames = 0
+        self.bytes_by_encoding: Dict[str, int] = {encoding: 0 for encoding in supported_encodings()}
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.clients)
 
     def set_event_loop(self, loop):
         """设置主事件循环引用"""
         self._loop = loop
 
-    async def connect(self, websocket: WebSocket):
-        """接受新的 WebSocket 连接"""
+    def set_dashboard_provider(self, provider: Optional[Callable[[], Optional[dict]]]):
+        """设置仪表盘数据来源（返回 None 表示暂不可用），附带在快照、补发和事件帧中"""
+        self._dashboard_provider = provider
+
+    def _dashboard(self) -> Optional[dict]:
+        return self._dashboard_provider() if self._dashboard_provider is not None else None
+
+    async def connect(self, websocket: WebSocket, stream_id: str = None, last_seq: int = None,
+                      encoding: str = None):
+        """
+        接受新的 WebSocket 连接，并启动其发送协程
+
+        带 stream_id/last_seq 时尝试只补发缺失的消息，否则推送车队快照。
+        快照/补发与注册在同一步内完成，保证排在所有后续推送之前。
+        不支持的编码回退为 JSON
+        """
         await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"新的 WebSocket 连接，当前连接数: {len(self.active_connections)}")
+        if encoding not in supported_encodings():
+            if encoding:
+                logger.warning(f"不支持的 WebSocket 编码 {encoding}，使用 JSON")
+            encoding = ENCODING_JSON
+        client = ClientConnection(websocket, self, encoding)
+        self._register(client, Subscription(), stream_id, last_seq)
+
+    def open_stream(self, request, fmt: str, subscription: Subscription,
+                    stream_id: str = None, last_seq: int = None) -> StreamClient:
+        """注册一个 HTTP 流式推送客户端（订阅条件在建立时给定）"""
+        client = StreamClient(request, self, fmt)
+        self._register(client, subscription, stream_id, last_seq)
+        return client
+
+    def _register(self, client: ClientConnection, subscription: Subscription,
+                  stream_id: Optional[str], last_seq: Optional[int]):
+        self.clients[client.websocket] = client
+        self.subscriptions.set(client, subscription)
+
+        missed = self.replay.since(stream_id, last_seq) if last_seq is not None else None
+        if missed is not None:
+            self._fanout(self._replay_frame(last_seq, missed, subscription), [client], False)
+            self.replays_sent += 1
+        else:
+            self._send_snapshot(client)
+        client.start()
+        logger.info(
+            f"新的推送连接（{client.transport}/{client.encoding}），当前连接数: {len(self.clients)}，"
+            f"{'补发 %d 条消息' % len(missed) if missed is not None else '推送快照'}"
+        )
 
     def disconnect(self, websocket: WebSocket):
         """断开 WebSocket 连接"""
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        logger.info(f"WebSocket 连接断开，当前连接数: {len(self.active_connections)}")
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        self.subscriptions.remove(client)
+        client.stop()
+        logger.info(f"WebSocket 连接断开，当前连接数: {len(self.clients)}")
+
+    def _enqueue(self, client: ClientConnection, payload: Union[str, bytes], droppable: bool,
+                 seq: int = None):
+        if not client.enqueue(payload, droppable, seq):
+            # 队列已满且无法腾出空间：断开慢客户端
+            self.slow_disconnects += 1
+            logger.warning(
+                f"WebSocket 客户端处理过慢（队列 {len(client.queue)} 条），断开连接"
+            )
+            self.disconnect(client.websocket)
+            asyncio.create_task(client.close(CLOSE_CODE_SLOW_CLIENT))
+
+    def _fanout(self, frame: dict, clients, droppable: bool) -> int:
+        """把帧按客户端编码各序列化一次后放入这些客户端的队列，返回入队总字节数"""
+        encoded: Dict[str, Tuple[Union[str, bytes], int]] = {}
+        seq = frame.get("seq")
+        total = 0
+        for client in clients:
+            item = encoded.get(client.encoding)
+            if item is None:
+                payload = encode_frame(frame, client.encoding)
+                size = len(payload) if isinstance(payload, bytes) else len(payload.encode("utf-8"))
+                item = encoded[client.encoding] = (payload, size)
+            self._enqueue(client, item[0], droppable, seq)
+            total += item[1]
+            self.bytes_by_encoding[client.encoding] += item[1]
+        self.encoded_frames += len(encoded)
+        return total
 
-    async def broadcast(self, message: dict):
-        """向所有连接的客户端广播消息"""
-        if not self.active_connections:
+    def _send_snapshot(self, client: ClientConnection):
+        """推送车队快照（按客户端当前订阅过滤）；车队状态未预热时不推送，客户端保留 REST 数据"""
+        if not fleet_state.ready:
             return
+        _, bikes = fleet_state.list_bikes(limit=fleet_state.total())
+        sub = self.subscriptions.get(client)
+        if sub is not None and not sub.unfiltered:
+            bikes = [
+                bike for bike in bikes
+                if (sub.bike_ids and bike["id"] in sub.bike_ids)
+                or sub.in_bbox(bike["current_lat"], bike["current_lng"])
+            ]
+        frame = {
+            "type": "snapshot",
+            "stream": self.replay.stream_id,
+            "seq": self.replay.seq,
+            "bikes": bikes,
+            "dashboard": self._dashboard(),
+        }
+        self._fanout(frame, [client], False)
+        self.snapshots_sent += 1
+
+    def _replay_frame(self, last_seq: int, missed: List[Tuple[int, str, dict]],
+                      subscription: Subscription) -> dict:
+        """补发帧：只含符合订阅的消息，遥测消息每个主题只保留最新一条，认证消息和领域事件全部保留"""
+        if not subscription.unfiltered or subscription.kinds is not None:
+            missed = [
+                entry for entry in missed if subscription.matches(*self._locate(entry[1], entry[2]))
+            ]
+        latest: Dict[str, int] = {}
+        for i, (_, topic, _) in enumerate(missed):
+            if _is_telemetry(topic):
+                latest[topic] = i
+        messages = [
+            {"seq": seq, "topic": topic, "data": data}
+            for i, (seq, topic, data) in enumerate(missed)
+            if not _is_telemetry(topic) or latest[topic] == i
+        ]
+        return {
+            "type": "replay",
+            "stream": self.replay.stream_id,
+            "from_seq": last_seq,
+            "seq": self.replay.seq,
+            "messages": messages,
+            "dashboard": self._dashboard(),
+        }
+
+    async def broadcast(self, message: dict, droppable: bool = False) -> int:
+        """
+        向所有连接的客户端广播消息（只入队，不等待发送），返回入队总字节数
 
-        # 转换为 JSON
-        data = json.dumps(message, ensure_ascii=False)
+        droppable=True 表示可被更新的数据覆盖的遥测消息，客户端落后时优先丢弃
+        """
+        if not self.clients:
+            return 0
 
-        # 向所有连接发送消息
-        disconnected = []
-        for connection in self.active_connections:
+        self.broadcasts += 1
+        return self._fanout(message, list(self.clients.values()), droppable)
+
+    @staticmethod
+    def _locate(topic: str, data: dict) -> Tuple[str, Optional[int], Optional[float], Optional[float]]:
+        """
+        从推送消息中取出 (消息类型, 车辆 ID, 纬度, 经度)，消息不带坐标时取车队状态中的位置
+
+        MQTT 消息的类型和车辆取自主题 bike/<id>/<类型>；领域事件类型为 event，车辆取自 data.bike_id
+        """
+        if topic.startswith(EVENT_TOPIC_PREFIX):
+            kind = "event"
+            bike_id = data.get("bike_id")
+        else:
+            parts = topic.split("/")
+            kind = parts[2] if len(parts) >= 3 else ""
             try:
-                await connection.send_text(data)
-            except Exception as e:
-                logger.error(f"发送消息失败: {e}")
-                disconnected.append(connection)
+                bike_id = int(parts[1])
+            except (IndexError, ValueError):
+                bike_id = None
 
-        # 清理断开的连接
-        for conn in disconnected:
-            self.disconnect(conn)
+        try:
+            lat, lng = float(data["lat"]), float(data["lng"])
+        except (KeyError, TypeError, ValueError):
+            position = fleet_state.position(bike_id) if bike_id is not None else None
+            lat, lng = position if position else (None, None)
+        return kind, bike_id, lat, lng
+
+    def _route(self, topic: str, data: dict, include_all: bool = True) -> Set[ClientConnection]:
+        """按订阅索引找出应收到该 MQTT 消息的客户端"""
+        return self.subscriptions.match(*self._locate(topic, data), include_all)
+
+    async def publish(self, topic: str, data: dict, droppable: bool = False) -> int:
+        """转发一条 MQTT 消息给订阅了它的客户端，返回入队总字节数"""
+        seq = self.replay.record(topic, data)
+        targets = self._route(topic, data)
+        if not targets:
+            return 0
+        frame = {"type": "mqtt", "seq": seq, "topic": topic, "data": data}
+        return self._fanout(frame, targets, droppable)
+
+    async def publish_event(self, topic: str, data: dict, dashboard: dict = None) -> int:
+        """推送一个领域事件（不可丢弃）及其发生后的仪表盘数据，返回入队总字节数"""
+        seq = self.replay.record(topic, data)
+        targets = self._route(topic, data)
+        if not targets:
+            return 0
+        self.events_sent += 1
+        frame = {"type": "event", "seq": seq, "topic": topic, "data": data, "dashboard": dashboard}
+        return self._fanout(frame, targets, False)
+
+    def publish_event_sync(self, topic: str, data: dict, dashboard: dict = None) -> bool:
+        """线程安全版本的 publish_event：交给事件循环按调用顺序推送，事件循环未设置时返回 False"""
+        if self._loop is None:
+            return False
+        asyncio.run_coroutine_threadsafe(self.publish_event(topic, data, dashboard), self._loop)
+        return True
+
+    async def publish_batch(self, messages: List[Tuple[str, dict]]) -> Tuple[int, int]:
+        """
+        按订阅把一批 MQTT 消息合并成 batch 帧推送（可丢弃），返回 (编码的帧数, 入队总字节数)
 
-    def broadcast_sync(self, message: dict):
+        收到相同消息子集的客户端为一组，每组每种编码只序列化一次
+        """
+        seqs = [self.replay.record(topic, data) for topic, data in messages]
+        if not self.clients or not messages:
+            return 0, 0
+
+        # 接收全部消息的客户端直接归为一组，只有带过滤条件的客户端逐条路由
+        per_client: Dict[ClientConnection, List[int]] = {}
+        for i, (topic, data) in enumerate(messages):
+            for client in self._route(topic, data, include_all=False):
+                per_client.setdefault(client, []).append(i)
+
+        groups: Dict[Tuple[int, ...], List[ClientConnection]] = {}
+        everyone = self.subscriptions.unfiltered_all()
+        if everyone:
+            groups[tuple(range(len(messages)))] = list(everyone)
+        for client, indices in per_client.items():
+            groups.setdefault(tuple(indices), []).append(client)
+
+        ts = time.time()
+        bytes_out = 0
+        encoded_before = self.encoded_frames
+        for indices, clients in groups.items():
+            frame = {
+                "type": "batch",
+                "ts": ts,
+                "seq": seqs[indices[-1]],
+                "messages": [
+                    {"seq": seqs[i], "topic": messages[i][0], "data": messages[i][1]} for i in indices
+                ],
+            }
+            bytes_out += self._fanout(frame, clients, True)
+        self.broadcasts += len(groups)
+        return self.encoded_frames - encoded_before, bytes_out
+
+    async def handle_client_message(self, websocket: WebSocket, text: str):
+        """处理客户端发来的消息（订阅/取消订阅/请求快照，任何编码下都是 JSON 文本帧）"""
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        try:
+            message = json.loads(text)
+            msg_type = message.get("type")
+            if msg_type == "resync":
+                self._send_snapshot(client)
+                return
+            if msg_type == "subscribe":
+                sub = parse_subscription(message)
+            elif msg_type == "unsubscribe":
+                sub = Subscription()
+            else:
+                logger.debug(f"收到 WebSocket 消息: {text}")
+                return
+        except (ValueError, TypeError, AttributeError) as e:
+            await self.send_personal({"type": "error", "message": f"订阅请求无效: {e}"}, websocket)
+            return
+
+        self.subscriptions.set(client, sub)
+        logger.info(f"WebSocket 客户端更新订阅: {sub.to_dict()}")
+        await self.send_personal({"type": "subscribed", **sub.to_dict()}, websocket)
+
+    def broadcast_sync(self, message: dict, droppable: bool = False):
         """同步版本的广播（用于从 MQTT 线程调用）"""
         if self._loop is None:
             logger.warning("事件循环未设置，无法广播消息")
@@ -71,9 +573,9 @@ class WebSocketManager:
             return
 
         try:
-            # 使用 run_coroutine_threadsafe 从其他线程安全地调度协程
-            future = asyncio.run_coroutine_threadsafe(
-                self.broadcast(message),
+            # 从其他线程安全地调度协程
+            asyncio.run_coroutine_threadsafe(
+                self.broadcast(message, droppable),
                 self._loop
             )
             logger.debug("消息已提交到事件循环: %s", message.get('topic', 'unknown'))
@@ -81,40 +583,160 @@ class WebSocketManager:
             logger.error(f"提交消息到事件循环失败: {e}")
 
     async def send_personal(self, message: dict, websocket: WebSocket):
-        """向特定客户端发送消息"""
-        try:
-            await websocket.send_text(json.dumps(message, ensure_ascii=False))
-        except Exception as e:
-            logger.error(f"发送个人消息失败: {e}")
+        """向特定客户端发送消息（经该客户端的发送队列，保证顺序）"""
+        client = self.clients.get(websocket)
+        if client is None:
+            logger.warning("发送个人消息失败: 客户端未连接")
+            return
+        self._fanout(message, [client], False)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取连接与发送统计"""
+        clients = [client.get_metrics() for client in self.clients.values()]
+        return {
+            "connections": len(clients),
+            "policy": self.policy,
+            "queue_size": self.queue_size,
+            "broadcasts": self.broadcasts,
+            "slow_disconnects": self.slow_disconnects,
+            "total_dropped": sum(c["dropped"] for c in clients),
+            "max_queue_depth": max((c["queue_depth"] for c in clients), default=0),
+            "max_lag_ms": max((c["max_lag_ms"] for c in clients), default=0.0),
+            "subscriptions": self.subscriptions.get_metrics(),
+            "stream": self.replay.stream_id,
+            "seq": self.replay.seq,
+            "replay_buffered": len(self.replay),
+            "snapshots_sent": self.snapshots_sent,
+            "replays_sent": self.replays_sent,
+            "events_sent": self.events_sent,
+            "encodings": supported_encodings(),
+            "encoded_frames": self.encoded_frames,
+            "bytes_by_encoding": self.bytes_by_encoding,
+            "per_message_deflate": settings.WS_PER_MESSAGE_DEFLATE,
+            "clients": clients,
+        }
 
 
 # 创建全局 WebSocket 管理器
 websocket_manager = WebSocketManager()
 
 
-def setup_mqtt_forwarding():
-    """设置 MQTT 消息转发到 WebSocket"""
+class TelemetryCoalescer:
+    """
+    遥测消息合并器（在事件循环线程中使用）
+
+    心跳/GPS 消息按主题只保留 tick 内的最新一条，每个 tick 合并成一个
+    batch 帧广播: {"type": "batch", "ts": ..., "messages": [{"topic", "data"}, ...]}
+    推送帧数从 O(消息数 × 客户端数) 降到 O(tick 数 × 客户端数)。
+    """
+
+    def __init__(self, manager: WebSocketManager, tick_ms: int = None):
+        self.manager = manager
+        self.tick = (tick_ms if tick_ms is not None else settings.WS_TICK_MS) / 1000
+        self._pending: Dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._started_at = time.monotonic()
+
+        # 统计指标
+        self.messages_in = 0
+        self.messages_out = 0
+        self.ticks = 0  # 有数据推送的 tick 数
+        self.frames = 0  # 编码的帧数（每个订阅分组一个）
+        self.bytes_out = 0  # 所有客户端合计入队字节数
+
+    def update(self, topic: str, data: dict):
+        """记录一条遥测消息，同一主题在 tick 内只保留最新的"""
+        self.messages_in += 1
+        self._pending[topic] = data
+
+    async def flush(self):
+        """把当前 tick 内的更新合并为一个帧广播"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        frames, bytes_out = await self.manager.publish_batch(list(pending.items()))
+        if not frames:
+            return  # 没有客户端订阅这些消息
+        self.ticks += 1
+        self.frames += frames
+        self.bytes_out += bytes_out
+        self.messages_out += len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"推送合并帧失败: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._started_at = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"遥测消息合并已启用，间隔 {self.tick * 1000:.0f}ms")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
 
-    def on_mqtt_message(topic: str, data: dict):
-        """MQTT 消息回调（在 MQTT 客户端线程中调用）"""
-        # 构造 WebSocket 消息
-        ws_message = {
-            "type": "mqtt",
-            "topic": topic,
-            "data": data
+    def get_metrics(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self._started_at, 1e-6)
+        return {
+            "tick_ms": round(self.tick * 1000),
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "pending": len(self._pending),
+            "ticks": self.ticks,
+            "frames_per_sec": round(self.ticks / elapsed, 2),  # 每个客户端最多收到的帧率
+            "encoded_frames": self.frames,
+            "bytes_out": self.bytes_out,
+            "bytes_per_sec": round(self.bytes_out / elapsed),
         }
 
-        # 使用同步版本的广播方法
-        try:
-            websocket_manager.broadcast_sync(ws_message)
-            logger.debug(f"成功转发 MQTT 消息: {topic}")
-        except Exception as e:
-            logger.error(f"转发 MQTT 消息到 WebSocket 失败: {e}")
+
+# 全局遥测合并器
+telemetry_coalescer = TelemetryCoalescer(websocket_manager)
+
+
+async def forward_mqtt_message(topic: str, data: dict):
+    """
+    MQTT 消息回调（协程）：转发给 WebSocket 客户端
+
+    asyncio 传输模式下直接在事件循环中执行；
+    线程模式下由 MQTTHandler 通过 run_coroutine_threadsafe 调度；
+    事件总线 follower 收到 leader 转发的消息时也直接调用
+    """
+    # 心跳/GPS 进入合并器按 tick 批量推送；认证消息立即推送
+    if settings.WS_TICK_MS > 0 and not topic.endswith("/auth"):
+        telemetry_coalescer.update(topic, data)
+        return
+
+    try:
+        # 心跳/GPS 会被后续上报覆盖，客户端落后时可以丢弃；认证消息必须送达
+        await websocket_manager.publish(topic, data, droppable=not topic.endswith("/auth"))
+        logger.debug("成功转发 MQTT 消息: %s", topic)
+    except Exception as e:
+        logger.error(f"转发 MQTT 消息到 WebSocket 失败: {e}")
+
+
+def setup_mqtt_forwarding(subscribe: bool = True):
+    """
+    设置 MQTT 消息转发到 WebSocket（须在事件循环中调用）
+
+    WS_TICK_MS > 0 时心跳/GPS 按 tick 合并为 batch 帧推送，0 表示逐条转发。
+    subscribe=False 时不订阅 MQTT（事件总线 follower，消息由 leader 转发）
+    """
+    if settings.WS_TICK_MS > 0:
+        telemetry_coalescer.start()
+    if not subscribe:
+        return
 
     # 订阅所有车辆相关的 MQTT 主题
-    mqtt_client.subscribe("bike/+/heartbeat", on_mqtt_message)
-    mqtt_client.subscribe("bike/+/gps", on_mqtt_message)
-    mqtt_client.subscribe("bike/+/auth", on_mqtt_message)
+    mqtt_client.subscribe("bike/+/heartbeat", forward_mqtt_message)
+    mqtt_client.subscribe("bike/+/gps", forward_mqtt_message)
+    mqtt_client.subscribe("bike/+/auth", forward_mqtt_message)
 
     logger.info("MQTT 消息转发到 WebSocket 已启用")
 
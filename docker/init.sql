@@ -66,6 +66,8 @@ CREATE INDEX idx_users_rfid ON users(rfid_card);
 CREATE INDEX idx_bikes_status ON bikes(status);
 CREATE INDEX idx_orders_user ON orders(user_id);
 CREATE INDEX idx_orders_bike ON orders(bike_id);
+-- 每个用户最多一个进行中的订单
+CREATE UNIQUE INDEX uq_orders_active_user ON orders(user_id) WHERE status = 'active';
 CREATE INDEX idx_trajectories_bike ON bike_trajectories(bike_id);
 CREATE INDEX idx_trajectories_order ON bike_trajectories(order_id);
 
@@ -0,0 +1,15 @@
+-- 数据库迁移脚本：每个用户最多一个进行中的订单（orders.active_user_id 生成列 + 唯一索引）
+-- 执行方式：mysql -u bikeuser -pbikepass123 bikesharing < migration_one_active_order_per_user.sql
+-- 执行前先确认没有同一用户多个进行中的订单，否则创建唯一索引会失败：
+--   SELECT user_id, COUNT(*) FROM orders WHERE status = 'active' GROUP BY user_id HAVING COUNT(*) > 1;
+
+USE bikesharing;
+
+ALTER TABLE orders
+    ADD COLUMN active_user_id INT GENERATED ALWAYS AS (CASE WHEN status = 'active' THEN user_id END) VIRTUAL,
+    ADD UNIQUE KEY uq_orders_active_user (active_user_id);
+
+-- 验证修改
+SHOW INDEX FROM orders WHERE Key_name = 'uq_orders_active_user';
+
+SELECT 'Migration completed successfully!' AS message;
@@ -43,6 +43,9 @@ CREATE TABLE orders (
     distance_km DECIMAL(10, 2),
     status VARCHAR(20) DEFAULT 'active',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- 进行中的订单为 user_id，其余为 NULL；唯一索引保证每个用户最多一个进行中的订单
+    active_user_id INT GENERATED ALWAYS AS (CASE WHEN status = 'active' THEN user_id END) VIRTUAL,
+    UNIQUE KEY uq_orders_active_user (active_user_id),
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL,
     FOREIGN KEY (bike_id) REFERENCES bikes(id) ON DELETE SET NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
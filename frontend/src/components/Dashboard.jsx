@@ -15,7 +15,7 @@ import './Dashboard.css';
 
 function Dashboard() {
   console.log('[Dashboard] 🚀 组件渲染开始 - 代码版本: 2026-01-13-15:45');
-  const { bikes, stats, loading, refetch, updateBike } = useBikes();
+  const { bikes, stats, loading, refetch, updateBike, replaceBikes, replaceStats } = useBikes();
   const { connected, subscribe } = useMQTT();
   const [selectedBike, setSelectedBike] = useState(null);
   const [isRefreshing, setIsRefreshing] = useState(false);
@@ -72,10 +72,8 @@ function Dashboard() {
           battery: data.battery,
           status: data.status,
           last_heartbeat: new Date().toISOString(),
+          online: true,
         });
-
-        // 如果收到心跳包，立即刷新数据（确保状态同步）
-        setTimeout(() => refetch(), 500);
       }
     );
 
@@ -94,19 +92,40 @@ function Dashboard() {
           current_lat: parseFloat(data.lat), // 转换为数字
           current_lng: parseFloat(data.lng), // 转换为数字
           last_heartbeat: new Date().toISOString(),
+          online: true,
         });
-
-        // GPS上报时也刷新数据
-        setTimeout(() => refetch(), 500);
       }
     );
 
+    // 连接/重连时后端推送的车队快照（补发成功时不会推送），无需再调用 REST 接口
+    const unsubscribeSnapshot = subscribe('snapshot', (topic, items) => {
+      console.log('[Dashboard] 收到车队快照:', items.length);
+      replaceBikes(items);
+    });
+
+    // 开锁、还车、修改车辆状态等事件：直接更新对应车辆
+    const unsubscribeEvents = subscribe('event/+', (topic, data) => {
+      console.log('[Dashboard] 收到事件:', topic, data);
+      if (data.bike) {
+        const { id, ...changes } = data.bike;
+        updateBike(id, changes);
+      }
+    });
+
+    // 事件发生后后端推送的仪表盘数据，替代定时轮询统计接口
+    const unsubscribeDashboard = subscribe('dashboard', (topic, dashboard) => {
+      replaceStats(dashboard);
+    });
+
     // 清理函数
     return () => {
       unsubscribeHeartbeat();
       unsubscribeGps();
+      unsubscribeSnapshot();
+      unsubscribeEvents();
+      unsubscribeDashboard();
     };
-  }, [connected, subscribe, updateBike]);
+  }, [connected, subscribe, updateBike, replaceBikes, replaceStats]);
 
   if (loading && bikes.length === 0) {
     return (
@@ -131,7 +150,7 @@ function Dashboard() {
           />
           <Badge
             status="default"
-            text={`在线车辆: ${bikes.filter(b => b.last_heartbeat).length}`}
+            text={`在线车辆: ${stats.online_bikes ?? bikes.filter(b => b.online).length}`}
           />
           <Badge
             status={bikes.filter(b => b.status === 'riding').length > 0 ? 'success' : 'default'}
@@ -7,13 +7,16 @@ import {
 } from '@ant-design/icons';
 import { MAP_CONFIG } from '../config/mapConfig';
 import { loadBaiduMapScript, isBaiduMapLoaded } from '../utils/loadBaiduMap';
-import { wgs84ToBd09, isValidCoord } from '../utils/mapUtils';
+import { wgs84ToBd09, bd09ToWgs84, isValidCoord } from '../utils/mapUtils';
+import { bikeAPI } from '../services/api';
 import './MapView.css';
 
 function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSelect }) {
   const mapContainerRef = useRef(null);
   const mapRef = useRef(null);
   const markersRef = useRef({});
+  const clusterMarkersRef = useRef([]); // 聚合簇标记
+  const viewportTimerRef = useRef(null);
   const polylinesRef = useRef({}); // 存储轨迹线
   const infoWindowRef = useRef(null);
   const bikesRef = useRef(bikes); // 保存 bikes 引用，用于定时器
@@ -25,6 +28,8 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
   const [containerReady, setContainerReady] = useState(false);
   const [initTriggered, setInitTriggered] = useState(false);
   const [isInitializing, setIsInitializing] = useState(false);
+  // 当前视野的查询结果：{ mode: 'bikes' | 'clusters', total, clusters, bikes }
+  const [viewport, setViewport] = useState(null);
 
   // 使用外部传入的 selectedBike，如果没有则使用内部状态
   const selectedBike = externalSelectedBike !== undefined ? externalSelectedBike : internalSelectedBike;
@@ -104,6 +109,33 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
     return undefined;
   }, []);
 
+  // 查询当前视野：缩小时由后端返回聚合簇，放大时返回视野内的车辆
+  const refreshViewport = useCallback(async () => {
+    const map = mapRef.current;
+    if (!map) {
+      return;
+    }
+    const bounds = map.getBounds();
+    const sw = bd09ToWgs84(bounds.getSouthWest().lat, bounds.getSouthWest().lng);
+    const ne = bd09ToWgs84(bounds.getNorthEast().lat, bounds.getNorthEast().lng);
+    try {
+      const response = await bikeAPI.getViewport({
+        bbox: [sw.lng, sw.lat, ne.lng, ne.lat].map((v) => v.toFixed(6)).join(','),
+        zoom: map.getZoom(),
+      });
+      setViewport(response);
+    } catch (error) {
+      console.error('[MapView] 视野查询失败:', error);
+      setViewport(null); // 回退为渲染全部车辆
+    }
+  }, []);
+
+  // 地图移动/缩放结束后防抖刷新视野
+  const scheduleViewportRefresh = useCallback(() => {
+    clearTimeout(viewportTimerRef.current);
+    viewportTimerRef.current = setTimeout(refreshViewport, 300);
+  }, [refreshViewport]);
+
   // 初始化地图
   const initMap = useCallback(async () => {
     try {
@@ -170,6 +202,11 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
 
       mapRef.current = map;
 
+      // 视野变化时重新查询车辆/聚合簇
+      map.addEventListener('moveend', scheduleViewportRefresh);
+      map.addEventListener('zoomend', scheduleViewportRefresh);
+      refreshViewport();
+
       // 创建 InfoWindow
       infoWindowRef.current = new window.BMap.InfoWindow('', {
         width: 300,
@@ -184,7 +221,43 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
       setMapError(error.message || '地图加载失败，请检查配置');
       setIsInitializing(false);
     }
-  }, []);
+  }, [refreshViewport, scheduleViewportRefresh]);
+
+  // 绘制聚合簇（圆圈 + 数量，颜色按空闲/骑行/故障占比）
+  const drawClusters = (map, clusters) => {
+    clusters.forEach((cluster) => {
+      const bd09Coord = wgs84ToBd09(cluster.lat, cluster.lng);
+      const point = new window.BMap.Point(bd09Coord.lng, bd09Coord.lat);
+      const counts = cluster.status_counts || {};
+      const size = Math.min(64, 28 + Math.round(Math.log10(cluster.count) * 12));
+      const label = new window.BMap.Label(String(cluster.count), {
+        position: point,
+        offset: new window.BMap.Size(-size / 2, -size / 2),
+      });
+      label.setStyle({
+        width: `${size}px`,
+        height: `${size}px`,
+        lineHeight: `${size}px`,
+        borderRadius: '50%',
+        border: '3px solid rgba(255, 255, 255, 0.8)',
+        background: getClusterColor(counts),
+        color: '#fff',
+        fontSize: '12px',
+        fontWeight: 'bold',
+        textAlign: 'center',
+        cursor: 'pointer',
+      });
+      label.setTitle(
+        `空闲 ${counts.idle || 0} / 骑行中 ${counts.riding || 0} / 故障 ${counts.fault || 0}`
+      );
+      // 点击簇放大两级
+      label.addEventListener('click', () => {
+        map.centerAndZoom(point, Math.min(map.getZoom() + 2, 20));
+      });
+      map.addOverlay(label);
+      clusterMarkersRef.current.push(label);
+    });
+  };
 
   // 添加或更新 Marker
   const updateMarkers = useCallback(() => {
@@ -195,11 +268,15 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
 
     const map = mapRef.current;
 
-    // 清除所有现有的 Marker
+    // 清除所有现有的 Marker 和聚合簇
     Object.values(markersRef.current).forEach((marker) => {
       map.removeOverlay(marker);
     });
     markersRef.current = {};
+    clusterMarkersRef.current.forEach((label) => {
+      map.removeOverlay(label);
+    });
+    clusterMarkersRef.current = [];
 
     // 只清除非骑行状态车辆的轨迹线（保留骑行中的轨迹）
     const ridingBikeIds = new Set(
@@ -215,10 +292,23 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
       }
     });
 
-    console.log('[MapView] updateMarkers: 开始添加标记，车辆总数:', bikes.length);
+    if (viewport && viewport.mode === 'clusters') {
+      drawClusters(map, viewport.clusters);
+      console.log('[MapView] updateMarkers: 聚合模式，簇数量:', viewport.clusters.length);
+      return;
+    }
+
+    // 视野内的车辆，用实时推送的最新数据覆盖
+    let visibleBikes = bikes;
+    if (viewport) {
+      const latest = new Map(bikes.map((bike) => [bike.id, bike]));
+      visibleBikes = viewport.bikes.map((bike) => latest.get(bike.id) || bike);
+    }
+
+    console.log('[MapView] updateMarkers: 开始添加标记，车辆总数:', visibleBikes.length);
 
     // 添加新的 Marker
-    bikes.forEach((bike) => {
+    visibleBikes.forEach((bike) => {
       console.log('[MapView] 处理车辆:', bike.bike_code, '原始坐标:', bike.current_lat, bike.current_lng);
 
       if (!isValidCoord(bike.current_lat, bike.current_lng)) {
@@ -303,7 +393,7 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
     });
 
     console.log('[MapView] updateMarkers: 完成，已添加', Object.keys(markersRef.current).length, '个标记');
-  }, [bikes, onBikeSelect]);
+  }, [bikes, viewport, onBikeSelect]);
 
   // 绘制骑行中车辆的轨迹
   const drawRidingTrajectories = useCallback(() => {
@@ -416,6 +506,7 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
   // 组件卸载时清理地图资源
   useEffect(() => {
     return () => {
+      clearTimeout(viewportTimerRef.current);
       // 清除轨迹线
       if (mapRef.current) {
         Object.values(polylinesRef.current).forEach((polyline) => {
@@ -446,6 +537,17 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
     return texts[status] || status;
   };
 
+  const getClusterColor = (counts) => {
+    const total = (counts.idle || 0) + (counts.riding || 0) + (counts.fault || 0);
+    if (!total) {
+      return '#1890ff';
+    }
+    if ((counts.fault || 0) / total > 0.3) {
+      return '#8c8c8c';
+    }
+    return (counts.riding || 0) > (counts.idle || 0) ? '#ff4d4f' : '#52c41a';
+  };
+
   const getBikeIconColor = (status) => {
     const colors = {
       idle: '#52c41a',
@@ -582,6 +684,9 @@ function MapView({ bikes, loading, selectedBike: externalSelectedBike, onBikeSel
           <EnvironmentOutlined />
           实时监控地图
           <Tag color="blue">{bikes.length} 辆车</Tag>
+          {viewport && viewport.mode === 'clusters' && (
+            <Tag color="purple">视野内 {viewport.total} 辆（已聚合）</Tag>
+          )}
         </Space>
       }
       variant="borderless"
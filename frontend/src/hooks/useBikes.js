@@ -45,6 +45,17 @@ export const useBikes = () => {
     });
   }, []);
 
+  // 用 WebSocket 推送的车队快照替换全部车辆
+  const replaceBikes = useCallback((items) => {
+    setBikes(items);
+    setLoading(false);
+  }, []);
+
+  // 用 WebSocket 推送的仪表盘数据替换统计
+  const replaceStats = useCallback((dashboard) => {
+    setStats(dashboard);
+  }, []);
+
   // 远程控制车辆
   const controlBike = useCallback(async (bikeId, command) => {
     try {
@@ -56,18 +67,10 @@ export const useBikes = () => {
     }
   }, []);
 
-  // 初始化数据
+  // 初始化数据（之后的变化由 WebSocket 推送，不再定时轮询）
   useEffect(() => {
     fetchBikes();
     fetchStats();
-
-    // 每 10 秒刷新一次车辆数据
-    const interval = setInterval(() => {
-      fetchBikes();
-      fetchStats();
-    }, 10000);
-
-    return () => clearInterval(interval);
   }, [fetchBikes, fetchStats]);
 
   return {
@@ -76,6 +79,8 @@ export const useBikes = () => {
     loading,
     error,
     updateBike,
+    replaceBikes,
+    replaceStats,
     controlBike,
     refetch: fetchBikes,
   };
@@ -65,6 +65,9 @@ export const bikeAPI = {
   // 获取车辆列表
   getBikes: (params) => api.get('/bikes', { params }),
 
+  // 获取地图视野内的车辆或聚合簇
+  getViewport: (params) => api.get('/bikes/viewport', { params }),
+
   // 获取车辆详情
   getBike: (bikeId) => api.get(`/bikes/${bikeId}`),
 
@@ -3,6 +3,12 @@
  *
  * 后端会订阅 MQTT 消息并通过 WebSocket 转发给前端
  * 这样避免了浏览器直接连接 MQTT broker 的限制
+ *
+ * 连接建立后后端先推送车队快照（'snapshot' 事件），之后的消息都带序号；
+ * 重连时带上最后收到的序号，后端只补发断线期间缺失的消息
+ *
+ * 订单、车辆状态、余额等变化以领域事件推送（主题 event/<事件名>），
+ * 快照、补发和事件帧附带最新的仪表盘数据（'dashboard' 事件），无需轮询统计接口
  */
 
 class WebSocketService {
@@ -13,13 +19,20 @@ class WebSocketService {
     this.reconnectAttempts = 0;
     this.maxReconnectAttempts = 5;
     this.reconnectTimeout = null;
+    this.subscription = null; // 订阅条件，重连后重新发送
+    this.streamId = null; // 后端推送流 ID（后端重启后变化）
+    this.lastSeq = null; // 最后收到的消息序号
+    this.pending = {}; // 尚无监听器时收到的快照/仪表盘数据，注册监听器时补发
   }
 
   connect() {
     return new Promise((resolve, reject) => {
       try {
         // 连接到后端 WebSocket 端点
-        const wsUrl = `ws://localhost:8000/ws`;
+        let wsUrl = `ws://localhost:8000/ws`;
+        if (this.streamId && this.lastSeq !== null) {
+          wsUrl += `?stream=${this.streamId}&last_seq=${this.lastSeq}`;
+        }
 
         console.log('正在连接后端 WebSocket...');
         console.log('地址:', wsUrl);
@@ -31,6 +44,9 @@ class WebSocketService {
           console.log('✅ WebSocket 连接成功');
           this.connected = true;
           this.reconnectAttempts = 0;
+          if (this.subscription) {
+            this.send({ type: 'subscribe', ...this.subscription });
+          }
           resolve(this.ws);
         };
 
@@ -80,27 +96,68 @@ class WebSocketService {
 
   _handleMessage(message) {
     // 处理来自后端的消息
-    if (message.type === 'mqtt') {
-      // MQTT 消息转发
-      const { topic, data } = message;
-      console.log('📨 收到 MQTT 消息:', topic, data);
-      console.log('[WebSocket] 当前注册的监听器:', Object.keys(this.listeners));
-
-      // 触发所有注册的监听器
-      Object.keys(this.listeners).forEach((pattern) => {
-        const matched = this._topicMatch(topic, pattern);
-        console.log('[WebSocket] 匹配测试 - topic:', topic, 'pattern:', pattern, 'matched:', matched);
-        if (matched) {
-          console.log('[WebSocket] 触发监听器:', pattern, '回调数量:', this.listeners[pattern].length);
-          this.listeners[pattern].forEach((callback) => {
-            console.log('[WebSocket] 执行回调函数');
-            callback(topic, data);
-          });
-        }
-      });
+    if (message.seq !== undefined && (this.lastSeq === null || message.seq > this.lastSeq)) {
+      this.lastSeq = message.seq;
+    }
+
+    if (message.type === 'snapshot') {
+      // 车队快照：替换本地的全部车辆数据
+      console.log('[WebSocket] 收到车队快照:', message.bikes.length, '辆车, seq:', message.seq);
+      this.streamId = message.stream;
+      this.lastSeq = message.seq;
+      this._deliver('snapshot', message.bikes);
+      this._deliverDashboard(message.dashboard);
+    } else if (message.type === 'replay') {
+      // 重连补发：按顺序分发断线期间缺失的消息
+      console.log('[WebSocket] 补发缺失消息:', message.messages.length, '条');
+      message.messages.forEach(({ topic, data }) => this._dispatch(topic, data));
+      this._deliverDashboard(message.dashboard);
+    } else if (message.type === 'event') {
+      // 领域事件（开锁、还车、充值等），附带事件发生后的仪表盘数据
+      console.log('[WebSocket] 收到事件:', message.topic, message.data);
+      this._dispatch(message.topic, message.data);
+      this._deliverDashboard(message.dashboard);
+    } else if (message.type === 'mqtt') {
+      // MQTT 消息转发（认证等事件逐条推送）
+      console.log('📨 收到 MQTT 消息:', message.topic, message.data);
+      this._dispatch(message.topic, message.data);
+    } else if (message.type === 'subscribed') {
+      console.log('[WebSocket] 订阅已生效:', message);
+    } else if (message.type === 'error') {
+      console.warn('[WebSocket] 服务端错误:', message.message);
+    } else if (message.type === 'batch') {
+      // 心跳/GPS 按 tick 合并的批量帧：拆开后按主题逐条分发
+      message.messages.forEach(({ topic, data }) => this._dispatch(topic, data));
+    }
+  }
+
+  _deliver(event, data) {
+    // 只保留最新的一份：有监听器时立即分发，否则等注册监听器时补发
+    if (this.listeners[event] && this.listeners[event].length) {
+      this._dispatch(event, data);
+    } else {
+      this.pending[event] = data;
     }
   }
 
+  _deliverDashboard(dashboard) {
+    // 后端仪表盘计数未就绪时不带该字段，前端保留接口获取的数据
+    if (dashboard) {
+      this._deliver('dashboard', dashboard);
+    }
+  }
+
+  _dispatch(topic, data) {
+    // 触发所有匹配主题的监听器
+    Object.keys(this.listeners).forEach((pattern) => {
+      if (this._topicMatch(topic, pattern)) {
+        this.listeners[pattern].forEach((callback) => {
+          callback(topic, data);
+        });
+      }
+    });
+  }
+
   _topicMatch(topic, pattern) {
     // 简单的通配符匹配
     const regex = pattern.replace('+', '[^/]+').replace('#', '.*');
@@ -113,6 +170,12 @@ class WebSocketService {
     }
     this.listeners[event].push(callback);
     console.log('[WebSocket] 注册监听器:', event, '该事件监听器数量:', this.listeners[event].length);
+
+    if (this.pending[event] !== undefined) {
+      const data = this.pending[event];
+      delete this.pending[event];
+      callback(event, data);
+    }
   }
 
   off(event, callback) {
@@ -121,6 +184,17 @@ class WebSocketService {
     }
   }
 
+  /**
+   * 设置订阅条件，只接收关心的车辆消息
+   * @param {Object|null} filter - { bike_ids, bbox: [minLng, minLat, maxLng, maxLat], topics }，null 表示全部
+   */
+  subscribe(filter) {
+    this.subscription = filter;
+    if (this.connected) {
+      this.send(filter ? { type: 'subscribe', ...filter } : { type: 'unsubscribe' });
+    }
+  }
+
   send(message) {
     if (this.ws && this.connected) {
       this.ws.send(JSON.stringify(message));